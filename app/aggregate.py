@@ -0,0 +1,173 @@
+import json
+import logging
+import os
+import re
+import threading
+from collections import Counter
+from datetime import datetime, timedelta, timezone, tzinfo
+from pathlib import Path
+
+logger = logging.getLogger("porfiriy.aggregate")
+
+_WORD = re.compile(r"[a-zа-яё0-9][a-zа-яё0-9-]{2,}")
+STOPWORDS = frozenset(
+    """
+    это как что так вот уже ещё еще там тут его она они оно мне меня тебя тебе нас вас
+    был была были было будет быть есть нет для или если когда чем где кто все всё всех
+    тоже только даже очень просто вообще сейчас потом надо можно нужно ничего чего этот
+    эта эти того тот той том при про под над без через после перед между мой моя мои твой
+    наш ваш свой себя себе который которая которые почему зачем опять ещё лол ага угу блин
+    the and for that this with you are was have not but what all can your just they from
+    nax find
+    """.split()
+)
+# Per-hour term counters are cut back to the most frequent ones past this size.
+MAX_TERMS_PER_HOUR = 2000
+KEEP_TERMS_PER_HOUR = 600
+MAX_REPLIED_PER_HOUR = 200
+
+
+def words(text: str) -> list[str]:
+    # Lowercased content words; a leading /command and stopwords are dropped.
+    if text.startswith("/"):
+        text = text.split(maxsplit=1)[1] if " " in text else ""
+    return [w for w in _WORD.findall(text.lower()) if w not in STOPWORDS and not w.isdigit()]
+
+
+def terms(text: str) -> list[str]:
+    # Content words plus adjacent word pairs.
+    found = words(text)
+    return found + [f"{a} {b}" for a, b in zip(found, found[1:])]
+
+
+def _hour_key(ts: datetime) -> str:
+    return ts.astimezone(timezone.utc).strftime("%Y-%m-%dT%H")
+
+
+# Bucket dicts that add() changes in place.
+_GROWING = ("users", "terms", "replied")
+
+
+def _new_bucket() -> dict:
+    return {"n": 0, "users": {}, "terms": {}, "replied": {}}
+
+
+class DailyAggregator:
+    # Rolling per-chat statistics, kept in UTC hour buckets and updated on
+    # every logged message, so digests read a compact summary instead of
+    # re-scanning the day's log. Buckets older than `keep_hours` are dropped.
+    #
+    # bucket = {"n": messages, "users": {user: n}, "terms": {term: n},
+    #           "replied": {message_id: [replies, author, text]}}
+
+    def __init__(self, path: Path | None, keep_hours: int = 48):
+        self.path = path
+        self.keep_hours = keep_hours
+        self._chats: dict[str, dict[str, dict]] = {}
+        self._lock = threading.Lock()
+        if path is not None and path.exists():
+            try:
+                self._chats = json.loads(path.read_text(encoding="utf-8"))
+            except ValueError:
+                logger.warning("Ignoring unreadable aggregates file %s", path)
+
+    def _bucket(self, chat_id: int, ts: datetime) -> dict:
+        hours = self._chats.setdefault(str(chat_id), {})
+        key = _hour_key(ts)
+        bucket = hours.get(key)
+        if bucket is None:
+            bucket = hours[key] = _new_bucket()
+            cutoff = _hour_key(ts - timedelta(hours=self.keep_hours))
+            for old in [k for k in hours if k < cutoff]:
+                del hours[old]
+        return bucket
+
+    def add(self, chat_id: int, ts: datetime, user: str, text: str, reply_to: dict | None = None) -> None:
+        found = terms(text)
+        with self._lock:
+            bucket = self._bucket(chat_id, ts)
+            bucket["n"] += 1
+            users = bucket["users"]
+            users[user] = users.get(user, 0) + 1
+            counts = bucket["terms"]
+            for term in found:
+                counts[term] = counts.get(term, 0) + 1
+            if len(counts) > MAX_TERMS_PER_HOUR:
+                bucket["terms"] = dict(Counter(counts).most_common(KEEP_TERMS_PER_HOUR))
+            if reply_to and reply_to.get("id") is not None:
+                replied = bucket["replied"]
+                key = str(reply_to["id"])
+                entry = replied.get(key)
+                if entry is None:
+                    if len(replied) >= MAX_REPLIED_PER_HOUR:
+                        return
+                    entry = replied[key] = [0, reply_to.get("user") or "?", (reply_to.get("text") or "")[:300]]
+                entry[0] += 1
+
+    def has(self, chat_id: int) -> bool:
+        return bool(self._chats.get(str(chat_id)))
+
+    def snapshot(
+        self, chat_id: int, hours: int = 24, now: datetime | None = None, tz: tzinfo = timezone.utc,
+    ) -> dict:
+        now = now or datetime.now(timezone.utc)
+        since = _hour_key(now - timedelta(hours=hours - 1))
+        total = 0
+        users: Counter = Counter()
+        found: Counter = Counter()
+        active: Counter = Counter()
+        replied: dict[str, list] = {}
+        with self._lock:
+            for key, bucket in self._chats.get(str(chat_id), {}).items():
+                if key < since:
+                    continue
+                total += bucket["n"]
+                users.update(bucket["users"])
+                found.update(bucket["terms"])
+                hour = datetime.strptime(key, "%Y-%m-%dT%H").replace(tzinfo=timezone.utc).astimezone(tz).hour
+                active[hour] += bucket["n"]
+                for msg_id, (count, author, text) in bucket["replied"].items():
+                    entry = replied.setdefault(msg_id, [0, author, text])
+                    entry[0] += count
+        words = [(t, n) for t, n in found.most_common() if " " not in t]
+        pairs = [(t, n) for t, n in found.most_common() if " " in t and n > 1]
+        return {
+            "messages": total,
+            "users": users.most_common(10),
+            "active_hours": sorted(active.most_common(3)),
+            "terms": words[:20],
+            "phrases": pairs[:10],
+            "replied": sorted(replied.values(), key=lambda e: e[0], reverse=True)[:5],
+        }
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        # Copy under the lock down to the dicts add() grows, and serialize
+        # outside it, so add() on the event loop never waits for json.dumps.
+        with self._lock:
+            chats = {
+                chat: {key: {**bucket, **{k: dict(bucket[k]) for k in _GROWING}} for key, bucket in hours.items()}
+                for chat, hours in self._chats.items()
+            }
+        data = json.dumps(chats, ensure_ascii=False)
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+def format_stats(stats: dict) -> str:
+    # Compact prompt block; only sections with data are included.
+    lines = [f"Сообщений за сутки: {stats['messages']}"]
+    if stats["users"]:
+        lines.append("Самые активные: " + ", ".join(f"{u} ({n})" for u, n in stats["users"]))
+    if stats["active_hours"]:
+        lines.append("Пиковые часы: " + ", ".join(f"{h:02d}:00 ({n})" for h, n in stats["active_hours"]))
+    if stats["terms"]:
+        lines.append("Частые слова: " + ", ".join(f"{t} ({n})" for t, n in stats["terms"]))
+    if stats["phrases"]:
+        lines.append("Частые связки: " + ", ".join(f"{t} ({n})" for t, n in stats["phrases"]))
+    if stats["replied"]:
+        lines.append("Больше всего ответов собрали:")
+        lines.extend(f"- {author}: {text} ({n} отв.)" for n, author, text in stats["replied"])
+    return "\n".join(lines)
@@ -1,29 +1,118 @@
 import asyncio
 import logging
+import signal
+import time
+from contextlib import aclosing
 from datetime import datetime
 from zoneinfo import ZoneInfo
 
+from aiohttp import web
 from aiogram import Bot, Dispatcher, F
-from aiogram.enums import ChatType
-from aiogram.filters import Command
+from aiogram.enums import ChatMemberStatus, ChatType
+from aiogram.exceptions import TelegramBadRequest, TelegramRetryAfter
+from aiogram.filters import Command, CommandObject
 from aiogram.types import (
     Message, InlineKeyboardMarkup, InlineKeyboardButton, CallbackQuery,
     ChatMemberUpdated,
 )
-from apscheduler.schedulers.asyncio import AsyncIOScheduler
 
-from storage import bind_chat, is_bound, log_message, load_chats, read_last_24h, read_last_n
+from storage import (
+    DATA, chat_stats, close_storage, log_message, log_writer_stats, load_chats, migrate_legacy_log, maintain_log,
+    read_last_24h, rebuild_aggregates, rebuild_search_index, save_aggregates, search_history, warm_recent_cache,
+)
+from cache import ResponseCache, normalize_query
 from comet import CometClient
+from aggregate import format_stats
+from context import AnchoredWindow, RollingSummaries, build_context, pack_recent
+from chat_settings import SETTINGS_HELP, describe_settings, parse_settings, resolve_settings
+from prompts import (
+    DAILY_DIGEST, FIND, NAX, REPLY, SUMMARY_SYSTEM, SUMMARY_UPDATE, WEB_DIGEST, section, system_prompt,
+)
+from jobs import DigestLedger, make_scheduler, sync_digest_jobs
+from search_index import format_hits
+from rows import Row
+from state import make_state
+from fastpath import FastPathMiddleware
+from throttle import ThrottleMiddleware
+from webhook import build_webhook_app
+from limits import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, RequestScheduler, SendLimiter
+from metrics import (
+    HANDLER_SECONDS, JOB_CHATS, JOB_SECONDS, REGISTRY, HandlerMetricsMiddleware, add_metrics_route,
+    start_metrics_server, timed_async,
+)
 from config import (
     BOT_TOKEN,
     COMET_API_TOKEN,
     COMET_MODEL,
+    COMET_BASE_URL,
+    COMET_HTTP2,
+    COMET_MAX_CONNECTIONS,
+    COMET_MAX_KEEPALIVE,
+    COMET_KEEPALIVE_EXPIRY,
+    COMET_CONNECT_TIMEOUT,
+    COMET_CHAT_TIMEOUT,
+    COMET_SEARCH_TIMEOUT,
+    COMET_MAX_CONCURRENCY,
+    COMET_RATE_PER_SECOND,
+    COMET_RATE_BURST,
+    COMET_QUEUE_TIMEOUT,
+    COMET_DIGEST_QUEUE_TIMEOUT,
+    COMET_MAX_RETRIES,
+    COMET_PROMPT_CACHE_KEY,
+    COMET_FALLBACKS,
+    COMET_BREAKER_FAILURES,
+    COMET_BREAKER_COOLDOWN,
+    COMET_HEDGE,
+    COMET_HEDGE_QUANTILE,
+    COMET_HEDGE_MIN_DELAY,
     TZ as TZ_NAME,
     ALLOWED_CHAT_IDS,
+    BOT_MODE,
+    WEBHOOK_URL,
+    WEBHOOK_PATH,
+    WEBHOOK_SECRET,
+    WEBHOOK_HOST,
+    WEBHOOK_PORT,
+    WEBHOOK_MAX_TASKS,
+    WEBHOOK_DRAIN_SECONDS,
+    THROTTLE_ENABLED,
+    THROTTLE_LIMITS,
+    THROTTLE_NOTICE_SECONDS,
+    THROTTLE_MAX_LLM_QUEUE,
+    STATE_BACKEND,
+    REDIS_URL,
+    STATE_PREFIX,
+    RECENT_CACHE_DEPTH,
     BOT_COOLDOWN_SECONDS,
-    HUMOR_MODE,
     WEB_DIGEST_HOUR,
     WEB_DIGEST_MINUTE,
+    DIGEST_CONCURRENCY,
+    DIGEST_CHAT_TIMEOUT,
+    DIGEST_SPREAD_MINUTES,
+    DIGEST_MISFIRE_GRACE_MINUTES,
+    SCHEDULER_JOBSTORE,
+    SCHEDULER_DB,
+    TG_SEND_PER_SECOND,
+    TG_CHAT_SEND_INTERVAL,
+    STREAM_REPLIES,
+    STREAM_EDIT_INTERVAL,
+    FIND_CACHE_TTL,
+    FIND_CACHE_SIZE,
+    FIND_CACHE_PERSIST,
+    CONTEXT_TOKEN_BUDGET,
+    DIGEST_TOKEN_BUDGET,
+    SUMMARY_CHUNK_TOKENS,
+    SUMMARY_REFRESH_MINUTES,
+    SEARCH_CONTEXT_TOP_K,
+    SEARCH_RECALL_TOP_K,
+    SEARCH_BUDGET_MS,
+    METRICS_HOST,
+    METRICS_PORT,
+    METRICS_LOG_MINUTES,
+    LOG_COMPRESS_AFTER_DAYS,
+    LOG_RETENTION_DAYS,
+    LOG_RETENTION_BY_CHAT,
+    LOG_MAINTENANCE_HOUR,
 )
 
 TZ = ZoneInfo(TZ_NAME)
@@ -39,22 +128,81 @@ logger = logging.getLogger("porfiriy")
 
 bot = Bot(BOT_TOKEN)
 dp = Dispatcher()
-comet = CometClient(COMET_API_TOKEN, model=COMET_MODEL)
-
-MODE_PROMPTS = {
-    "soft": "Лёгкий сарказм, больше иронии, меньше жести.",
-    "hard": "Черный юмор, цинизм, жёсткие панчи, но без травли по защищённым признакам.",
-    "insane": "Максимально безумный стендап-режим, абсурд и огонь, но без запрещёнки.",
-}
-
-SYSTEM_PROMPT = (
-    "Ты Порфирий — комик-циник для закрытого чата. "
-    f"Режим: {MODE_PROMPTS.get(HUMOR_MODE, MODE_PROMPTS['hard'])} "
-    "Пиши кратко, дерзко, смешно. Никаких призывов к насилию, экстремизму, доксингу."
+dp.message.middleware(HandlerMetricsMiddleware())
+dp.callback_query.middleware(HandlerMetricsMiddleware())
+dp.my_chat_member.middleware(HandlerMetricsMiddleware())
+llm_scheduler = RequestScheduler(
+    COMET_MAX_CONCURRENCY,
+    COMET_RATE_PER_SECOND,
+    COMET_RATE_BURST,
+    {PRIORITY_INTERACTIVE: COMET_QUEUE_TIMEOUT, PRIORITY_BACKGROUND: COMET_DIGEST_QUEUE_TIMEOUT},
+)
+comet = CometClient(
+    COMET_API_TOKEN,
+    model=COMET_MODEL,
+    base_url=COMET_BASE_URL,
+    http2=COMET_HTTP2,
+    max_connections=COMET_MAX_CONNECTIONS,
+    max_keepalive=COMET_MAX_KEEPALIVE,
+    keepalive_expiry=COMET_KEEPALIVE_EXPIRY,
+    connect_timeout=COMET_CONNECT_TIMEOUT,
+    chat_timeout=COMET_CHAT_TIMEOUT,
+    search_timeout=COMET_SEARCH_TIMEOUT,
+    scheduler=llm_scheduler,
+    max_retries=COMET_MAX_RETRIES,
+    prompt_cache_key=COMET_PROMPT_CACHE_KEY,
+    fallbacks=COMET_FALLBACKS,
+    breaker_failures=COMET_BREAKER_FAILURES,
+    breaker_cooldown=COMET_BREAKER_COOLDOWN,
+    hedge=COMET_HEDGE,
+    hedge_quantile=COMET_HEDGE_QUANTILE,
+    hedge_min_delay=COMET_HEDGE_MIN_DELAY,
+)
+state = make_state(STATE_BACKEND, REDIS_URL, STATE_PREFIX, RECENT_CACHE_DEPTH)
+# Registered first: the throttle reads the route it stores.
+dp.message.outer_middleware(FastPathMiddleware(state, lambda message: _log_group_message(message), ALLOWED_CHAT_IDS))
+if THROTTLE_ENABLED:
+    dp.message.outer_middleware(ThrottleMiddleware(
+        state,
+        THROTTLE_LIMITS,
+        THROTTLE_NOTICE_SECONDS,
+        ALLOWED_CHAT_IDS,
+        overloaded=lambda: (
+            THROTTLE_MAX_LLM_QUEUE > 0 and llm_scheduler.queued()["interactive"] >= THROTTLE_MAX_LLM_QUEUE
+        ),
+        on_rejected=lambda message: _log_group_message(message),
+    ))
+send_limiter = SendLimiter(TG_SEND_PER_SECOND, TG_CHAT_SEND_INTERVAL)
+find_cache = ResponseCache(
+    FIND_CACHE_TTL,
+    FIND_CACHE_SIZE,
+    DATA / "find_cache.json" if FIND_CACHE_PERSIST else None,
+)
+summaries = RollingSummaries(DATA / "summaries.json")
+context_window = AnchoredWindow()
+scheduler = make_scheduler(TZ, SCHEDULER_JOBSTORE, SCHEDULER_DB, DIGEST_MISFIRE_GRACE_MINUTES * 60)
+ledger = DigestLedger(DATA / "digests.json")
+
+REGISTRY.gauge(
+    "porfiriy_find_cache",
+    "/find answer cache counters",
+    lambda: [({"stat": k}, v) for k, v in find_cache.stats().items()],
+)
+REGISTRY.gauge(
+    "porfiriy_llm_scheduler",
+    "CometAPI request scheduler: in flight, queued per priority, totals",
+    lambda: [({"stat": k}, v) for k, v in llm_scheduler.stats().items()],
+)
+REGISTRY.gauge(
+    "porfiriy_llm_upstream",
+    "CometAPI upstreams: breaker open, consecutive failures, times opened",
+    comet.upstream_stats,
+)
+REGISTRY.gauge(
+    "porfiriy_context_window",
+    "recent-message blocks that extended the previous prompt's block vs started over",
+    lambda: [({"stat": "extended"}, context_window.extended), ({"stat": "restarted"}, context_window.restarted)],
 )
-
-LAST_CALL: dict[int, float] = {}
-
 
 # ---------------------------------------------------------------------------
 # Личка — команды
@@ -100,7 +248,7 @@ async def on_my_chat_member(event: ChatMemberUpdated):
         if ALLOWED_CHAT_IDS and chat.id not in ALLOWED_CHAT_IDS:
             logger.warning("my_chat_member: chat %s not in ALLOWED_CHAT_IDS, skip", chat.id)
             return
-        bind_chat(chat.id, chat.title)
+        await state.bind_chat(chat.id, chat.title)
         logger.info("Auto-bound chat %s (%s) via my_chat_member", chat.id, chat.title)
         try:
             await bot.send_message(
@@ -125,7 +273,7 @@ async def cmd_bind_in_group(message: Message):
         logger.warning("cmd_bind_in_group: chat %s not in ALLOWED_CHAT_IDS", chat.id)
         await message.reply("Этот чат не в списке разрешённых.")
         return
-    bind_chat(chat.id, chat.title)
+    await state.bind_chat(chat.id, chat.title)
     await message.reply(f"Привязан. chat_id={chat.id}. Зови через /nax.")
 
 
@@ -134,7 +282,7 @@ async def cmd_bind_in_group(message: Message):
 # ---------------------------------------------------------------------------
 
 async def _bind_chat_from_forward(message: Message, chat_id: int, title: str | None):
-    bind_chat(chat_id, title)
+    await state.bind_chat(chat_id, title)
     logger.info("Chat bound via forward: %s (%s)", title, chat_id)
     await message.answer(f"Готово. Привязал чат: {title or chat_id} ({chat_id})")
 
@@ -209,16 +357,58 @@ async def private_fallback(message: Message):
 
 
 # ---------------------------------------------------------------------------
-# Ручной веб-поиск
+# Потоковые ответы: заглушка + редактирование по мере генерации
 # ---------------------------------------------------------------------------
 
-def _is_find_command(text: str) -> bool:
-    if not text:
-        return False
-    first = text.split(maxsplit=1)[0].lower()
-    return first == "/find" or first.startswith("/find@")
+async def _edit_reply(placeholder: Message, text: str, **kwargs) -> float:
+    # Returns how long to back off before the next edit.
+    try:
+        await placeholder.edit_text(text, **kwargs)
+    except TelegramRetryAfter as e:
+        return float(e.retry_after)
+    except TelegramBadRequest as e:
+        if "message is not modified" not in str(e):
+            raise
+    return 0.0
+
+
+async def _stream_reply(message: Message, chunks, fail_text: str, limit: int = 4000, **kwargs) -> str | None:
+    placeholder = await message.reply("…", **kwargs)
+    text = ""
+    shown = ""
+    next_edit_at = 0.0
+    try:
+        async with aclosing(chunks):
+            async for chunk in chunks:
+                text += chunk
+                now = time.monotonic()
+                visible = text[:limit]
+                if now >= next_edit_at and visible.strip() and visible != shown:
+                    backoff = await _edit_reply(placeholder, visible, **kwargs)
+                    if not backoff:
+                        shown = visible
+                    next_edit_at = time.monotonic() + max(STREAM_EDIT_INTERVAL, backoff)
+        if not text.strip():
+            raise RuntimeError("empty answer")
+    except Exception as e:
+        logger.exception("streamed reply failed in chat %s", message.chat.id)
+        await _edit_reply(placeholder, f"{fail_text}: {e}")
+        return None
 
+    visible = text[:limit]
+    while visible != shown:
+        backoff = await _edit_reply(placeholder, visible, **kwargs)
+        if not backoff:
+            break
+        await asyncio.sleep(backoff)
+    return text
 
+
+# ---------------------------------------------------------------------------
+# Ручной веб-поиск
+# ---------------------------------------------------------------------------
+
+@timed_async(HANDLER_SECONDS, handler="find")
 async def _handle_find(message: Message):
     started_at = datetime.now().timestamp()
     logger.info(
@@ -233,7 +423,7 @@ async def _handle_find(message: Message):
             logger.warning("cmd_find.blocked reason=not_allowed chat=%s", message.chat.id)
             await message.reply("Этот чат не в списке разрешённых для /find.")
             return
-        if not is_bound(message.chat.id):
+        if not await state.is_bound(message.chat.id):
             logger.warning("cmd_find.blocked reason=not_bound chat=%s", message.chat.id)
             await message.reply("Сначала привяжи чат: /bind")
             return
@@ -250,31 +440,43 @@ async def _handle_find(message: Message):
         return
     logger.info("cmd_find.query_ready chat=%s query=%r", message.chat.id, query[:200])
 
-    prompt = (
-        "Ты Порфирий, циничный, но полезный чат-аналитик. "
-        f"Сделай веб-поиск по запросу: {query}\n\n"
-        "Верни ответ на русском в формате:\n"
-        "1) Короткий итог (2-4 предложения)\n"
-        "2) Что важно сейчас (3-5 пунктов)\n"
-        "3) Источники (3-5 ссылок)\n"
-        "4) Одна короткая безумная шутка в стиле Порфирия"
-    )
+    prompt = FIND.render(query=query)
+    streamed = False
+
+    async def fetch() -> str:
+        nonlocal streamed
+        if not STREAM_REPLIES:
+            return await comet.web_search(prompt)
+        streamed = True
+        result = await _stream_reply(
+            message, comet.web_search_stream(prompt), "Поиск сломался", disable_web_page_preview=True,
+        )
+        if result is None:
+            raise RuntimeError("streamed search failed")
+        return result
+
     try:
-        logger.info("cmd_find.search_start chat=%s", message.chat.id)
-        result = await comet.web_search(prompt)
+        logger.info("cmd_find.search_start chat=%s stream=%s", message.chat.id, STREAM_REPLIES)
+        result, fetched = await find_cache.get_or_fetch(normalize_query(query), fetch)
         elapsed_ms = int((datetime.now().timestamp() - started_at) * 1000)
         logger.info(
-            "cmd_find.search_ok chat=%s result_len=%s elapsed_ms=%s",
+            "cmd_find.search_ok chat=%s result_len=%s elapsed_ms=%s cache=%s",
             message.chat.id,
             len(result),
             elapsed_ms,
+            "miss" if fetched else "hit",
         )
+        if streamed:
+            return
         await message.reply(result[:4000], disable_web_page_preview=True)
         logger.info("cmd_find.reply_sent chat=%s reply_len=%s", message.chat.id, min(len(result), 4000))
     except Exception as e:
         elapsed_ms = int((datetime.now().timestamp() - started_at) * 1000)
-        logger.exception("cmd_find failed in chat %s", message.chat.id)
         logger.error("cmd_find.search_fail chat=%s elapsed_ms=%s error=%r", message.chat.id, elapsed_ms, e)
+        if streamed:
+            # The placeholder already shows the error.
+            return
+        logger.exception("cmd_find failed in chat %s", message.chat.id)
         await message.reply(f"Поиск сломался: {e}")
 
 
@@ -284,68 +486,155 @@ async def cmd_find(message: Message):
     await _handle_find(message)
 
 
+# ---------------------------------------------------------------------------
+# Поиск по истории чата — /recall
+# ---------------------------------------------------------------------------
+
+async def _handle_recall(message: Message, before: str | None) -> None:
+    # Answered from the local index only, so it is not throttled like /find.
+    text = message.text or message.caption or ""
+    parts = text.split(maxsplit=1)
+    query = parts[1].strip() if len(parts) > 1 else ""
+    if not query and message.reply_to_message:
+        query = (message.reply_to_message.text or message.reply_to_message.caption or "").strip()
+    if not query:
+        await message.reply("Используй: /recall <запрос> или реплай на сообщение с /recall")
+        return
+    hits = search_history(message.chat.id, query, SEARCH_RECALL_TOP_K, SEARCH_BUDGET_MS, before)
+    if not hits:
+        await message.reply("Ничего похожего в истории чата не нашёл.")
+        return
+    await message.reply(("Из истории чата:\n" + "\n".join(format_hits(hits, TZ)))[:4000])
+
+
+# ---------------------------------------------------------------------------
+# Настройки чата — /settings
+# ---------------------------------------------------------------------------
+
+async def _is_chat_admin(message: Message) -> bool:
+    # Anonymous admins post on behalf of the chat itself.
+    if message.sender_chat is not None:
+        return message.sender_chat.id == message.chat.id
+    if message.from_user is None:
+        return False
+    member = await bot.get_chat_member(message.chat.id, message.from_user.id)
+    return member.status in {ChatMemberStatus.CREATOR, ChatMemberStatus.ADMINISTRATOR}
+
+
+@dp.message(Command("settings"), F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
+async def cmd_settings(message: Message, command: CommandObject):
+    if ALLOWED_CHAT_IDS and message.chat.id not in ALLOWED_CHAT_IDS:
+        return
+    if not await state.is_bound(message.chat.id):
+        return
+    args = (command.args or "").split()
+    if not args:
+        settings = resolve_settings(await state.chat_settings(message.chat.id))
+        await message.reply(describe_settings(settings) + "\n\n" + SETTINGS_HELP)
+        return
+    if not await _is_chat_admin(message):
+        await message.reply("Менять настройки могут только админы чата.")
+        return
+    try:
+        changes = parse_settings(args)
+    except ValueError as e:
+        await message.reply(str(e))
+        return
+    stored = await state.update_chat_settings(message.chat.id, changes)
+    logger.info("Chat %s settings: %s", message.chat.id, stored)
+    await message.reply("Сохранил.\n" + describe_settings(resolve_settings(stored)))
+
+
 # ---------------------------------------------------------------------------
 # Групповой слушатель — /nax и логирование
 # ---------------------------------------------------------------------------
 
+async def _log_group_message(message: Message) -> Row | None:
+    text = message.text or message.caption or ""
+    if not text:
+        return None
+    user = message.from_user.full_name if message.from_user else "unknown"
+    reply = message.reply_to_message
+    reply_to = None
+    if reply is not None:
+        reply_to = {
+            "id": reply.message_id,
+            "user": reply.from_user.full_name if reply.from_user else "unknown",
+            "text": reply.text or reply.caption or "",
+        }
+    row = log_message(message.chat.id, user, text, reply_to)
+    await state.push_recent(message.chat.id, row)
+    return row
+
+
 @dp.message(F.chat.type.in_({ChatType.GROUP, ChatType.SUPERGROUP}))
-async def group_listener(message: Message):
+async def group_listener(message: Message, route: str = "plain"):
+    # Plain chatter is logged by FastPathMiddleware and never gets here.
     if ALLOWED_CHAT_IDS and message.chat.id not in ALLOWED_CHAT_IDS:
         return
-    if not is_bound(message.chat.id):
+    if not await state.is_bound(message.chat.id):
         return
 
     text = message.text or message.caption or ""
-    if text:
-        user = message.from_user.full_name if message.from_user else "unknown"
-        log_message(message.chat.id, user, text)
+    row = await _log_group_message(message)
 
-    if _is_find_command(text):
+    if route == "find":
         await _handle_find(message)
         return
+    if route == "recall":
+        await _handle_recall(message, row["ts"] if row else None)
+        return
 
-    is_nax = text.startswith("/nax")
-    is_reply_to_bot = (
-        message.reply_to_message is not None
-        and message.reply_to_message.from_user is not None
-        and message.reply_to_message.from_user.id == bot.id
-        and bool(text)
-    )
-
+    is_nax = route == "nax"
+    is_reply_to_bot = route == "reply"
     if not is_nax and not is_reply_to_bot:
         return
 
-    now_ts = datetime.now().timestamp()
-    last = LAST_CALL.get(message.chat.id, 0)
-    if now_ts - last < BOT_COOLDOWN_SECONDS:
-        wait_s = int(BOT_COOLDOWN_SECONDS - (now_ts - last))
-        logger.info("Cooldown hit in chat %s, wait=%ss", message.chat.id, wait_s)
-        await message.reply(f"Остынь. Следующий вызов через {wait_s} сек.")
-        return
-    LAST_CALL[message.chat.id] = now_ts
+    if not THROTTLE_ENABLED:
+        # Without the throttle middleware the plain per-chat cooldown applies.
+        left = await state.cooldown(f"chat:{message.chat.id}", BOT_COOLDOWN_SECONDS)
+        if left > 0:
+            wait_s = max(1, int(left))
+            logger.info("Cooldown hit in chat %s, wait=%ss", message.chat.id, wait_s)
+            await message.reply(f"Остынь. Следующий вызов через {wait_s} сек.")
+            return
 
-    recent = read_last_n(message.chat.id, n=10)
-    context_block = ""
-    if recent:
-        lines = "\n".join(f"  {r['user']}: {r['text']}" for r in recent)
-        context_block = f"Последние сообщения в чате:\n{lines}\n\n"
+    settings = resolve_settings(await state.chat_settings(message.chat.id))
+    depth = settings["context"]
+    recent = await state.recent(message.chat.id, 2 * depth)
+    recent_block = section(
+        "Последние сообщения в чате", context_window.lines(message.chat.id, recent, depth, CONTEXT_TOKEN_BUDGET),
+    )
 
     if is_nax:
-        target = text.replace("/nax", "", 1).strip()
+        parts = text.split(maxsplit=1)
+        target = parts[1].strip() if len(parts) > 1 else ""
         if not target and message.reply_to_message:
             target = message.reply_to_message.text or message.reply_to_message.caption or ""
         if not target:
             await message.reply("Дай текст после /nax или ответь реплаем на сообщение.")
             return
-        prompt = f"{context_block}Сообщение из чата:\n{target}\n\nОтветь в стиле Порфирия."
     else:
-        bot_msg = message.reply_to_message.text or message.reply_to_message.caption or ""
-        prompt = (
-            f"{context_block}"
-            f"Предыдущее сообщение Порфирия:\n{bot_msg}\n\n"
-            f"Пользователь отвечает:\n{text}\n\n"
-            "Продолжи в стиле Порфирия."
+        target = text
+
+    related_block = ""
+    if SEARCH_CONTEXT_TOP_K > 0:
+        # Older messages on the same topic; ones already in the recent block are skipped.
+        seen = {r["ts"] for r in recent}
+        hits = search_history(
+            message.chat.id, target, SEARCH_CONTEXT_TOP_K + len(seen), SEARCH_BUDGET_MS, row["ts"] if row else None,
         )
+        hits = [h for h in hits if h["ts"] not in seen][:SEARCH_CONTEXT_TOP_K]
+        related_block = section("Раньше в чате на эту тему", format_hits(hits, TZ))
+
+    # Append-only recent block first, per-request parts last: see AnchoredWindow.
+    if is_nax:
+        prompt = NAX.render(recent=recent_block, related=related_block, target=target)
+    else:
+        bot_msg = message.reply_to_message.text or message.reply_to_message.caption or ""
+        prompt = REPLY.render(recent=recent_block, related=related_block, bot_message=bot_msg, text=text)
+    system = system_prompt(settings["humor"])
+    cache_key = f"chat:{message.chat.id}"
 
     try:
         logger.info(
@@ -355,101 +644,351 @@ async def group_listener(message: Message):
             is_nax,
             is_reply_to_bot,
         )
-        answer = await comet.chat(SYSTEM_PROMPT, prompt)
+        if STREAM_REPLIES:
+            await _stream_reply(
+                message, comet.chat_stream(system, prompt, cache_key=cache_key), "Что-то пошло не так",
+            )
+            return
+        answer = await comet.chat(system, prompt, cache_key=cache_key)
         await message.reply(answer[:4000])
     except Exception as e:
         logger.exception("reply handler failed in chat %s", message.chat.id)
         await message.reply(f"Что-то пошло не так: {e}")
 
 
+# ---------------------------------------------------------------------------
+# Дайджесты: параллельный обход чатов
+# ---------------------------------------------------------------------------
+
+async def _send_limited(chat_id: int, text: str, **kwargs):
+    await send_limiter.wait(chat_id)
+    return await bot.send_message(chat_id, text, **kwargs)
+
+
+async def _digest_chat_ids() -> list[int]:
+    return [
+        int(cid_str) for cid_str in await state.chats()
+        if not ALLOWED_CHAT_IDS or int(cid_str) in ALLOWED_CHAT_IDS
+    ]
+
+
+async def _run_chat_job(job: str, per_chat, cid: int) -> tuple[str, int]:
+    started = time.perf_counter()
+    try:
+        status = await asyncio.wait_for(per_chat(cid), DIGEST_CHAT_TIMEOUT)
+    except asyncio.TimeoutError:
+        status = "timeout"
+        logger.error("%s timed out for chat %s after %ss", job, cid, DIGEST_CHAT_TIMEOUT)
+    except Exception:
+        status = "error"
+        logger.exception("%s crashed for chat %s", job, cid)
+    elapsed_ms = int((time.perf_counter() - started) * 1000)
+    JOB_CHATS.inc(job=job, status=status)
+    logger.info("%s.chat_done chat=%s status=%s elapsed_ms=%s", job, cid, status, elapsed_ms)
+    return status, elapsed_ms
+
+
+async def _run_digest_job(job: str, per_chat) -> None:
+    # Every chat at once; used for the summaries refresh.
+    chat_ids = await _digest_chat_ids()
+    sem = asyncio.Semaphore(max(1, DIGEST_CONCURRENCY))
+    timings: dict[int, tuple[str, int]] = {}
+
+    async def run_one(cid: int) -> None:
+        async with sem:
+            timings[cid] = await _run_chat_job(job, per_chat, cid)
+
+    started = time.perf_counter()
+    with JOB_SECONDS.time(job=job):
+        await asyncio.gather(*(run_one(cid) for cid in chat_ids))
+    slowest = max((ms for _, ms in timings.values()), default=0)
+    logger.info(
+        "%s.done chats=%s sent=%s wall_ms=%s slowest_chat_ms=%s",
+        job,
+        len(chat_ids),
+        sum(1 for status, _ in timings.values() if status == "sent"),
+        int((time.perf_counter() - started) * 1000),
+        slowest,
+    )
+
+
+# ---------------------------------------------------------------------------
+# Контекст дайджестов: бюджет токенов + скользящее саммари
+# ---------------------------------------------------------------------------
+
+async def _summarize_chunk(previous: str, lines: list[str]) -> str:
+    prompt = SUMMARY_UPDATE.render(previous=section("Текущее краткое содержание", previous), lines="\n".join(lines))
+    text = await comet.chat(SUMMARY_SYSTEM, prompt, priority=PRIORITY_BACKGROUND)
+    return text.strip()[:3000]
+
+
+async def _digest_context(cid: int, rows: list[Row]) -> str:
+    try:
+        return await build_context(cid, rows, DIGEST_TOKEN_BUDGET, summaries, _summarize_chunk, SUMMARY_CHUNK_TOKENS)
+    except Exception:
+        logger.exception("Rolling summary failed for chat %s, using recent messages only", cid)
+        lines, _ = pack_recent(rows, DIGEST_TOKEN_BUDGET)
+        return "\n".join(lines)
+
+
+async def _refresh_summary_chat(cid: int) -> str:
+    rows = await asyncio.to_thread(read_last_24h, cid)
+    if not rows:
+        return "empty"
+    await _digest_context(cid, rows)
+    return "updated"
+
+
+async def refresh_summaries():
+    await _run_digest_job("refresh_summaries", _refresh_summary_chat)
+
+
 # ---------------------------------------------------------------------------
 # Ежедневный дайджест
 # ---------------------------------------------------------------------------
 
-async def daily_digest():
-    chats = load_chats()
-    for cid_str, meta in chats.items():
-        cid = int(cid_str)
-        if ALLOWED_CHAT_IDS and cid not in ALLOWED_CHAT_IDS:
-            continue
-        rows = read_last_24h(cid)
-        if not rows:
-            continue
-        sample = "\n".join([f"- {r['user']}: {r['text']}" for r in rows[-200:]])
-        prompt = (
-            "Сделай дневной разбор чата: ключевые темы, кто как себя ведет, "
-            "смешные и циничные комментарии по личностям участников. "
-            "Формат: 1) Итоги дня 2) Портреты персонажей 3) Прогноз на завтра.\n\n"
-            f"Лог за сутки:\n{sample}"
+async def _daily_digest_chat(cid: int) -> str:
+    rows = await asyncio.to_thread(read_last_24h, cid)
+    if not rows:
+        return "empty"
+    sample = await _digest_context(cid, rows)
+    prompt = DAILY_DIGEST.render(stats=format_stats(chat_stats(cid, 24, TZ)), log=sample)
+    settings = resolve_settings(await state.chat_settings(cid))
+    try:
+        logger.info("Daily digest for chat %s (%s messages)", cid, len(rows))
+        text = await comet.chat(
+            system_prompt(settings["humor"]), prompt, priority=PRIORITY_BACKGROUND, cache_key=f"chat:{cid}",
         )
-        try:
-            logger.info("Daily digest for chat %s (%s messages)", cid, len(rows))
-            text = await comet.chat(SYSTEM_PROMPT, prompt)
-            await bot.send_message(cid, f"🕕 Дневной разбор Порфирия\n\n{text[:3900]}")
-        except Exception as e:
-            logger.exception("Daily digest failed for chat %s", cid)
-            await bot.send_message(cid, f"Не смог собрать разбор: {e}")
+        await _send_limited(cid, f"🕕 Дневной разбор Порфирия\n\n{text[:3900]}")
+        return "sent"
+    except Exception as e:
+        logger.exception("Daily digest failed for chat %s", cid)
+        await _send_limited(cid, f"Не смог собрать разбор: {e}")
+        return "failed"
 
 
 # ---------------------------------------------------------------------------
 # Веб-дайджест горячих тем в 12:00
 # ---------------------------------------------------------------------------
 
-async def daily_web_themes_digest():
-    chats = load_chats()
-    for cid_str, meta in chats.items():
-        cid = int(cid_str)
-        if ALLOWED_CHAT_IDS and cid not in ALLOWED_CHAT_IDS:
-            continue
-
-        rows = read_last_24h(cid)
-        if not rows:
-            continue
-
-        sample = "\n".join([f"- {r['user']}: {r['text']}" for r in rows[-250:]])
-        prompt = (
-            "Ты Порфирий. У тебя есть лог чата за 24 часа. "
-            "Выдели 3-5 самых горячих тем от пользователей, затем выполни веб-поиск "
-            "по каждой теме и сделай сумасшедший смешной дайджест.\n\n"
-            "Требования к ответу:\n"
-            "- На русском.\n"
-            "- Коротко и ярко.\n"
-            "- Для каждой темы: что обсуждали в чате + что происходит в интернете прямо сейчас.\n"
-            "- В конце: блок источников с 5-8 ссылками.\n"
-            "- Без токсичности по защищённым признакам.\n\n"
-            f"Лог чата за сутки:\n{sample}"
+async def _web_themes_digest_chat(cid: int) -> str:
+    # Hot topics come from the precomputed aggregates; only a short tail of
+    # recent messages is added for context, so no 24h read is needed.
+    stats = chat_stats(cid, 24, TZ)
+    if not stats["messages"]:
+        return "empty"
+    recent = await state.recent(cid, 40)
+    lines, _ = pack_recent(recent, CONTEXT_TOKEN_BUDGET)
+    prompt = WEB_DIGEST.render(stats=format_stats(stats), recent="\n".join(lines))
+    try:
+        logger.info("Web themes digest for chat %s (%s messages)", cid, stats["messages"])
+        text = await comet.web_search(prompt, priority=PRIORITY_BACKGROUND)
+        await _send_limited(
+            cid,
+            f"🔥 Горячие темы дня + веб-разнос от Порфирия\n\n{text[:3900]}",
+            disable_web_page_preview=True,
         )
-        try:
-            logger.info("Web themes digest for chat %s (%s messages)", cid, len(rows))
-            text = await comet.web_search(prompt)
-            await bot.send_message(
-                cid,
-                f"🔥 Горячие темы дня + веб-разнос от Порфирия\n\n{text[:3900]}",
-                disable_web_page_preview=True,
-            )
-        except Exception as e:
-            logger.exception("Web digest failed for chat %s", cid)
-            await bot.send_message(cid, f"Не смог сделать веб-дайджест: {e}")
+        return "sent"
+    except Exception as e:
+        logger.exception("Web digest failed for chat %s", cid)
+        await _send_limited(cid, f"Не смог сделать веб-дайджест: {e}")
+        return "failed"
+
+
+# ---------------------------------------------------------------------------
+# Расписание дайджестов по чатам
+# ---------------------------------------------------------------------------
+
+DIGESTS = {"daily_digest": _daily_digest_chat, "web_themes_digest": _web_themes_digest_chat}
+# /settings switch that turns each digest off for a chat.
+DIGEST_SETTINGS = {"daily_digest": "daily", "web_themes_digest": "web"}
+DIGEST_TIMES = {"daily_digest": (18, 0), "web_themes_digest": (WEB_DIGEST_HOUR, WEB_DIGEST_MINUTE)}
+_digest_slots = asyncio.Semaphore(max(1, DIGEST_CONCURRENCY))
+_digests_running: set[tuple[str, int]] = set()
+
+
+async def run_chat_digest(job: str, cid: int) -> None:
+    # Target of the per-chat jobs in the persistent store: keep the name and
+    # signature stable, stored jobs refer to them.
+    period = datetime.now(TZ).date().isoformat()
+    if ledger.done(job, cid, period) or (job, cid) in _digests_running:
+        JOB_CHATS.inc(job=job, status="skipped")
+        logger.info("%s.skipped chat=%s period=%s (already done or running)", job, cid, period)
+        return
+    if cid not in await _digest_chat_ids():
+        return
+    if not resolve_settings(await state.chat_settings(cid))[DIGEST_SETTINGS[job]]:
+        JOB_CHATS.inc(job=job, status="disabled")
+        return
+    _digests_running.add((job, cid))
+    try:
+        ledger.start(job, cid, period)
+        async with _digest_slots:
+            with JOB_SECONDS.time(job=job):
+                status, _ = await _run_chat_job(job, DIGESTS[job], cid)
+        # Failures are final too: the chat already got the error reply, and a
+        # restart the same day must not post the digest after it.
+        ledger.finish(job, cid, period, status)
+    finally:
+        _digests_running.discard((job, cid))
+
+
+async def sync_chat_digests() -> None:
+    stats = sync_digest_jobs(scheduler, run_chat_digest, DIGEST_TIMES, await _digest_chat_ids(), DIGEST_SPREAD_MINUTES)
+    if stats["added"] or stats["removed"]:
+        logger.info("Digest jobs synced: %s", stats)
+
+
+def _catch_up_digests() -> int:
+    # Digests cut off by a restart: started today, never finished.
+    period = datetime.now(TZ).date().isoformat()
+    pending = [(job, cid) for job, cid in ledger.interrupted(period) if job in DIGESTS]
+    for job, cid in pending:
+        scheduler.add_job(run_chat_digest, args=(job, cid), id=f"catch_up:{job}:{cid}", replace_existing=True)
+    return len(pending)
+
+
+# ---------------------------------------------------------------------------
+# Обслуживание лога сообщений
+# ---------------------------------------------------------------------------
+
+async def log_maintenance():
+    started = time.perf_counter()
+    with JOB_SECONDS.time(job="log_maintenance"):
+        stats = await asyncio.to_thread(
+            maintain_log, LOG_COMPRESS_AFTER_DAYS, LOG_RETENTION_DAYS, LOG_RETENTION_BY_CHAT,
+        )
+    logger.info(
+        "log_maintenance.done compressed=%s deleted=%s bytes_before=%s bytes_after=%s elapsed_ms=%s",
+        stats["compressed"],
+        stats["deleted"],
+        stats["bytes_before"],
+        stats["bytes_after"],
+        int((time.perf_counter() - started) * 1000),
+    )
+
+
+async def persist_aggregates():
+    await asyncio.to_thread(save_aggregates)
+
+
+# ---------------------------------------------------------------------------
+# Метрики
+# ---------------------------------------------------------------------------
+
+async def log_metrics_summary():
+    logger.info("Metrics summary:\n%s", REGISTRY.summary())
 
 
 # ---------------------------------------------------------------------------
 # Запуск
 # ---------------------------------------------------------------------------
 
+ALLOWED_UPDATES = ["message", "callback_query", "my_chat_member"]
+
+
+async def _run_polling() -> None:
+    # getUpdates is refused while a webhook is registered.
+    await bot.delete_webhook()
+    await dp.start_polling(bot, allowed_updates=ALLOWED_UPDATES)
+
+
+async def _run_webhook() -> None:
+    app, handler = build_webhook_app(
+        dp, bot, WEBHOOK_PATH, WEBHOOK_SECRET or None, WEBHOOK_MAX_TASKS, WEBHOOK_DRAIN_SECONDS,
+    )
+    REGISTRY.gauge(
+        "porfiriy_webhook",
+        "webhook updates in flight and totals",
+        lambda: [({"stat": k}, v) for k, v in handler.stats().items()],
+    )
+    if METRICS_PORT == WEBHOOK_PORT:
+        add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, WEBHOOK_HOST, WEBHOOK_PORT).start()
+    logger.info(
+        "Webhook server on %s:%s%s (up to %s updates at once)",
+        WEBHOOK_HOST, WEBHOOK_PORT, WEBHOOK_PATH, WEBHOOK_MAX_TASKS,
+    )
+    if WEBHOOK_URL:
+        await bot.set_webhook(
+            WEBHOOK_URL.rstrip("/") + WEBHOOK_PATH,
+            secret_token=WEBHOOK_SECRET or None,
+            allowed_updates=ALLOWED_UPDATES,
+        )
+    else:
+        logger.warning("WEBHOOK_URL is empty; not registering the webhook with Telegram")
+
+    stop = asyncio.Event()
+    loop = asyncio.get_running_loop()
+    for sig in (signal.SIGINT, signal.SIGTERM):
+        loop.add_signal_handler(sig, stop.set)
+    try:
+        await stop.wait()
+    finally:
+        # Stops accepting requests, drains running handlers, closes the bot session.
+        await runner.cleanup()
+        logger.info("Webhook server stopped: %s", handler.stats())
+
+
 async def main():
     logger.info("Starting Porfiriy bot...")
-    scheduler = AsyncIOScheduler(timezone=TZ)
-    scheduler.add_job(daily_digest, "cron", hour=18, minute=0)
-    scheduler.add_job(daily_web_themes_digest, "cron", hour=WEB_DIGEST_HOUR, minute=WEB_DIGEST_MINUTE)
-    scheduler.start()
+    migrated = migrate_legacy_log()
+    if migrated:
+        logger.info("Migrated %s legacy log rows into per-chat segments", migrated)
+    warm_recent_cache(int(cid) for cid in load_chats())
+    rebuilt = await asyncio.to_thread(rebuild_aggregates, [int(cid) for cid in load_chats()])
+    if rebuilt:
+        logger.info("Rebuilt digest aggregates for %s chats from the log", rebuilt)
+    indexed = await asyncio.to_thread(rebuild_search_index, [int(cid) for cid in load_chats()])
+    logger.info("Search index loaded with %s messages", indexed)
+    imported = await state.import_chats(load_chats())
+    if imported:
+        logger.info("Copied %s local chat bindings into the %s state", imported, state.name)
+    # Paused until the digest jobs are synced, so a stored job for a chat
+    # that is gone cannot fire first.
+    scheduler.start(paused=True)
+    await sync_chat_digests()
+    caught_up = _catch_up_digests()
+    if caught_up:
+        logger.info("Re-running %s digests interrupted by the last shutdown", caught_up)
+    scheduler.add_job(sync_chat_digests, "interval", minutes=10)
+    if SUMMARY_REFRESH_MINUTES > 0:
+        scheduler.add_job(refresh_summaries, "interval", minutes=SUMMARY_REFRESH_MINUTES)
+    scheduler.add_job(log_maintenance, "cron", hour=LOG_MAINTENANCE_HOUR, minute=30)
+    scheduler.add_job(persist_aggregates, "interval", minutes=10)
+    if METRICS_LOG_MINUTES > 0:
+        scheduler.add_job(log_metrics_summary, "interval", minutes=METRICS_LOG_MINUTES)
+    scheduler.resume()
     logger.info(
-        "Scheduler started (daily digest at 18:00 %s, web digest at %02d:%02d %s)",
+        "Scheduler started (daily digest at 18:00 %s, web digest at %02d:%02d %s, spread over %s min, %s job store)",
         TZ,
         WEB_DIGEST_HOUR,
         WEB_DIGEST_MINUTE,
         TZ,
+        DIGEST_SPREAD_MINUTES,
+        SCHEDULER_JOBSTORE,
     )
-    await dp.start_polling(bot, allowed_updates=["message", "callback_query", "my_chat_member"])
+    metrics_runner = None
+    if METRICS_PORT and not (BOT_MODE == "webhook" and METRICS_PORT == WEBHOOK_PORT):
+        metrics_runner = await start_metrics_server(METRICS_HOST, METRICS_PORT)
+        logger.info("Metrics at http://%s:%s/metrics", METRICS_HOST, METRICS_PORT)
+    try:
+        if BOT_MODE == "webhook":
+            await _run_webhook()
+        else:
+            await _run_polling()
+    finally:
+        scheduler.shutdown(wait=False)
+        if metrics_runner is not None:
+            await metrics_runner.cleanup()
+        await comet.aclose()
+        await state.aclose()
+        await asyncio.to_thread(close_storage)
+        logger.info("Message log writer stopped: %s", log_writer_stats())
+        logger.info("/find cache: %s", find_cache.stats())
+        logger.info("LLM scheduler: %s", llm_scheduler.stats())
 
 
 if __name__ == "__main__":
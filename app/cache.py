@@ -0,0 +1,124 @@
+import asyncio
+import json
+import logging
+import os
+import re
+import time
+from collections import OrderedDict
+from pathlib import Path
+
+logger = logging.getLogger("porfiriy.cache")
+
+_SPACES = re.compile(r"\s+")
+_EDGE_PUNCT = " \t\n.,!?;:«»\"'()"
+
+
+def normalize_query(query: str) -> str:
+    return _SPACES.sub(" ", query.lower()).strip(_EDGE_PUNCT)
+
+
+class ResponseCache:
+    # TTL + LRU cache of finished answers with single-flight: concurrent
+    # get_or_fetch() calls for the same key share one in-flight fetch.
+    # Entries carry wall-clock expiry so they survive a restart when `path`
+    # is set.
+
+    def __init__(self, ttl: float, max_items: int, path: Path | None = None):
+        self.ttl = ttl
+        self.max_items = max_items
+        self.path = path
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self._items: OrderedDict[str, tuple[float, str]] = OrderedDict()
+        self._inflight: dict[str, asyncio.Future] = {}
+        if path is not None:
+            self._load()
+
+    def _load(self) -> None:
+        if not self.path.exists():
+            return
+        try:
+            raw = json.loads(self.path.read_text(encoding="utf-8"))
+        except (OSError, ValueError):
+            logger.warning("Ignoring unreadable cache file %s", self.path)
+            return
+        now = time.time()
+        for key, (expires_at, value) in raw.items():
+            if expires_at > now:
+                self._items[key] = (expires_at, value)
+        self._evict()
+
+    def save(self) -> None:
+        if self.path is None:
+            return
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(json.dumps(dict(self._items), ensure_ascii=False), encoding="utf-8")
+        os.replace(tmp, self.path)
+
+    def _evict(self) -> None:
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    def get(self, key: str) -> str | None:
+        item = self._items.get(key)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at <= time.time():
+            del self._items[key]
+            return None
+        self._items.move_to_end(key)
+        return value
+
+    def put(self, key: str, value: str) -> None:
+        if self.ttl <= 0 or self.max_items <= 0:
+            return
+        self._items[key] = (time.time() + self.ttl, value)
+        self._items.move_to_end(key)
+        self._evict()
+
+    async def get_or_fetch(self, key: str, fetch) -> tuple[str, bool]:
+        # Returns (value, fetched_here). Only the caller that ran fetch() gets
+        # fetched_here=True; hits and coalesced waiters get False.
+        value = self.get(key)
+        if value is not None:
+            self.hits += 1
+            return value, False
+        pending = self._inflight.get(key)
+        if pending is not None:
+            self.coalesced += 1
+            return await asyncio.shield(pending), False
+
+        self.misses += 1
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = await fetch()
+        except BaseException as e:
+            if isinstance(e, asyncio.CancelledError):
+                future.set_exception(RuntimeError("request was cancelled"))
+            else:
+                future.set_exception(e)
+            # Waiters may not exist; don't warn about an unretrieved exception.
+            future.exception()
+            raise
+        finally:
+            self._inflight.pop(key, None)
+        future.set_result(value)
+        self.put(key, value)
+        if self.path is not None:
+            try:
+                await asyncio.to_thread(self.save)
+            except OSError:
+                logger.exception("Failed to persist cache to %s", self.path)
+        return value, True
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._items),
+            "inflight": len(self._inflight),
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+        }
@@ -0,0 +1,71 @@
+from config import CONTEXT_DEPTH, CONTEXT_MAX_DEPTH, HUMOR_MODE
+from prompts import MODE_PROMPTS
+
+# Per-chat overrides kept under "settings" in the chat's registry entry.
+# Only changed keys are stored; everything else follows the .env defaults.
+
+# Prompts read 2 * depth rows; past the recent cache they come from disk.
+MAX_CONTEXT_DEPTH = CONTEXT_MAX_DEPTH
+SETTINGS_HELP = (
+    "Настройки чата (менять могут админы):\n"
+    "/settings humor soft|hard|insane\n"
+    f"/settings context 1-{MAX_CONTEXT_DEPTH} — сколько последних сообщений видит Порфирий\n"
+    "/settings daily on|off — дневной разбор\n"
+    "/settings web on|off — веб-дайджест\n"
+    "/settings reset — вернуть всё по умолчанию"
+)
+_SWITCH = {"on": True, "off": False, "1": True, "0": False, "вкл": True, "выкл": False}
+
+
+def default_settings() -> dict:
+    return {
+        "humor": HUMOR_MODE if HUMOR_MODE in MODE_PROMPTS else "hard",
+        "context": CONTEXT_DEPTH,
+        "daily": True,
+        "web": True,
+    }
+
+
+def resolve_settings(stored: dict | None) -> dict:
+    settings = default_settings()
+    for key, value in (stored or {}).items():
+        if key in settings:
+            settings[key] = value
+    # Also covers overrides stored under a larger CONTEXT_MAX_DEPTH.
+    settings["context"] = max(1, min(int(settings["context"]), MAX_CONTEXT_DEPTH))
+    return settings
+
+
+def parse_settings(args: list[str]) -> dict | None:
+    # "/settings <key> <value>" arguments -> changes to store, or None for
+    # reset. Raises ValueError with a message for the chat.
+    if args and args[0].lower() == "reset":
+        return None
+    if len(args) != 2:
+        raise ValueError(SETTINGS_HELP)
+    key, value = args[0].lower(), args[1].lower()
+    if key == "humor":
+        if value not in MODE_PROMPTS:
+            raise ValueError("Режимы: " + ", ".join(MODE_PROMPTS))
+        return {"humor": value}
+    if key == "context":
+        if not value.isdigit() or not 1 <= int(value) <= MAX_CONTEXT_DEPTH:
+            raise ValueError(f"context — число от 1 до {MAX_CONTEXT_DEPTH}")
+        return {"context": int(value)}
+    if key in ("daily", "web"):
+        if value not in _SWITCH:
+            raise ValueError(f"{key}: on или off")
+        return {key: _SWITCH[value]}
+    raise ValueError(SETTINGS_HELP)
+
+
+def describe_settings(settings: dict) -> str:
+    def switch(on: bool) -> str:
+        return "вкл" if on else "выкл"
+
+    return (
+        f"Юмор: {settings['humor']}\n"
+        f"Контекст: {settings['context']} сообщений\n"
+        f"Дневной разбор: {switch(settings['daily'])}\n"
+        f"Веб-дайджест: {switch(settings['web'])}"
+    )
@@ -1,15 +1,256 @@
+import asyncio
+import json
+import logging
+import random
+import time
+from contextlib import aclosing, nullcontext
+from datetime import datetime, timezone
+from email.utils import parsedate_to_datetime
+from typing import AsyncIterator
+
 import httpx
 
+from limits import PRIORITY_INTERACTIVE, QueueTimeout, RequestScheduler
+from metrics import LLM_PROMPT_TOKENS, LLM_ROUTING, LLM_SECONDS
+from routing import CircuitBreaker, LatencyWindow, Upstream
+
+logger = logging.getLogger("porfiriy.comet")
+
+
+# Web-search tool variants, in the order tried on an upstream that has not
+# accepted one yet.
+SEARCH_TOOLS = ("web_search_preview", "web_search")
+
+
+class CometUnavailable(RuntimeError):
+    pass
+
 
 class CometClient:
-    def __init__(self, token: str, model: str = "gpt-5.1", base_url: str = "https://api.cometapi.com"):
+    # Requests go to the first upstream (COMET_MODEL at COMET_BASE_URL) and
+    # fail over down `fallbacks` on errors; an upstream whose breaker is open
+    # is skipped. With `hedge` on, an interactive request that has not
+    # answered (streams: sent the first chunk) within the hedge quantile of
+    # recent latencies gets a second request to the next upstream, and the
+    # first answer wins.
+
+    def __init__(
+        self,
+        token: str,
+        model: str = "gpt-5.1",
+        base_url: str = "https://api.cometapi.com",
+        *,
+        http2: bool = False,
+        max_connections: int = 20,
+        max_keepalive: int = 10,
+        keepalive_expiry: float = 60.0,
+        connect_timeout: float = 10.0,
+        chat_timeout: float = 60.0,
+        search_timeout: float = 120.0,
+        scheduler: RequestScheduler | None = None,
+        max_retries: int = 3,
+        max_backoff: float = 60.0,
+        prompt_cache_key: bool = False,
+        fallbacks: list[tuple[str, str]] = (),
+        breaker_failures: int = 5,
+        breaker_cooldown: float = 30.0,
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_delay: float = 1.0,
+    ):
         self.token = token
         self.model = model
-        root = base_url.rstrip("/")
-        self.chat_url = f"{root}/v1/chat/completions"
-        self.responses_url = f"{root}/v1/responses"
+        self.upstreams = [
+            Upstream(m, url, CircuitBreaker(breaker_failures, breaker_cooldown))
+            for m, url in [(model, base_url), *fallbacks]
+        ]
+        self.http2 = http2
+        self.limits = httpx.Limits(
+            max_connections=max_connections,
+            max_keepalive_connections=max_keepalive,
+            keepalive_expiry=keepalive_expiry,
+        )
+        self.chat_timeout = httpx.Timeout(chat_timeout, connect=connect_timeout)
+        self.search_timeout = httpx.Timeout(search_timeout, connect=connect_timeout)
+        self.scheduler = scheduler
+        self.max_retries = max_retries
+        self.max_backoff = max_backoff
+        self.prompt_cache_key = prompt_cache_key
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_delay = hedge_min_delay
+        # Time to answer (streams: to the first chunk) per kind of call.
+        self._latency: dict[str, LatencyWindow] = {}
+        self._client: httpx.AsyncClient | None = None
+
+    @property
+    def client(self) -> httpx.AsyncClient:
+        # One pooled client for the process lifetime: keep-alive connections
+        # are reused across /nax, /find and digests instead of a new TLS
+        # handshake per call.
+        if self._client is None or self._client.is_closed:
+            self._client = httpx.AsyncClient(
+                http2=self.http2,
+                limits=self.limits,
+                timeout=self.chat_timeout,
+                headers={"Authorization": f"Bearer {self.token}"},
+            )
+        return self._client
+
+    async def aclose(self) -> None:
+        if self._client is not None:
+            await self._client.aclose()
+            self._client = None
+
+    def _slot(self, priority: int):
+        if self.scheduler is None:
+            return nullcontext()
+        return self.scheduler.slot(priority)
+
+    async def _throttle(self, r: httpx.Response, attempt: int) -> None:
+        # 429: wait for Retry-After (or exponential backoff) plus jitter. With
+        # a scheduler the pause applies to every queued request, not just this
+        # one, and the slot is released while waiting.
+        delay = _retry_after(r)
+        if delay is None:
+            delay = 2 ** attempt
+        delay = min(delay, self.max_backoff) * random.uniform(1.0, 1.25)
+        logger.warning("CometAPI 429, retry %s in %.1fs", attempt + 1, delay)
+        if self.scheduler is not None:
+            self.scheduler.pause(delay)
+        else:
+            await asyncio.sleep(delay)
+
+    async def _post(
+        self, upstream: Upstream, url: str, payload: dict, timeout: httpx.Timeout, priority: int, **labels,
+    ) -> httpx.Response:
+        payload = {**payload, "model": upstream.model}
+        for attempt in range(self.max_retries + 1):
+            async with self._slot(priority):
+                started = time.perf_counter()
+                status = "error"
+                try:
+                    r = await self.client.post(url, json=payload, timeout=timeout)
+                    status = str(r.status_code)
+                    if r.status_code == 429 and attempt < self.max_retries:
+                        await self._throttle(r, attempt)
+                        continue
+                    r.raise_for_status()
+                    return r
+                finally:
+                    LLM_SECONDS.observe(
+                        time.perf_counter() - started, status=status, mode="once", upstream=upstream.name, **labels,
+                    )
+
+    # -----------------------------------------------------------------------
+    # Routing: failover, circuit breakers, hedging
+    # -----------------------------------------------------------------------
 
-    async def chat(self, system_prompt: str, user_prompt: str) -> str:
+    def _hedge_delay(self, kind: str, priority: int) -> float | None:
+        if not self.hedge or priority != PRIORITY_INTERACTIVE:
+            return None
+        # A hedge waiting for a scheduler slot would only add to the queue.
+        if self.scheduler is not None and self.scheduler.queued()["interactive"]:
+            return None
+        q = self._latency[kind].quantile(self.hedge_quantile)
+        return None if q is None else max(self.hedge_min_delay, q)
+
+    async def _attempt(self, upstream: Upstream, call, kind: str):
+        started = time.perf_counter()
+        try:
+            result = await call(upstream)
+        except (asyncio.CancelledError, QueueTimeout):
+            # Never got an answer from the upstream, so nothing to judge it by.
+            upstream.breaker.release()
+            raise
+        except Exception as e:
+            if _unhealthy(e):
+                upstream.breaker.failure()
+            else:
+                # The upstream answered; the request itself was at fault.
+                upstream.breaker.success()
+            raise
+        upstream.breaker.success()
+        self._latency[kind].add(time.perf_counter() - started)
+        return result
+
+    async def _routed(self, kind: str, priority: int, call, discard=None):
+        # Runs `call(upstream)` on the first upstream whose breaker lets it
+        # through, fails over on transport errors, 5xx and exhausted 429s and
+        # hedges slow calls. Any other error is the request's own and is
+        # raised at once.
+        # `discard` gets results that lost the race (open streams to close).
+        self._latency.setdefault(kind, LatencyWindow())
+        order = iter(self.upstreams)
+
+        def pick() -> Upstream | None:
+            for upstream in order:
+                if upstream.breaker.allow():
+                    return upstream
+                LLM_ROUTING.inc(event="skipped", upstream=upstream.name)
+            return None
+
+        upstream = pick()
+        if upstream is None:
+            raise CometUnavailable("all CometAPI upstreams are cooling down after errors")
+        running: dict[asyncio.Task, tuple[Upstream, bool]] = {}
+
+        def launch(target: Upstream, hedge: bool) -> None:
+            task = asyncio.create_task(self._attempt(target, call, kind))
+            running[task] = (target, hedge)
+
+        launch(upstream, False)
+        started = time.perf_counter()
+        hedge_delay = self._hedge_delay(kind, priority)
+        error: BaseException | None = None
+        try:
+            while running:
+                timeout = None if hedge_delay is None else max(0.0, started + hedge_delay - time.perf_counter())
+                done, _ = await asyncio.wait(running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED)
+                if not done:
+                    # Slow: one hedged request, to the next upstream if there
+                    # is a healthy one, else the same one again.
+                    hedge_delay = None
+                    target = pick() or upstream
+                    LLM_ROUTING.inc(event="hedge", upstream=target.name)
+                    launch(target, True)
+                    continue
+                for task in done:
+                    target, hedge = running.pop(task)
+                    if task.exception() is None:
+                        if hedge:
+                            LLM_ROUTING.inc(event="hedge_won", upstream=target.name)
+                        return task.result()
+                    error = task.exception()
+                    if not _unhealthy(error):
+                        raise error
+                    logger.warning("CometAPI %s via %s failed: %r", kind, target.name, error)
+                if not running:
+                    upstream = pick()
+                    if upstream is None:
+                        break
+                    LLM_ROUTING.inc(event="failover", upstream=upstream.name)
+                    launch(upstream, False)
+                    started = time.perf_counter()
+                    hedge_delay = self._hedge_delay(kind, priority)
+            raise error
+        finally:
+            for task in running:
+                task.cancel()
+            for result in await asyncio.gather(*running, return_exceptions=True):
+                if discard is not None and not isinstance(result, BaseException):
+                    await discard(result)
+
+    def _search_tools(self, upstream: Upstream) -> list[str]:
+        if upstream.search_tool is None:
+            return list(SEARCH_TOOLS)
+        return [upstream.search_tool, *(t for t in SEARCH_TOOLS if t != upstream.search_tool)]
+
+    # -----------------------------------------------------------------------
+    # Requests
+    # -----------------------------------------------------------------------
+
+    def _chat_payload(self, system_prompt: str, user_prompt: str, cache_key: str | None) -> dict:
         payload = {
             "model": self.model,
             "messages": [
@@ -17,62 +258,273 @@ class CometClient:
                 {"role": "user", "content": user_prompt},
             ],
         }
-        headers = {"Authorization": f"Bearer {self.token}"}
-        async with httpx.AsyncClient(timeout=60) as client:
-            r = await client.post(self.chat_url, headers=headers, json=payload)
-            r.raise_for_status()
-            data = r.json()
-            return data["choices"][0]["message"]["content"]
-
-    async def web_search(self, prompt: str) -> str:
+        if cache_key and self.prompt_cache_key:
+            payload["prompt_cache_key"] = cache_key
+        return payload
+
+    async def chat(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        *,
+        priority: int = PRIORITY_INTERACTIVE,
+        cache_key: str | None = None,
+    ) -> str:
+        payload = self._chat_payload(system_prompt, user_prompt, cache_key)
+
+        async def call(upstream: Upstream) -> dict:
+            r = await self._post(
+                upstream, upstream.chat_url, payload, self.chat_timeout, priority, endpoint="chat", variant="-",
+            )
+            return r.json()
+
+        data = await self._routed("chat", priority, call)
+        usage = data.get("usage") or {}
+        if usage.get("prompt_tokens"):
+            LLM_PROMPT_TOKENS.inc(usage["prompt_tokens"], kind="prompt")
+            LLM_PROMPT_TOKENS.inc((usage.get("prompt_tokens_details") or {}).get("cached_tokens") or 0, kind="cached")
+        return data["choices"][0]["message"]["content"]
+
+    async def web_search(self, prompt: str, *, priority: int = PRIORITY_INTERACTIVE) -> str:
+        async def call(upstream: Upstream) -> str:
+            # The tool variant this upstream accepted before goes first, so a
+            # rejected first attempt is paid for once, not on every call.
+            tools = self._search_tools(upstream)
+            for i, tool in enumerate(tools):
+                payload = {"input": prompt, "tools": [{"type": tool}]}
+                try:
+                    r = await self._post(
+                        upstream, upstream.responses_url, payload, self.search_timeout, priority,
+                        endpoint="responses", variant=tool,
+                    )
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code not in {400, 422} or i == len(tools) - 1:
+                        raise
+                    continue
+                upstream.search_tool = tool
+                text = _extract_response_text(r.json())
+                if text:
+                    return text
+                raise RuntimeError("Comet responses API returned no text output")
+
+        return await self._routed("responses", priority, call)
+
+    # -----------------------------------------------------------------------
+    # Streaming (SSE)
+    # -----------------------------------------------------------------------
+
+    async def chat_stream(
+        self,
+        system_prompt: str,
+        user_prompt: str,
+        *,
+        priority: int = PRIORITY_INTERACTIVE,
+        cache_key: str | None = None,
+    ) -> AsyncIterator[str]:
+        payload = {**self._chat_payload(system_prompt, user_prompt, cache_key), "stream": True}
+        chunks, first = await self._routed(
+            "chat_stream", priority, lambda upstream: _open(self._chat_stream(upstream, payload, priority)), _close,
+        )
+        async with aclosing(chunks):
+            if first:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+
+    async def _chat_stream(self, upstream: Upstream, payload: dict, priority: int) -> AsyncIterator[str]:
+        payload = {**payload, "model": upstream.model}
+        for attempt in range(self.max_retries + 1):
+            async with self._slot(priority):
+                with LLM_SECONDS.time(
+                    endpoint="chat", variant="-", mode="stream", status="error", upstream=upstream.name,
+                ) as labels:
+                    async with self.client.stream(
+                        "POST", upstream.chat_url, json=payload, timeout=self.chat_timeout,
+                    ) as r:
+                        labels["status"] = str(r.status_code)
+                        if r.status_code == 429 and attempt < self.max_retries:
+                            await r.aread()
+                            await self._throttle(r, attempt)
+                            continue
+                        await _raise_for_status(r)
+                        async for event in _sse_events(r):
+                            for choice in event.get("choices") or []:
+                                delta = (choice.get("delta") or {}).get("content")
+                                if delta:
+                                    yield delta
+                        return
+
+    async def web_search_stream(self, prompt: str, *, priority: int = PRIORITY_INTERACTIVE) -> AsyncIterator[str]:
+        async def call(upstream: Upstream) -> tuple[AsyncIterator[str], str]:
+            tools = self._search_tools(upstream)
+            for i, tool in enumerate(tools):
+                try:
+                    opened = await _open(self._responses_stream(upstream, prompt, tool, priority))
+                except httpx.HTTPStatusError as e:
+                    if e.response.status_code not in {400, 422} or i == len(tools) - 1:
+                        raise
+                    continue
+                upstream.search_tool = tool
+                return opened
+
+        chunks, first = await self._routed("responses_stream", priority, call, _close)
+        async with aclosing(chunks):
+            if first:
+                yield first
+            async for chunk in chunks:
+                yield chunk
+
+    async def _responses_stream(
+        self, upstream: Upstream, prompt: str, tool: str, priority: int,
+    ) -> AsyncIterator[str]:
         payload = {
-            "model": self.model,
+            "model": upstream.model,
             "input": prompt,
-            "tools": [{"type": "web_search_preview"}],
-        }
-        headers = {
-            "Authorization": f"Bearer {self.token}",
-            "Content-Type": "application/json",
+            "tools": [{"type": tool}],
+            "stream": True,
         }
-        async with httpx.AsyncClient(timeout=120) as client:
-            try:
-                r = await client.post(self.responses_url, headers=headers, json=payload)
-                r.raise_for_status()
-            except httpx.HTTPStatusError as e:
-                if e.response.status_code not in {400, 422}:
-                    raise
-                fallback_payload = {
-                    "model": self.model,
-                    "input": prompt,
-                    "tools": [{"type": "web_search"}],
-                }
-                r = await client.post(self.responses_url, headers=headers, json=fallback_payload)
-                r.raise_for_status()
-
-            data = r.json()
-
-        # CometAPI may pass through different provider response formats.
-        output_text = data.get("output_text")
-        if output_text:
-            return output_text
-
-        if "choices" in data:
-            choices = data.get("choices") or []
-            if choices:
-                msg = choices[0].get("message", {})
-                content = msg.get("content")
-                if isinstance(content, str):
-                    return content
-
-        output = data.get("output") or []
-        chunks: list[str] = []
-        for item in output:
-            for part in item.get("content", []):
-                if part.get("type") in {"output_text", "text"}:
-                    txt = part.get("text", "")
-                    if txt:
-                        chunks.append(txt)
-        if chunks:
-            return "\n".join(chunks)
+        for attempt in range(self.max_retries + 1):
+            async with self._slot(priority):
+                with LLM_SECONDS.time(
+                    endpoint="responses", variant=tool, mode="stream", status="error", upstream=upstream.name,
+                ) as labels:
+                    async with self.client.stream(
+                        "POST", upstream.responses_url, json=payload, timeout=self.search_timeout,
+                    ) as r:
+                        labels["status"] = str(r.status_code)
+                        if r.status_code == 429 and attempt < self.max_retries:
+                            await r.aread()
+                            await self._throttle(r, attempt)
+                            continue
+                        await _raise_for_status(r)
+                        async with aclosing(_responses_chunks(r)) as chunks:
+                            async for chunk in chunks:
+                                yield chunk
+                        return
+
+    def upstream_stats(self) -> list[tuple[dict, float]]:
+        out = []
+        for upstream in self.upstreams:
+            breaker = upstream.breaker
+            labels = {"upstream": upstream.name}
+            out.append(({**labels, "stat": "open"}, 1 if breaker.state == "open" else 0))
+            out.append(({**labels, "stat": "failures"}, breaker.failures))
+            out.append(({**labels, "stat": "opened"}, breaker.opened))
+        return out
+
+
+def _unhealthy(e: Exception) -> bool:
+    # Errors that count against an upstream's breaker: no answer at all, a
+    # server-side failure, or a 429 that outlasted all retries with backoff.
+    if isinstance(e, httpx.TransportError):
+        return True
+    return isinstance(e, httpx.HTTPStatusError) and (e.response.status_code >= 500 or e.response.status_code == 429)
+
+
+async def _open(chunks: AsyncIterator[str]) -> tuple[AsyncIterator[str], str]:
+    # Runs a stream up to its first chunk, so that routing can fail over and
+    # hedge on the time to first token. An empty stream gives "".
+    try:
+        return chunks, await chunks.__anext__()
+    except StopAsyncIteration:
+        return chunks, ""
+    except BaseException:
+        await chunks.aclose()
+        raise
 
+
+async def _close(opened: tuple[AsyncIterator[str], str]) -> None:
+    await opened[0].aclose()
+
+
+async def _raise_for_status(r: httpx.Response) -> None:
+    if r.is_error:
+        await r.aread()
+        r.raise_for_status()
+
+
+async def _sse_events(r: httpx.Response) -> AsyncIterator[dict]:
+    data_lines: list[str] = []
+    async for line in r.aiter_lines():
+        if line.startswith("data:"):
+            data_lines.append(line[5:].strip())
+            continue
+        if line.strip() or not data_lines:
+            continue
+        data = "\n".join(data_lines)
+        data_lines = []
+        if data == "[DONE]":
+            return
+        yield json.loads(data)
+    if data_lines and data_lines[0] != "[DONE]":
+        yield json.loads("\n".join(data_lines))
+
+
+async def _responses_chunks(r: httpx.Response) -> AsyncIterator[str]:
+    streamed = False
+    async for event in _sse_events(r):
+        kind = event.get("type", "")
+        if kind == "response.output_text.delta":
+            delta = event.get("delta")
+            if delta:
+                streamed = True
+                yield delta
+        elif kind == "response.completed":
+            # Some providers only send the final response object.
+            if not streamed:
+                text = _extract_response_text(event.get("response") or {})
+                if text:
+                    streamed = True
+                    yield text
+        elif kind == "error" or kind == "response.failed":
+            raise RuntimeError(f"Comet responses stream failed: {event}")
+        elif "choices" in event:
+            for choice in event.get("choices") or []:
+                delta = (choice.get("delta") or {}).get("content")
+                if delta:
+                    streamed = True
+                    yield delta
+    if not streamed:
         raise RuntimeError("Comet responses API returned no text output")
+
+
+def _retry_after(r: httpx.Response) -> float | None:
+    value = r.headers.get("Retry-After", "").strip()
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        when = parsedate_to_datetime(value)
+    except (TypeError, ValueError):
+        return None
+    if when.tzinfo is None:
+        when = when.replace(tzinfo=timezone.utc)
+    return max(0.0, (when - datetime.now(timezone.utc)).total_seconds())
+
+
+def _extract_response_text(data: dict) -> str:
+    # CometAPI may pass through different provider response formats.
+    output_text = data.get("output_text")
+    if output_text:
+        return output_text
+
+    if "choices" in data:
+        choices = data.get("choices") or []
+        if choices:
+            msg = choices[0].get("message", {})
+            content = msg.get("content")
+            if isinstance(content, str):
+                return content
+
+    output = data.get("output") or []
+    chunks: list[str] = []
+    for item in output:
+        for part in item.get("content", []):
+            if part.get("type") in {"output_text", "text"}:
+                txt = part.get("text", "")
+                if txt:
+                    chunks.append(txt)
+    return "\n".join(chunks)
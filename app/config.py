@@ -1,4 +1,5 @@
 import os
+from pathlib import Path
 from dotenv import load_dotenv
 
 load_dotenv()
@@ -7,10 +8,152 @@ BOT_TOKEN = os.getenv("BOT_TOKEN", "")
 COMET_API_TOKEN = os.getenv("COMET_API_TOKEN", "")
 TZ = os.getenv("TZ", "Europe/Moscow")
 COMET_MODEL = os.getenv("COMET_MODEL", "gpt-5.1")
+COMET_BASE_URL = os.getenv("COMET_BASE_URL", "https://api.cometapi.com")
+DATA_DIR = Path(os.getenv("DATA_DIR", "").strip() or Path(__file__).resolve().parent.parent / "data")
+STORAGE_BACKEND = os.getenv("STORAGE_BACKEND", "files").strip().lower()  # files|sqlite
+SQLITE_PATH = Path(os.getenv("SQLITE_PATH", "").strip() or DATA_DIR / "porfiriy.sqlite3")
 
 # Optional hardening/tuning
-ALLOWED_CHAT_IDS = [int(x.strip()) for x in os.getenv("ALLOWED_CHAT_IDS", "").split(",") if x.strip()]
+ALLOWED_CHAT_IDS = frozenset(int(x.strip()) for x in os.getenv("ALLOWED_CHAT_IDS", "").split(",") if x.strip())
 BOT_COOLDOWN_SECONDS = int(os.getenv("BOT_COOLDOWN_SECONDS", "20"))
 HUMOR_MODE = os.getenv("HUMOR_MODE", "hard")  # soft|hard|insane
 WEB_DIGEST_HOUR = int(os.getenv("WEB_DIGEST_HOUR", "12"))
 WEB_DIGEST_MINUTE = int(os.getenv("WEB_DIGEST_MINUTE", "0"))
+
+# Update delivery: long polling or a webhook served by aiohttp
+BOT_MODE = os.getenv("BOT_MODE", "polling").strip().lower()  # polling|webhook
+WEBHOOK_URL = os.getenv("WEBHOOK_URL", "").strip()
+WEBHOOK_PATH = os.getenv("WEBHOOK_PATH", "/telegram/webhook")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET", "").strip()
+WEBHOOK_HOST = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+WEBHOOK_PORT = int(os.getenv("WEBHOOK_PORT", "8080"))
+WEBHOOK_MAX_TASKS = int(os.getenv("WEBHOOK_MAX_TASKS", "256"))
+WEBHOOK_DRAIN_SECONDS = float(os.getenv("WEBHOOK_DRAIN_SECONDS", "30"))
+
+# Throttling of LLM-backed commands. Limits are "burst/seconds": up to
+# `burst` calls at once, earned back evenly over `seconds`; 0 is off.
+def _limit(name: str, default: str) -> tuple[float, float] | None:
+    raw = os.getenv(name, "").strip() or default
+    if raw == "0":
+        return None
+    burst, seconds = (float(x) for x in raw.split("/", 1))
+    return (burst, seconds) if burst > 0 and seconds > 0 else None
+
+
+THROTTLE_ENABLED = os.getenv("THROTTLE_ENABLED", "1").strip().lower() in {"1", "true", "yes", "on"}
+THROTTLE_LIMITS = {
+    "nax": {
+        "chat": _limit("THROTTLE_NAX_CHAT", f"3/{3 * BOT_COOLDOWN_SECONDS}"),
+        "user": _limit("THROTTLE_NAX_USER", "2/60"),
+    },
+    "reply": {
+        "chat": _limit("THROTTLE_REPLY_CHAT", f"3/{3 * BOT_COOLDOWN_SECONDS}"),
+        "user": _limit("THROTTLE_REPLY_USER", "3/60"),
+    },
+    "find": {
+        "chat": _limit("THROTTLE_FIND_CHAT", "5/300"),
+        "user": _limit("THROTTLE_FIND_USER", "3/300"),
+    },
+}
+THROTTLE_NOTICE_SECONDS = float(os.getenv("THROTTLE_NOTICE_SECONDS", "10"))
+THROTTLE_MAX_LLM_QUEUE = int(os.getenv("THROTTLE_MAX_LLM_QUEUE", "20"))
+
+# Shared state across replicas (cooldowns, chat registry, recent context)
+STATE_BACKEND = os.getenv("STATE_BACKEND", "memory").strip().lower()  # memory|redis
+REDIS_URL = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+STATE_PREFIX = os.getenv("STATE_PREFIX", "porfiriy:")
+
+# In-memory recent-messages cache (context for /nax and replies)
+RECENT_CACHE_DEPTH = int(os.getenv("RECENT_CACHE_DEPTH", "50"))
+RECENT_CACHE_MAX_BYTES = int(os.getenv("RECENT_CACHE_MAX_BYTES", str(16 * 1024 * 1024)))
+
+# Write-behind message logger
+LOG_FLUSH_BATCH = int(os.getenv("LOG_FLUSH_BATCH", "500"))
+LOG_FLUSH_SECONDS = float(os.getenv("LOG_FLUSH_SECONDS", "0.5"))
+
+# CometAPI HTTP connection pool
+COMET_HTTP2 = os.getenv("COMET_HTTP2", "0").strip().lower() in {"1", "true", "yes", "on"}
+COMET_MAX_CONNECTIONS = int(os.getenv("COMET_MAX_CONNECTIONS", "20"))
+COMET_MAX_KEEPALIVE = int(os.getenv("COMET_MAX_KEEPALIVE", "10"))
+COMET_KEEPALIVE_EXPIRY = float(os.getenv("COMET_KEEPALIVE_EXPIRY", "60"))
+COMET_CONNECT_TIMEOUT = float(os.getenv("COMET_CONNECT_TIMEOUT", "10"))
+COMET_CHAT_TIMEOUT = float(os.getenv("COMET_CHAT_TIMEOUT", "60"))
+COMET_SEARCH_TIMEOUT = float(os.getenv("COMET_SEARCH_TIMEOUT", "120"))
+
+# CometAPI request scheduler (interactive requests go before digests)
+COMET_MAX_CONCURRENCY = int(os.getenv("COMET_MAX_CONCURRENCY", "8"))
+COMET_RATE_PER_SECOND = float(os.getenv("COMET_RATE_PER_SECOND", "5"))
+COMET_RATE_BURST = float(os.getenv("COMET_RATE_BURST", "10"))
+COMET_QUEUE_TIMEOUT = float(os.getenv("COMET_QUEUE_TIMEOUT", "30"))
+COMET_DIGEST_QUEUE_TIMEOUT = float(os.getenv("COMET_DIGEST_QUEUE_TIMEOUT", "0"))
+COMET_MAX_RETRIES = int(os.getenv("COMET_MAX_RETRIES", "3"))
+# Sends OpenAI's prompt_cache_key (one per chat) so a chat's requests land on the same prompt cache.
+COMET_PROMPT_CACHE_KEY = os.getenv("COMET_PROMPT_CACHE_KEY", "0").strip().lower() in {"1", "true", "yes", "on"}
+
+# CometAPI failover: "model" or "model@base_url" entries tried in order
+# after COMET_MODEL at COMET_BASE_URL; a missing base URL means the primary.
+def _fallbacks(raw: str) -> list[tuple[str, str]]:
+    out = []
+    for item in raw.split(","):
+        model, _, base_url = item.strip().partition("@")
+        if model.strip():
+            out.append((model.strip(), base_url.strip() or COMET_BASE_URL))
+    return out
+
+
+COMET_FALLBACKS = _fallbacks(os.getenv("COMET_FALLBACKS", ""))
+COMET_BREAKER_FAILURES = int(os.getenv("COMET_BREAKER_FAILURES", "5"))
+COMET_BREAKER_COOLDOWN = float(os.getenv("COMET_BREAKER_COOLDOWN", "30"))
+COMET_HEDGE = os.getenv("COMET_HEDGE", "0").strip().lower() in {"1", "true", "yes", "on"}
+COMET_HEDGE_QUANTILE = float(os.getenv("COMET_HEDGE_QUANTILE", "0.95"))
+COMET_HEDGE_MIN_DELAY = float(os.getenv("COMET_HEDGE_MIN_DELAY", "1"))
+
+# Scheduled digests
+DIGEST_CONCURRENCY = int(os.getenv("DIGEST_CONCURRENCY", "4"))
+DIGEST_CHAT_TIMEOUT = float(os.getenv("DIGEST_CHAT_TIMEOUT", "300"))
+DIGEST_SPREAD_MINUTES = int(os.getenv("DIGEST_SPREAD_MINUTES", "20"))
+DIGEST_MISFIRE_GRACE_MINUTES = int(os.getenv("DIGEST_MISFIRE_GRACE_MINUTES", "180"))
+SCHEDULER_JOBSTORE = os.getenv("SCHEDULER_JOBSTORE", "sqlite").strip().lower()  # sqlite|memory
+SCHEDULER_DB = Path(os.getenv("SCHEDULER_DB", "").strip() or DATA_DIR / "scheduler.sqlite3")
+TG_SEND_PER_SECOND = float(os.getenv("TG_SEND_PER_SECOND", "25"))
+TG_CHAT_SEND_INTERVAL = float(os.getenv("TG_CHAT_SEND_INTERVAL", "3"))
+
+# Streaming replies (progressive message edits)
+STREAM_REPLIES = os.getenv("STREAM_REPLIES", "1").strip().lower() in {"1", "true", "yes", "on"}
+STREAM_EDIT_INTERVAL = float(os.getenv("STREAM_EDIT_INTERVAL", "1.5"))
+
+# /find answer cache
+FIND_CACHE_TTL = float(os.getenv("FIND_CACHE_TTL", "900"))
+FIND_CACHE_SIZE = int(os.getenv("FIND_CACHE_SIZE", "256"))
+FIND_CACHE_PERSIST = os.getenv("FIND_CACHE_PERSIST", "1").strip().lower() in {"1", "true", "yes", "on"}
+
+# Prompt budgets and rolling summaries
+CONTEXT_TOKEN_BUDGET = int(os.getenv("CONTEXT_TOKEN_BUDGET", "1500"))
+CONTEXT_DEPTH = int(os.getenv("CONTEXT_DEPTH", "10"))
+CONTEXT_MAX_DEPTH = max(1, int(os.getenv("CONTEXT_MAX_DEPTH", "25")))
+DIGEST_TOKEN_BUDGET = int(os.getenv("DIGEST_TOKEN_BUDGET", "6000"))
+SUMMARY_CHUNK_TOKENS = int(os.getenv("SUMMARY_CHUNK_TOKENS", "6000"))
+SUMMARY_REFRESH_MINUTES = int(os.getenv("SUMMARY_REFRESH_MINUTES", "60"))
+
+# Chat history search (/recall and related-message context)
+SEARCH_INDEX_DOCS = int(os.getenv("SEARCH_INDEX_DOCS", "2000"))
+SEARCH_VECTORS = os.getenv("SEARCH_VECTORS", "1").strip().lower() in {"1", "true", "yes", "on"}
+SEARCH_CONTEXT_TOP_K = int(os.getenv("SEARCH_CONTEXT_TOP_K", "3"))
+SEARCH_RECALL_TOP_K = int(os.getenv("SEARCH_RECALL_TOP_K", "5"))
+SEARCH_BUDGET_MS = float(os.getenv("SEARCH_BUDGET_MS", "5"))
+
+# Metrics
+METRICS_HOST = os.getenv("METRICS_HOST", "127.0.0.1")
+METRICS_PORT = int(os.getenv("METRICS_PORT", "9108"))
+METRICS_LOG_MINUTES = int(os.getenv("METRICS_LOG_MINUTES", "15"))
+
+# Message log maintenance
+LOG_COMPRESS_AFTER_DAYS = int(os.getenv("LOG_COMPRESS_AFTER_DAYS", "2"))
+LOG_RETENTION_DAYS = int(os.getenv("LOG_RETENTION_DAYS", "0"))
+LOG_RETENTION_BY_CHAT = {
+    int(chat_id): int(days)
+    for chat_id, days in (
+        item.strip().rsplit(":", 1) for item in os.getenv("LOG_RETENTION_BY_CHAT", "").split(",") if item.strip()
+    )
+}
+LOG_MAINTENANCE_HOUR = int(os.getenv("LOG_MAINTENANCE_HOUR", "4"))
@@ -0,0 +1,216 @@
+import asyncio
+import json
+import logging
+import os
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+from rows import Row
+
+logger = logging.getLogger("porfiriy.context")
+
+# Rough average for Russian chat text with the GPT tokenizers; good enough to
+# keep prompts inside a budget without shipping a tokenizer.
+CHARS_PER_TOKEN = 3.0
+
+
+def estimate_tokens(text: str) -> int:
+    return int(len(text) / CHARS_PER_TOKEN) + 1
+
+
+def format_row(row: Row, prefix: str = "- ") -> str:
+    return f"{prefix}{row['user']}: {row['text']}"
+
+
+def pack_recent(rows: list[Row], budget: int, prefix: str = "- ") -> tuple[list[str], int]:
+    # Walks from the newest row back and keeps rows while they fit into the
+    # token budget. Returns the kept lines in chronological order and the
+    # index of the first kept row (rows before it did not fit).
+    lines: list[str] = []
+    used = 0
+    start = len(rows)
+    for i in range(len(rows) - 1, -1, -1):
+        line = format_row(rows[i], prefix)
+        cost = estimate_tokens(line)
+        if used + cost > budget and lines:
+            break
+        lines.append(line)
+        used += cost
+        start = i
+        if used >= budget:
+            break
+    lines.reverse()
+    return lines, start
+
+
+class AnchoredWindow:
+    # Recent-message block for /nax and replies. Per chat it remembers the
+    # block of the previous prompt (formatted lines, token estimate, last
+    # row) and extends it with the rows that arrived since, instead of
+    # sliding a fixed window: consecutive prompts in a chat then share an
+    # append-only prefix that provider-side prompt caching can reuse, and
+    # old rows are not formatted again. The block restarts from the newest
+    # `depth` rows once it would pass 2 * depth rows or the token budget.
+    # `rows` must hold the last 2 * depth rows of the chat.
+
+    def __init__(self, max_chats: int = 1024):
+        self.max_chats = max_chats
+        self._chats: OrderedDict[int, tuple[list[str], int, str]] = OrderedDict()
+        self.extended = 0
+        self.restarted = 0
+
+    def lines(self, chat_id: int, rows: list[Row], depth: int, budget: int, prefix: str = "  ") -> list[str]:
+        if not rows:
+            return []
+        entry = self._chats.get(chat_id)
+        if entry is not None:
+            lines, used, last_ts = entry
+            for i in range(len(rows) - 1, -1, -1):
+                if rows[i]["ts"] == last_ts:
+                    new = [format_row(r, prefix) for r in rows[i + 1:]]
+                    cost = sum(estimate_tokens(line) for line in new)
+                    if len(lines) + len(new) <= 2 * depth and used + cost <= budget:
+                        lines = lines + new
+                        self._remember(chat_id, lines, used + cost, rows[-1]["ts"])
+                        self.extended += 1
+                        return lines
+                    break
+        self.restarted += 1
+        lines, _ = pack_recent(rows[-depth:], budget, prefix)
+        self._remember(chat_id, lines, sum(estimate_tokens(line) for line in lines), rows[-1]["ts"])
+        return lines
+
+    def _remember(self, chat_id: int, lines: list[str], used: int, last_ts: str) -> None:
+        self._chats[chat_id] = (lines, used, last_ts)
+        self._chats.move_to_end(chat_id)
+        while len(self._chats) > self.max_chats:
+            self._chats.popitem(last=False)
+
+
+def _chunks(rows: list[Row], budget: int) -> list[list[str]]:
+    out: list[list[str]] = []
+    current: list[str] = []
+    used = 0
+    for row in rows:
+        line = format_row(row)
+        cost = estimate_tokens(line)
+        if current and used + cost > budget:
+            out.append(current)
+            current, used = [], 0
+        current.append(line)
+        used += cost
+    if current:
+        out.append(current)
+    return out
+
+
+# Summaries are kept per pane of PANE_HOURS (UTC-aligned), so the window can
+# slide without folding messages older than a day into the text: a pane that
+# starts before the window is dropped and rebuilt from its rows still inside.
+PANE_HOURS = 6
+
+
+def _pane_key(ts: str) -> str:
+    # "YYYY-MM-DDTHH" of the pane a UTC ISO timestamp falls into.
+    hour = int(ts[11:13])
+    return f"{ts[:11]}{hour - hour % PANE_HOURS:02d}"
+
+
+class RollingSummaries:
+    # Per-chat summaries of messages that no longer fit into the prompt
+    # budget, as a list of panes in time order. A pane's text covers exactly
+    # its rows with from_ts <= ts <= until_ts; newer rows of the pane are
+    # folded into it, so old messages are compressed once.
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._data: dict[str, list[dict]] = {}
+        self._file_lock = threading.Lock()
+        self._chat_locks: dict[int, asyncio.Lock] = {}
+        if path.exists():
+            try:
+                data = json.loads(path.read_text(encoding="utf-8"))
+            except ValueError:
+                logger.warning("Ignoring unreadable summaries file %s", path)
+            else:
+                # Entries from before panes are dropped and rebuilt.
+                self._data = {k: v for k, v in data.items() if isinstance(v, list)}
+
+    def lock(self, chat_id: int) -> asyncio.Lock:
+        return self._chat_locks.setdefault(chat_id, asyncio.Lock())
+
+    def get(self, chat_id: int) -> list[dict]:
+        return [dict(p) for p in self._data.get(str(chat_id), [])]
+
+    def set(self, chat_id: int, panes: list[dict]) -> None:
+        self._data[str(chat_id)] = panes
+
+    def save(self) -> None:
+        with self._file_lock:
+            tmp = self.path.with_name(self.path.name + ".tmp")
+            tmp.write_text(json.dumps(self._data, ensure_ascii=False, indent=2), encoding="utf-8")
+            os.replace(tmp, self.path)
+
+
+async def build_context(
+    chat_id: int,
+    rows: list[Row],
+    budget: int,
+    summaries: RollingSummaries,
+    summarize,
+    chunk_budget: int,
+) -> str:
+    # Packs the newest rows verbatim into `budget` tokens and folds the rest
+    # into the chat's rolling summary panes via `summarize(previous, lines)`.
+    if not rows:
+        return ""
+    lines, start = pack_recent(rows, budget)
+    overflow = rows[:start]
+    log_block = "\n".join(lines)
+    if not overflow:
+        return log_block
+
+    async with summaries.lock(chat_id):
+        # Row timestamps are UTC ISO strings and compare as such.
+        window_start = rows[0]["ts"]
+        stored = summaries.get(chat_id)
+        panes = {p["pane"]: p for p in stored if p["from_ts"] >= window_start}
+        by_pane: dict[str, list[Row]] = {}
+        for row in overflow:
+            by_pane.setdefault(_pane_key(row["ts"]), []).append(row)
+        summarized = 0
+        for key, pane_rows in by_pane.items():
+            pane = panes.get(key)
+            if pane is not None:
+                fresh = [r for r in pane_rows if r["ts"] > pane["until_ts"]]
+                if pane_rows[0]["ts"] < pane["from_ts"]:
+                    # Rows before the pane's start: it cannot be extended.
+                    pane, fresh = None, pane_rows
+            else:
+                fresh = pane_rows
+            if not fresh:
+                continue
+            text = pane["text"] if pane else ""
+            for chunk in _chunks(fresh, chunk_budget):
+                text = await summarize(text, chunk)
+            panes[key] = {
+                "pane": key,
+                "from_ts": pane["from_ts"] if pane else fresh[0]["ts"],
+                "until_ts": fresh[-1]["ts"],
+                "text": text,
+            }
+            summarized += len(fresh)
+        ordered = [panes[k] for k in sorted(panes)]
+        if summarized or len(ordered) != len(stored):
+            summaries.set(chat_id, ordered)
+            await asyncio.to_thread(summaries.save)
+            logger.info("Summary for chat %s updated with %s rows", chat_id, summarized)
+
+    previous = "\n\n".join(p["text"] for p in ordered if p["text"])
+    if not previous:
+        return log_block
+    return (
+        f"Краткое содержание более ранних сообщений за сутки:\n{previous}\n\n"
+        f"Последние сообщения:\n{log_block}"
+    )
@@ -0,0 +1,61 @@
+import re
+import time
+
+from aiogram import BaseMiddleware
+from aiogram.enums import ChatType
+from aiogram.types import Message
+
+from metrics import HANDLER_SECONDS
+
+GROUP_TYPES = frozenset({ChatType.GROUP, ChatType.SUPERGROUP})
+_COMMAND = re.compile(r"/([A-Za-z0-9_]+)(?:@\w+)?(?:\s|$)")
+_ROUTED_COMMANDS = {"find": "find", "recall": "recall", "nax": "nax"}
+
+
+def route(message: Message, bot_id: int) -> str:
+    # One pass over the message that tells every later stage what it is:
+    # "find" | "recall" | "nax" | "reply" (to the bot) | "command" (any other
+    # /command) | "plain".
+    text = message.text or message.caption or ""
+    if text[:1] == "/":
+        m = _COMMAND.match(text)
+        if m is not None:
+            routed = _ROUTED_COMMANDS.get(m.group(1).lower())
+            if routed is not None:
+                return routed
+    reply = message.reply_to_message
+    if text and reply is not None and reply.from_user is not None and reply.from_user.id == bot_id:
+        return "reply"
+    return "command" if text[:1] == "/" else "plain"
+
+
+class FastPathMiddleware(BaseMiddleware):
+    # First outer middleware on messages. Puts the route into the handler
+    # data (`route`) and finishes plain group chatter right here: it is only
+    # logged, and skipping the filter chain saves aiogram from running every
+    # sync magic filter in the default thread pool. Commands, replies to the
+    # bot and private messages go on to the handlers as before.
+
+    def __init__(self, state, on_plain, allowed_chat_ids=()):
+        self.state = state
+        self.on_plain = on_plain
+        self.allowed_chat_ids = frozenset(allowed_chat_ids)
+        self.bot_id: int | None = None
+
+    async def __call__(self, handler, event: Message, data):
+        if self.bot_id is None:
+            # Bot.id parses the token on every access.
+            self.bot_id = data["bot"].id
+        kind = data["route"] = route(event, self.bot_id)
+        if kind != "plain" or event.chat.type not in GROUP_TYPES:
+            return await handler(event, data)
+        started = time.perf_counter()
+        try:
+            chat_id = event.chat.id
+            if self.allowed_chat_ids and chat_id not in self.allowed_chat_ids:
+                return None
+            if await self.state.is_bound(chat_id):
+                await self.on_plain(event)
+            return None
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler="fast_path")
@@ -0,0 +1,135 @@
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime, timezone
+from pathlib import Path
+
+from apscheduler.jobstores.memory import MemoryJobStore
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.triggers.cron import CronTrigger
+
+logger = logging.getLogger("porfiriy.jobs")
+
+# Digests run as one cron job per (digest, chat) in the "digests" job store,
+# which is SQLite-backed by default: a run that was due while the bot was
+# down is still found there on start and runs once (coalesced) if it is
+# within the misfire grace time. Housekeeping jobs stay in the in-memory
+# "default" store and are simply re-added on every start.
+
+DIGEST_STORE = "digests"
+
+
+class DigestLedger:
+    # Last started and last finished period (local date) of every per-chat
+    # digest with the final status (sent, empty, failed, timeout, error),
+    # kept in a small JSON file. A finished period is never run again; one
+    # that was started but never reached a final status (the bot restarted
+    # mid-run) is picked up by the startup catch-up.
+
+    def __init__(self, path: Path | None):
+        self.path = path
+        self._entries: dict[str, dict] = {}
+        self._lock = threading.Lock()
+        if path is not None and path.exists():
+            try:
+                self._entries = json.loads(path.read_text(encoding="utf-8"))
+            except ValueError:
+                logger.warning("Ignoring unreadable digest ledger %s", path)
+
+    @staticmethod
+    def _key(job: str, chat_id: int) -> str:
+        return f"{job}:{chat_id}"
+
+    def entry(self, job: str, chat_id: int) -> dict:
+        with self._lock:
+            return dict(self._entries.get(self._key(job, chat_id), {}))
+
+    def done(self, job: str, chat_id: int, period: str) -> bool:
+        return self.entry(job, chat_id).get("done") == period
+
+    def start(self, job: str, chat_id: int, period: str) -> None:
+        self._update(job, chat_id, started=period, started_at=_now())
+
+    def finish(self, job: str, chat_id: int, period: str, status: str) -> None:
+        self._update(job, chat_id, done=period, status=status, finished_at=_now())
+
+    def interrupted(self, period: str) -> list[tuple[str, int]]:
+        with self._lock:
+            return [
+                (key.rsplit(":", 1)[0], int(key.rsplit(":", 1)[1]))
+                for key, e in self._entries.items()
+                if e.get("started") == period and e.get("done") != period
+            ]
+
+    def _update(self, job: str, chat_id: int, **fields) -> None:
+        with self._lock:
+            self._entries.setdefault(self._key(job, chat_id), {}).update(fields)
+            data = json.dumps(self._entries, ensure_ascii=False, indent=1)
+        if self.path is None:
+            return
+        tmp = self.path.with_name(self.path.name + ".tmp")
+        tmp.write_text(data, encoding="utf-8")
+        os.replace(tmp, self.path)
+
+
+def _now() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+def stagger(hour: int, minute: int, chat_id: int, spread_minutes: int) -> tuple[int, int]:
+    # Same chat, same offset on every start: the slot is hashed from the id.
+    offset = zlib.crc32(str(chat_id).encode()) % spread_minutes if spread_minutes > 0 else 0
+    total = hour * 60 + minute + offset
+    return total // 60 % 24, total % 60
+
+
+def make_scheduler(tz, jobstore: str, db_path: Path, misfire_grace_seconds: int) -> AsyncIOScheduler:
+    if jobstore == "sqlite":
+        try:
+            from apscheduler.jobstores.sqlalchemy import SQLAlchemyJobStore
+        except ImportError as e:
+            raise RuntimeError("SCHEDULER_JOBSTORE=sqlite needs SQLAlchemy (pip install SQLAlchemy)") from e
+        db_path.parent.mkdir(parents=True, exist_ok=True)
+        digests = SQLAlchemyJobStore(url=f"sqlite:///{db_path}")
+    else:
+        digests = MemoryJobStore()
+    return AsyncIOScheduler(
+        timezone=tz,
+        jobstores={"default": MemoryJobStore(), DIGEST_STORE: digests},
+        job_defaults={"coalesce": True, "misfire_grace_time": misfire_grace_seconds, "max_instances": 1},
+    )
+
+
+def sync_digest_jobs(
+    scheduler: AsyncIOScheduler, func, times: dict[str, tuple[int, int]], chat_ids, spread_minutes: int,
+) -> dict:
+    # Makes the digest store hold exactly one job per (digest, chat). Jobs
+    # whose slot did not change are left alone so that a run missed while
+    # the bot was down keeps its due time.
+    wanted: dict[str, tuple[str, int, CronTrigger]] = {}
+    for job, (hour, minute) in times.items():
+        for chat_id in chat_ids:
+            h, m = stagger(hour, minute, chat_id, spread_minutes)
+            trigger = CronTrigger(hour=h, minute=m, timezone=scheduler.timezone)
+            wanted[f"{job}:{chat_id}"] = (job, chat_id, trigger)
+    stats = {"jobs": len(wanted), "added": 0, "removed": 0}
+    existing = {j.id: j for j in scheduler.get_jobs(jobstore=DIGEST_STORE)}
+    for job_id, current in existing.items():
+        if job_id not in wanted:
+            current.remove()
+            stats["removed"] += 1
+    for job_id, (job, chat_id, trigger) in wanted.items():
+        current = existing.get(job_id)
+        if current is not None and _same_trigger(current.trigger, trigger) and tuple(current.args) == (job, chat_id):
+            continue
+        scheduler.add_job(
+            func, trigger, args=(job, chat_id), id=job_id, jobstore=DIGEST_STORE, replace_existing=True,
+        )
+        stats["added"] += 1
+    return stats
+
+
+def _same_trigger(a, b) -> bool:
+    return str(a) == str(b) and str(getattr(a, "timezone", "")) == str(getattr(b, "timezone", ""))
@@ -0,0 +1,199 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+
+
+class SendLimiter:
+    # Spaces out outgoing Telegram messages: at most `per_second` sends
+    # overall and at least `chat_interval` seconds between sends to the same
+    # chat (Telegram allows ~30 msg/s per bot and ~20 msg/min per group).
+
+    def __init__(self, per_second: float, chat_interval: float):
+        self.global_interval = 1.0 / per_second if per_second > 0 else 0.0
+        self.chat_interval = chat_interval
+        self._next_global = 0.0
+        self._next_chat: dict[int, float] = {}
+        self._lock = asyncio.Lock()
+
+    async def wait(self, chat_id: int) -> None:
+        async with self._lock:
+            now = time.monotonic()
+            at = max(now, self._next_global, self._next_chat.get(chat_id, 0.0))
+            self._next_global = at + self.global_interval
+            self._next_chat[chat_id] = at + self.chat_interval
+        delay = at - now
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+
+class TokenBuckets:
+    # Keyed token buckets: each key holds up to `burst` tokens and earns them
+    # back at burst/period per second. take() spends one token from every
+    # bucket it is given or from none of them, so a call rejected by one
+    # bucket does not drain the others.
+
+    def __init__(self, max_keys: int = 100_000):
+        self.max_keys = max_keys
+        # key -> (tokens, updated, burst, rate)
+        self._buckets: dict[str, tuple[float, float, float, float]] = {}
+
+    def take(self, buckets: list[tuple[str, float, float]]) -> tuple[float, int]:
+        # `buckets` holds (key, burst, period). Returns (0, -1) after spending,
+        # or the longest wait and the index of the bucket that needs it.
+        now = time.monotonic()
+        levels = []
+        wait, index = 0.0, -1
+        for i, (key, burst, period) in enumerate(buckets):
+            rate = burst / period
+            tokens, updated, _, _ = self._buckets.get(key, (burst, now, burst, rate))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            levels.append((tokens, burst, rate))
+            if tokens < 1 and (1 - tokens) / rate > wait:
+                wait, index = (1 - tokens) / rate, i
+        spend = 1 if index < 0 else 0
+        for (key, _, _), (tokens, burst, rate) in zip(buckets, levels):
+            self._buckets[key] = (tokens - spend, now, burst, rate)
+        if len(self._buckets) > self.max_keys:
+            self._prune(now)
+        return wait, index
+
+    def _prune(self, now: float) -> None:
+        # Forget buckets idle long enough to be full again under their own
+        # limit; a full bucket behaves exactly like a new one.
+        self._buckets = {
+            key: entry
+            for key, entry in self._buckets.items()
+            if entry[0] + (now - entry[1]) * entry[3] < entry[2]
+        }
+
+
+PRIORITY_INTERACTIVE = 0
+PRIORITY_BACKGROUND = 1
+PRIORITY_NAMES = {PRIORITY_INTERACTIVE: "interactive", PRIORITY_BACKGROUND: "background"}
+
+
+class QueueTimeout(RuntimeError):
+    pass
+
+
+class RequestScheduler:
+    # Admits outgoing LLM requests: at most `max_concurrent` in flight, a
+    # token bucket of `per_second` (up to `burst` at once), lower priority
+    # numbers first and FIFO within a priority. pause() holds every request
+    # back after the provider answered 429.
+
+    def __init__(
+        self,
+        max_concurrent: int,
+        per_second: float = 0.0,
+        burst: float = 1.0,
+        queue_timeouts: dict[int, float] | None = None,
+    ):
+        self.max_concurrent = max(1, max_concurrent)
+        self.rate = per_second
+        self.burst = max(1.0, burst)
+        self.queue_timeouts = queue_timeouts or {}
+        self._tokens = self.burst
+        self._refilled = time.monotonic()
+        self._paused_until = 0.0
+        self._active = 0
+        self._waiters: list[tuple[int, int, asyncio.Future]] = []
+        self._seq = itertools.count()
+        self._timer: asyncio.TimerHandle | None = None
+        self.granted = 0
+        self.timeouts = 0
+        self.throttled = 0
+
+    def _refill(self, now: float) -> None:
+        if self.rate > 0:
+            self._tokens = min(self.burst, self._tokens + (now - self._refilled) * self.rate)
+        self._refilled = now
+
+    def _dispatch(self) -> None:
+        while self._waiters and self._active < self.max_concurrent:
+            if self._waiters[0][2].done():
+                heapq.heappop(self._waiters)
+                continue
+            now = time.monotonic()
+            self._refill(now)
+            delay = self._paused_until - now
+            if self.rate > 0 and self._tokens < 1:
+                delay = max(delay, (1 - self._tokens) / self.rate)
+            if delay > 0:
+                self._schedule(delay)
+                return
+            _, _, fut = heapq.heappop(self._waiters)
+            if self.rate > 0:
+                self._tokens -= 1
+            self._active += 1
+            self.granted += 1
+            fut.set_result(None)
+
+    def _schedule(self, delay: float) -> None:
+        if self._timer is not None:
+            self._timer.cancel()
+        self._timer = asyncio.get_running_loop().call_later(delay, self._on_timer)
+
+    def _on_timer(self) -> None:
+        self._timer = None
+        self._dispatch()
+
+    def _expire(self, fut: asyncio.Future) -> None:
+        if not fut.done():
+            self.timeouts += 1
+            fut.set_exception(QueueTimeout("LLM request queue timed out"))
+
+    async def acquire(self, priority: int = PRIORITY_INTERACTIVE) -> None:
+        loop = asyncio.get_running_loop()
+        fut = loop.create_future()
+        heapq.heappush(self._waiters, (priority, next(self._seq), fut))
+        self._dispatch()
+        if fut.done():
+            return
+        timeout = self.queue_timeouts.get(priority)
+        timer = loop.call_later(timeout, self._expire, fut) if timeout else None
+        try:
+            await fut
+        except asyncio.CancelledError:
+            # Cancelled right after being admitted: give the slot back.
+            if fut.done() and not fut.cancelled() and fut.exception() is None:
+                self.release()
+            raise
+        finally:
+            if timer is not None:
+                timer.cancel()
+
+    def release(self) -> None:
+        self._active -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def slot(self, priority: int = PRIORITY_INTERACTIVE):
+        await self.acquire(priority)
+        try:
+            yield
+        finally:
+            self.release()
+
+    def pause(self, seconds: float) -> None:
+        self.throttled += 1
+        self._paused_until = max(self._paused_until, time.monotonic() + seconds)
+
+    def queued(self) -> dict[str, int]:
+        out = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, fut in self._waiters:
+            if not fut.done():
+                name = PRIORITY_NAMES.get(priority, str(priority))
+                out[name] = out.get(name, 0) + 1
+        return out
+
+    def stats(self) -> dict:
+        return {
+            "active": self._active,
+            **{f"queued_{name}": n for name, n in self.queued().items()},
+            "granted": self.granted,
+            "timeouts": self.timeouts,
+            "throttled": self.throttled,
+        }
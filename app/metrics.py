@@ -0,0 +1,234 @@
+import functools
+import threading
+import time
+from contextlib import contextmanager
+
+from aiohttp import web
+from aiogram import BaseMiddleware
+
+# Seconds; covers in-memory lookups up to slow LLM calls.
+DEFAULT_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+
+def _label_key(labels: dict) -> tuple:
+    return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+def _format_labels(key: tuple, extra: tuple = ()) -> str:
+    items = key + extra
+    if not items:
+        return ""
+    body = ",".join(f'{k}="{v}"' for k, v in items)
+    return "{" + body + "}"
+
+
+class Counter:
+    kind = "counter"
+
+    def __init__(self, name: str, help_text: str):
+        self.name = name
+        self.help = help_text
+        self._values: dict[tuple, float] = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def samples(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)} {v:g}" for k, v in sorted(self._values.items())]
+
+    def summary(self) -> list[str]:
+        with self._lock:
+            return [f"{self.name}{_format_labels(k)}={v:g}" for k, v in sorted(self._values.items())]
+
+
+class Gauge:
+    # Value is read from a callback at scrape time; the callback returns a
+    # number or a list of (labels dict, number) pairs.
+    kind = "gauge"
+
+    def __init__(self, name: str, help_text: str, read):
+        self.name = name
+        self.help = help_text
+        self._read = read
+
+    def _values(self) -> dict[tuple, float]:
+        value = self._read()
+        if isinstance(value, list):
+            return {_label_key(labels): v for labels, v in value}
+        return {(): value}
+
+    def samples(self) -> list[str]:
+        return [f"{self.name}{_format_labels(k)} {v:g}" for k, v in sorted(self._values().items())]
+
+    def summary(self) -> list[str]:
+        return [f"{self.name}{_format_labels(k)}={v:g}" for k, v in sorted(self._values().items())]
+
+
+class Histogram:
+    kind = "histogram"
+
+    def __init__(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(sorted(buckets))
+        # label key -> [per-bucket counts..., +Inf count, sum]
+        self._values: dict[tuple, list[float]] = {}
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, **labels) -> None:
+        key = _label_key(labels)
+        with self._lock:
+            row = self._values.get(key)
+            if row is None:
+                row = self._values[key] = [0] * (len(self.buckets) + 2)
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    row[i] += 1
+                    break
+            else:
+                row[len(self.buckets)] += 1
+            row[-1] += value
+
+    @contextmanager
+    def time(self, **labels):
+        started = time.perf_counter()
+        try:
+            yield labels
+        finally:
+            self.observe(time.perf_counter() - started, **labels)
+
+    def _quantile(self, row: list[float], q: float) -> float:
+        total = sum(row[:-1])
+        if not total:
+            return 0.0
+        rank = q * total
+        seen = 0
+        for i, bound in enumerate(self.buckets):
+            seen += row[i]
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def samples(self) -> list[str]:
+        out = []
+        with self._lock:
+            for key, row in sorted(self._values.items()):
+                cumulative = 0
+                for i, bound in enumerate(self.buckets):
+                    cumulative += row[i]
+                    out.append(f"{self.name}_bucket{_format_labels(key, (('le', f'{bound:g}'),))} {cumulative:g}")
+                cumulative += row[len(self.buckets)]
+                out.append(f"{self.name}_bucket{_format_labels(key, (('le', '+Inf'),))} {cumulative:g}")
+                out.append(f"{self.name}_sum{_format_labels(key)} {row[-1]:g}")
+                out.append(f"{self.name}_count{_format_labels(key)} {cumulative:g}")
+        return out
+
+    def summary(self) -> list[str]:
+        out = []
+        with self._lock:
+            for key, row in sorted(self._values.items()):
+                count = sum(row[:-1])
+                out.append(
+                    f"{self.name}{_format_labels(key)} n={count:g} "
+                    f"p50<={self._quantile(row, 0.5):g}s p99<={self._quantile(row, 0.99):g}s"
+                )
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: dict[str, Counter | Gauge | Histogram] = {}
+
+    def _add(self, metric):
+        existing = self._metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help_text: str) -> Counter:
+        return self._add(Counter(name, help_text))
+
+    def histogram(self, name: str, help_text: str, buckets: tuple = DEFAULT_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help_text, buckets))
+
+    def gauge(self, name: str, help_text: str, read) -> Gauge:
+        return self._add(Gauge(name, help_text, read))
+
+    def render(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            lines.extend(metric.samples())
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        lines = []
+        for metric in self._metrics.values():
+            lines.extend(metric.summary())
+        return "\n".join(lines)
+
+
+REGISTRY = Registry()
+
+HANDLER_SECONDS = REGISTRY.histogram("porfiriy_handler_seconds", "aiogram handler latency")
+HANDLER_ERRORS = REGISTRY.counter("porfiriy_handler_errors_total", "aiogram handlers that raised")
+LLM_SECONDS = REGISTRY.histogram("porfiriy_llm_seconds", "CometAPI request latency")
+LLM_PROMPT_TOKENS = REGISTRY.counter(
+    "porfiriy_llm_prompt_tokens_total", "prompt tokens sent, and the part served from the provider's prompt cache",
+)
+LLM_ROUTING = REGISTRY.counter(
+    "porfiriy_llm_routing_total", "CometAPI failovers, hedged requests and upstreams skipped by an open breaker",
+)
+STORAGE_SECONDS = REGISTRY.histogram("porfiriy_storage_seconds", "storage read/write latency")
+JOB_SECONDS = REGISTRY.histogram("porfiriy_job_seconds", "scheduled job wall time")
+JOB_CHATS = REGISTRY.counter("porfiriy_job_chats_total", "per-chat results of scheduled jobs")
+THROTTLED = REGISTRY.counter("porfiriy_throttled_total", "commands rejected by the throttle middleware")
+THROTTLE_NOTICES = REGISTRY.counter("porfiriy_throttle_notices_total", "cooldown replies sent or coalesced")
+
+
+def timed_async(histogram: Histogram, **labels):
+    def decorator(func):
+        @functools.wraps(func)
+        async def wrapper(*args, **kwargs):
+            with histogram.time(**labels):
+                return await func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+class HandlerMetricsMiddleware(BaseMiddleware):
+    # Inner middleware: times whichever handler matched the event.
+    async def __call__(self, handler, event, data):
+        handler_obj = data.get("handler")
+        name = getattr(getattr(handler_obj, "callback", None), "__name__", "unknown")
+        started = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            HANDLER_ERRORS.inc(handler=name)
+            raise
+        finally:
+            HANDLER_SECONDS.observe(time.perf_counter() - started, handler=name)
+
+
+async def _metrics_view(request: web.Request) -> web.Response:
+    return web.Response(text=REGISTRY.render(), content_type="text/plain", charset="utf-8")
+
+
+def add_metrics_route(app: web.Application, path: str = "/metrics") -> None:
+    app.router.add_get(path, _metrics_view)
+
+
+async def start_metrics_server(host: str, port: int) -> web.AppRunner:
+    app = web.Application()
+    add_metrics_route(app)
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
@@ -0,0 +1,86 @@
+import time
+from collections import deque
+
+# Upstream bookkeeping for CometClient: the ordered list of model/base URL
+# pairs to try, a circuit breaker per upstream and the latency windows that
+# set the hedge delay.
+
+
+class CircuitBreaker:
+    # Opens after `threshold` failures in a row (transport errors, timeouts,
+    # 5xx, exhausted 429s) and rejects calls for `cooldown` seconds. After
+    # that a single probe goes through: success closes the breaker, failure
+    # opens it again.
+
+    def __init__(self, threshold: int = 5, cooldown: float = 30.0):
+        self.threshold = threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.opened_at: float | None = None
+        self.probing = False
+        self.opened = 0
+
+    @property
+    def state(self) -> str:
+        if self.opened_at is None:
+            return "closed"
+        if self.probing or time.monotonic() - self.opened_at >= self.cooldown:
+            return "half_open"
+        return "open"
+
+    def allow(self) -> bool:
+        if self.threshold <= 0 or self.opened_at is None:
+            return True
+        if self.probing or time.monotonic() - self.opened_at < self.cooldown:
+            return False
+        self.probing = True
+        return True
+
+    def success(self) -> None:
+        self.failures = 0
+        self.opened_at = None
+        self.probing = False
+
+    def failure(self) -> None:
+        self.failures += 1
+        if self.probing or (self.threshold > 0 and self.failures >= self.threshold):
+            if self.opened_at is None:
+                self.opened += 1
+            self.opened_at = time.monotonic()
+        self.probing = False
+
+    def release(self) -> None:
+        # The probe was cancelled before it told anything about the upstream.
+        self.probing = False
+
+
+class Upstream:
+    __slots__ = ("name", "model", "chat_url", "responses_url", "breaker", "search_tool")
+
+    def __init__(self, model: str, base_url: str, breaker: CircuitBreaker):
+        root = base_url.rstrip("/")
+        self.name = f"{model}@{root.split('://', 1)[-1]}"
+        self.model = model
+        self.chat_url = f"{root}/v1/chat/completions"
+        self.responses_url = f"{root}/v1/responses"
+        self.breaker = breaker
+        # Web-search tool variant this upstream accepted last time.
+        self.search_tool: str | None = None
+
+
+class LatencyWindow:
+    # Last `size` successful durations; quantile() is None until `min_samples`
+    # have been seen, so a cold start does not hedge on a guess.
+
+    def __init__(self, size: int = 200, min_samples: int = 20):
+        self.min_samples = min_samples
+        self._values: deque[float] = deque(maxlen=size)
+
+    def add(self, seconds: float) -> None:
+        self._values.append(seconds)
+
+    def quantile(self, q: float) -> float | None:
+        if len(self._values) < self.min_samples:
+            return None
+        ordered = sorted(self._values)
+        return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
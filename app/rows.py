@@ -0,0 +1,53 @@
+import json
+import sys
+from datetime import datetime, timezone
+
+# Log rows as read back from storage. A Row holds the four fields in
+# __slots__ (about a third of a dict's size) and answers row["ts"] like the
+# dicts it replaces, so callers do not care which one they got. "ts" stays
+# the UTC ISO string it was written as: all rows share the "+00:00" offset,
+# so time filters compare strings and a datetime is only parsed on demand.
+
+
+class Row:
+    __slots__ = ("ts", "chat_id", "user", "text")
+
+    def __init__(self, ts: str, chat_id: int, user: str, text: str):
+        self.ts = ts
+        self.chat_id = chat_id
+        # A chat has a few dozen authors over thousands of rows.
+        self.user = sys.intern(user)
+        self.text = text
+
+    @classmethod
+    def from_json(cls, line: bytes | str) -> "Row":
+        d = json.loads(line)
+        return cls(d["ts"], d.get("chat_id"), d.get("user", "unknown"), d.get("text", ""))
+
+    def to_json(self) -> str:
+        return json.dumps(
+            {"ts": self.ts, "chat_id": self.chat_id, "user": self.user, "text": self.text}, ensure_ascii=False,
+        )
+
+    @property
+    def dt(self) -> datetime:
+        return datetime.fromisoformat(self.ts)
+
+    def __getitem__(self, key: str):
+        if key not in Row.__slots__:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def get(self, key: str, default=None):
+        return getattr(self, key) if key in Row.__slots__ else default
+
+    def keys(self) -> tuple[str, ...]:
+        return Row.__slots__
+
+    def __repr__(self) -> str:
+        return f"Row(ts={self.ts!r}, chat_id={self.chat_id!r}, user={self.user!r}, text={self.text[:40]!r})"
+
+
+def ts_key(when: datetime) -> str:
+    # The string a row's "ts" is compared against for `when`.
+    return when.astimezone(timezone.utc).isoformat()
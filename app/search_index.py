@@ -0,0 +1,191 @@
+import math
+import threading
+import time
+import zlib
+from datetime import datetime
+
+from aggregate import words
+
+try:
+    import numpy as np
+except ImportError:  # optional: BM25 alone works without it
+    np = None
+
+# Local retrieval over the chat log. Every chat keeps its last `max_docs`
+# messages in a BM25 inverted index; with NumPy installed each message also
+# gets a hashed bag-of-words vector, and the two rankings are fused so that
+# near-matches with different word forms still surface. Kept in memory and
+# rebuilt from the log on start.
+
+K1 = 1.2
+B = 0.75
+# Candidates taken from each ranking before fusing; RRF_K damps rank 1.
+FUSE_DEPTH = 50
+RRF_K = 60
+
+
+def tokens(text: str) -> list[str]:
+    # Content words cut to a 5-letter prefix: a crude stemmer that makes
+    # "работа"/"работы"/"работаю" one term in Russian.
+    return [w[:5] for w in words(text)]
+
+
+def _hashed(counts: dict[str, int], dim: int):
+    vec = np.zeros(dim, dtype=np.float32)
+    for term, tf in counts.items():
+        h = zlib.crc32(term.encode())
+        vec[h % dim] += (1.0 if h & 0x80000000 else -1.0) * (1.0 + math.log(tf))
+    norm = float(np.linalg.norm(vec))
+    return vec / norm if norm else vec
+
+
+class _ChatIndex:
+    __slots__ = ("docs", "postings", "total_len", "next_id", "vectors")
+
+    def __init__(self):
+        # doc id -> (ts, user, text, unique terms, length)
+        self.docs: dict[int, tuple] = {}
+        self.postings: dict[str, dict[int, int]] = {}
+        self.total_len = 0
+        self.next_id = 0
+        self.vectors = None
+
+
+class SearchIndex:
+    def __init__(self, max_docs: int = 2000, vectors: bool = True, dim: int = 256):
+        self.max_docs = max(1, max_docs)
+        self.dim = dim
+        self.vectors = vectors and np is not None
+        self._chats: dict[int, _ChatIndex] = {}
+        self._lock = threading.Lock()
+        self.queries = 0
+        self.truncated = 0
+
+    def add(self, chat_id: int, ts: str, user: str, text: str) -> None:
+        found = tokens(text)
+        # One-word messages ("ага", "))") only add noise to the ranking.
+        if len(found) < 2:
+            return
+        counts: dict[str, int] = {}
+        for term in found:
+            counts[term] = counts.get(term, 0) + 1
+        vec = _hashed(counts, self.dim) if self.vectors else None
+        with self._lock:
+            index = self._chats.get(chat_id)
+            if index is None:
+                index = self._chats[chat_id] = _ChatIndex()
+            doc_id = index.next_id
+            index.next_id += 1
+            index.docs[doc_id] = (ts, user, text[:500], tuple(counts), len(found))
+            index.total_len += len(found)
+            for term, tf in counts.items():
+                index.postings.setdefault(term, {})[doc_id] = tf
+            if vec is not None:
+                if index.vectors is None:
+                    index.vectors = np.zeros((self.max_docs, self.dim), dtype=np.float32)
+                index.vectors[doc_id % self.max_docs] = vec
+            old = doc_id - self.max_docs
+            if old in index.docs:
+                self._evict(index, old)
+
+    @staticmethod
+    def _evict(index: _ChatIndex, doc_id: int) -> None:
+        _, _, _, unique, length = index.docs.pop(doc_id)
+        index.total_len -= length
+        for term in unique:
+            posting = index.postings[term]
+            del posting[doc_id]
+            if not posting:
+                del index.postings[term]
+
+    def has(self, chat_id: int) -> bool:
+        return chat_id in self._chats
+
+    def search(
+        self, chat_id: int, query: str, k: int = 3, budget: float = 0.005, before: str | None = None,
+    ) -> list[dict]:
+        # Top-k rows for `query`, best first. Terms are scored rarest first;
+        # once `budget` seconds are spent the remaining (common) terms are
+        # skipped, so the ranking degrades instead of the reply slowing down.
+        # `before` (an ISO ts) hides the message that is being answered.
+        deadline = time.perf_counter() + budget
+        found = tokens(query)
+        if not found or k <= 0:
+            return []
+        with self._lock:
+            self.queries += 1
+            index = self._chats.get(chat_id)
+            if index is None or not index.docs:
+                return []
+            n = len(index.docs)
+            avg_len = index.total_len / n
+            query_terms = sorted(
+                {t for t in found if t in index.postings}, key=lambda t: len(index.postings[t]),
+            )
+            scores: dict[int, float] = {}
+            for i, term in enumerate(query_terms):
+                if i and time.perf_counter() > deadline:
+                    self.truncated += 1
+                    break
+                posting = index.postings[term]
+                df = len(posting)
+                idf = math.log(1 + (n - df + 0.5) / (df + 0.5))
+                for doc_id, tf in posting.items():
+                    length = index.docs[doc_id][4]
+                    scores[doc_id] = scores.get(doc_id, 0.0) + idf * tf * (K1 + 1) / (
+                        tf + K1 * (1 - B + B * length / avg_len)
+                    )
+            ranked = sorted(scores, key=scores.get, reverse=True)[:FUSE_DEPTH]
+            if index.vectors is not None and time.perf_counter() < deadline:
+                ranked = self._fuse(index, found, ranked)
+            hits = []
+            for doc_id in ranked:
+                ts, user, text, _, _ = index.docs[doc_id]
+                if before is not None and ts >= before:
+                    continue
+                hits.append({"ts": ts, "chat_id": chat_id, "user": user, "text": text})
+                if len(hits) >= k:
+                    break
+            return hits
+
+    def _fuse(self, index: _ChatIndex, found: list[str], ranked: list[int]) -> list[int]:
+        # Reciprocal rank fusion of the BM25 order with cosine similarity.
+        counts: dict[str, int] = {}
+        for term in found:
+            counts[term] = counts.get(term, 0) + 1
+        sims = index.vectors @ _hashed(counts, self.dim)
+        top = np.argpartition(-sims, min(FUSE_DEPTH, len(sims) - 1))[:FUSE_DEPTH]
+        # Slots map back to the newest doc id that lives in them.
+        last = index.next_id - 1
+        by_vector = []
+        for slot in top[np.argsort(-sims[top])]:
+            if sims[slot] <= 0:
+                break
+            doc_id = last - (last - int(slot)) % self.max_docs
+            if doc_id in index.docs:
+                by_vector.append(doc_id)
+        fused: dict[int, float] = {}
+        for ranking in (ranked, by_vector):
+            for rank, doc_id in enumerate(ranking):
+                fused[doc_id] = fused.get(doc_id, 0.0) + 1 / (RRF_K + rank)
+        return sorted(fused, key=fused.get, reverse=True)
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "chats": len(self._chats),
+                "docs": sum(len(i.docs) for i in self._chats.values()),
+                "terms": sum(len(i.postings) for i in self._chats.values()),
+                "queries": self.queries,
+                "truncated": self.truncated,
+            }
+
+
+def format_hits(hits: list[dict], tz=None) -> list[str]:
+    lines = []
+    for row in hits:
+        ts = datetime.fromisoformat(row["ts"])
+        if tz is not None:
+            ts = ts.astimezone(tz)
+        lines.append(f"[{ts:%d.%m %H:%M}] {row['user']}: {row['text']}")
+    return lines
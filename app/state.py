@@ -0,0 +1,254 @@
+import asyncio
+import json
+import time
+
+import storage
+from limits import TokenBuckets
+from rows import Row
+
+# State that has to agree across bot replicas: cooldowns and throttle
+# buckets, the chat registry and the recent-message context used in prompts. MemoryState keeps
+# everything in this process (one replica); RedisState shares it through any
+# Redis-protocol server. The message log itself stays in storage.py.
+
+
+class MemoryState:
+    name = "memory"
+
+    def __init__(self):
+        self._cooldowns: dict[str, float] = {}
+        self._buckets = TokenBuckets()
+
+    async def cooldown(self, key: str, seconds: float) -> float:
+        # Starts the cooldown and returns 0, or returns the seconds left.
+        now = time.monotonic()
+        until = self._cooldowns.get(key, 0.0)
+        if until > now:
+            return until - now
+        self._cooldowns[key] = now + seconds
+        return 0.0
+
+    async def take(self, buckets: list[tuple[str, float, float]]) -> tuple[float, int]:
+        # Spends a token from every (key, burst, period) bucket or from none;
+        # returns (0, -1) or the seconds left and the bucket that is empty.
+        return self._buckets.take(buckets)
+
+    async def is_bound(self, chat_id: int) -> bool:
+        # Bound chats are answered from memory; only an unknown chat makes the
+        # registry check its version, which may query the database.
+        if storage.is_bound_loaded(chat_id):
+            return True
+        return await asyncio.to_thread(storage.is_bound, chat_id)
+
+    async def bind_chat(self, chat_id: int, title: str | None) -> None:
+        await asyncio.to_thread(storage.bind_chat, chat_id, title)
+
+    async def chats(self) -> dict:
+        return await asyncio.to_thread(storage.load_chats)
+
+    async def chat_settings(self, chat_id: int) -> dict:
+        return (await asyncio.to_thread(storage.chat_meta, chat_id) or {}).get("settings", {})
+
+    async def update_chat_settings(self, chat_id: int, changes: dict | None) -> dict:
+        # Merges `changes` into the stored overrides; None clears them.
+        return await asyncio.to_thread(storage.merge_chat_settings, chat_id, changes)
+
+    async def import_chats(self, chats: dict) -> int:
+        return 0
+
+    async def push_recent(self, chat_id: int, row: Row) -> None:
+        # storage.log_message already put the row into the local cache.
+        pass
+
+    async def recent(self, chat_id: int, n: int) -> list[Row]:
+        # A cache miss flushes the writer and reads the log from disk.
+        return await asyncio.to_thread(storage.read_last_n, chat_id, n)
+
+    async def aclose(self) -> None:
+        pass
+
+
+# Token buckets kept in hashes, one per key, with ARGV = now, then burst and
+# period for each key. Tokens are spent from all of them or from none; atomic
+# because scripts run one at a time. Returns the wait as a string (Lua numbers
+# are truncated to integers in Redis replies) and the 0-based index of the
+# bucket that is empty, or -1.
+TAKE_SCRIPT = """
+local now = tonumber(ARGV[1])
+local levels = {}
+local wait = 0
+local index = -1
+for i, key in ipairs(KEYS) do
+    local burst = tonumber(ARGV[2 * i])
+    local rate = burst / tonumber(ARGV[2 * i + 1])
+    local state = redis.call('HMGET', key, 'tokens', 'ts')
+    local tokens = tonumber(state[1]) or burst
+    local ts = tonumber(state[2]) or now
+    tokens = math.min(burst, tokens + math.max(0, now - ts) * rate)
+    levels[i] = tokens
+    if tokens < 1 and (1 - tokens) / rate > wait then
+        wait = (1 - tokens) / rate
+        index = i - 1
+    end
+end
+local spend = 0
+if index < 0 then
+    spend = 1
+end
+for i, key in ipairs(KEYS) do
+    redis.call('HSET', key, 'tokens', levels[i] - spend, 'ts', now)
+    redis.call('PEXPIRE', key, math.ceil(tonumber(ARGV[2 * i + 1]) * 1000))
+end
+return {tostring(wait), index}
+"""
+
+
+# Merges ARGV[2] (JSON changes, "" to clear) into the "settings" of chat
+# ARGV[1] in the chats hash; ARGV[3] is the meta to start from when the chat
+# is not there yet. Returns the new settings as JSON; no overrides are
+# stored as no "settings" key.
+SETTINGS_SCRIPT = """
+local meta = cjson.decode(redis.call('HGET', KEYS[1], ARGV[1]) or ARGV[3])
+local settings = {}
+if ARGV[2] ~= '' then
+    if type(meta['settings']) == 'table' then
+        settings = meta['settings']
+    end
+    for key, value in pairs(cjson.decode(ARGV[2])) do
+        settings[key] = value
+    end
+end
+-- An empty table may encode as [] instead of {}: store none at all.
+if next(settings) == nil then
+    meta['settings'] = nil
+    redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(meta))
+    return '{}'
+end
+meta['settings'] = settings
+redis.call('HSET', KEYS[1], ARGV[1], cjson.encode(meta))
+return cjson.encode(settings)
+"""
+
+
+class RedisState:
+    # `client` is a redis.asyncio.Redis or anything speaking the same API
+    # (e.g. fakeredis for tests). Keys:
+    #   <prefix>cooldown:<key>   string with a TTL
+    #   <prefix>bucket:<key>     hash of tokens/ts, updated by TAKE_SCRIPT
+    #   <prefix>chats            hash chat_id -> JSON meta
+    #   <prefix>recent:<chat_id> list of JSON rows, newest last
+    name = "redis"
+
+    def __init__(self, client, prefix: str = "porfiriy:", recent_depth: int = 50):
+        self.client = client
+        self.prefix = prefix
+        self.recent_depth = max(1, recent_depth)
+        # Chats are never unbound, so a positive answer can be kept locally.
+        self._bound: set[int] = set()
+        self._take = client.register_script(TAKE_SCRIPT)
+        self._merge_settings = client.register_script(SETTINGS_SCRIPT)
+
+    def _key(self, *parts) -> str:
+        return self.prefix + ":".join(str(p) for p in parts)
+
+    async def cooldown(self, key: str, seconds: float) -> float:
+        if seconds <= 0:
+            return 0.0
+        k = self._key("cooldown", key)
+        if await self.client.set(k, "1", nx=True, px=max(1, int(seconds * 1000))):
+            return 0.0
+        ttl_ms = await self.client.pttl(k)
+        return max(0, ttl_ms) / 1000
+
+    async def take(self, buckets: list[tuple[str, float, float]]) -> tuple[float, int]:
+        if not buckets:
+            return 0.0, -1
+        args = [time.time()]
+        for _, burst, period in buckets:
+            args += [burst, period]
+        wait, index = await self._take(keys=[self._key("bucket", key) for key, _, _ in buckets], args=args)
+        return float(_text(wait)), int(index)
+
+    async def is_bound(self, chat_id: int) -> bool:
+        if chat_id in self._bound:
+            return True
+        if await self.client.hexists(self._key("chats"), str(chat_id)):
+            self._bound.add(chat_id)
+            return True
+        return False
+
+    async def bind_chat(self, chat_id: int, title: str | None) -> None:
+        # Keep the local registry in step so the files stay a usable backup.
+        await asyncio.to_thread(storage.bind_chat, chat_id, title)
+        meta = await asyncio.to_thread(storage.chat_meta, chat_id) or {"title": title}
+        await self.client.hset(self._key("chats"), str(chat_id), json.dumps(meta, ensure_ascii=False))
+        self._bound.add(chat_id)
+
+    async def chats(self) -> dict:
+        raw = await self.client.hgetall(self._key("chats"))
+        return {_text(k): json.loads(v) for k, v in raw.items()}
+
+    async def chat_settings(self, chat_id: int) -> dict:
+        raw = await self.client.hget(self._key("chats"), str(chat_id))
+        return json.loads(raw).get("settings", {}) if raw else {}
+
+    async def update_chat_settings(self, chat_id: int, changes: dict | None) -> dict:
+        # The merge runs in SETTINGS_SCRIPT so concurrent changes from any
+        # replica do not overwrite each other. The local meta only seeds a
+        # chat the shared registry does not have yet.
+        local = await asyncio.to_thread(storage.chat_meta, chat_id) or {}
+        raw = await self._merge_settings(
+            keys=[self._key("chats")],
+            args=[
+                str(chat_id),
+                json.dumps(changes, ensure_ascii=False) if changes is not None else "",
+                json.dumps(local, ensure_ascii=False),
+            ],
+        )
+        settings = json.loads(raw)
+        await asyncio.to_thread(storage.update_chat_meta, chat_id, {"settings": settings})
+        return settings
+
+    async def import_chats(self, chats: dict) -> int:
+        # Seeds the shared registry from a replica's local one without
+        # overwriting chats that are already there.
+        if not chats:
+            return 0
+        pipe = self.client.pipeline(transaction=False)
+        for chat_id, meta in chats.items():
+            pipe.hsetnx(self._key("chats"), str(chat_id), json.dumps(meta, ensure_ascii=False))
+        return sum(1 for added in await pipe.execute() if added)
+
+    async def push_recent(self, chat_id: int, row: Row) -> None:
+        k = self._key("recent", chat_id)
+        pipe = self.client.pipeline(transaction=False)
+        pipe.rpush(k, row.to_json())
+        pipe.ltrim(k, -self.recent_depth, -1)
+        await pipe.execute()
+
+    async def recent(self, chat_id: int, n: int) -> list[Row]:
+        if n <= 0:
+            return []
+        rows = [Row.from_json(r) for r in await self.client.lrange(self._key("recent", chat_id), -n, -1)]
+        if len(rows) >= n:
+            return rows
+        # Shared list is still short (fresh Redis): the local log may know more.
+        local = await asyncio.to_thread(storage.read_last_n, chat_id, n)
+        return local if len(local) > len(rows) else rows
+
+    async def aclose(self) -> None:
+        await self.client.aclose()
+
+
+def _text(value) -> str:
+    return value.decode() if isinstance(value, bytes) else value
+
+
+def make_state(backend: str, redis_url: str = "", prefix: str = "porfiriy:", recent_depth: int = 50):
+    if backend == "redis":
+        try:
+            import redis.asyncio as redis
+        except ImportError as e:
+            raise RuntimeError("STATE_BACKEND=redis needs the redis package (pip install redis)") from e
+        return RedisState(redis.from_url(redis_url), prefix, recent_depth)
+    return MemoryState()
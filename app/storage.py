@@ -1,69 +1,828 @@
+import gzip
 import json
+import logging
+import os
+import queue
+import shutil
+import struct
+import threading
+import time
+from collections import OrderedDict, deque
+from contextlib import ExitStack, contextmanager
 from pathlib import Path
-from datetime import datetime, timezone
+from typing import Iterator
+from datetime import datetime, timedelta, timezone, tzinfo
 
-DATA = Path(__file__).resolve().parent.parent / "data"
-DATA.mkdir(exist_ok=True)
+from config import (
+    DATA_DIR,
+    LOG_FLUSH_BATCH,
+    LOG_FLUSH_SECONDS,
+    RECENT_CACHE_DEPTH,
+    RECENT_CACHE_MAX_BYTES,
+    SEARCH_INDEX_DOCS,
+    SEARCH_VECTORS,
+    SQLITE_PATH,
+    STORAGE_BACKEND,
+)
+from aggregate import DailyAggregator
+from rows import Row, ts_key
+from search_index import SearchIndex
+from metrics import REGISTRY, STORAGE_SECONDS
+
+logger = logging.getLogger("porfiriy.storage")
+
+DATA = DATA_DIR
+DATA.mkdir(parents=True, exist_ok=True)
 CHATS_FILE = DATA / "chats.json"
+# Legacy single-file log, split into per-chat segments by migrate_legacy_log().
 LOG_FILE = DATA / "messages.jsonl"
+MESSAGES_DIR = DATA / "messages"
+MESSAGES_DIR.mkdir(exist_ok=True)
+
+# Each segment data/messages/<chat_id>/<YYYY-MM-DD>.jsonl has a sidecar .idx
+# with the byte offset of every line start, packed as little-endian uint64.
+_OFFSET = struct.Struct("<Q")
+# Reads stream segments in chunks and scan tails backwards in blocks, so a
+# read holds the rows it returns rather than the whole file.
+_READ_CHUNK = 1 << 20
+_TAIL_BLOCK = 64 << 10
+# Serializes appends with segment compression so no row lands in a segment
+# that is being archived.
+_segment_lock = threading.Lock()
+
+
+# ---------------------------------------------------------------------------
+# Реестр привязанных чатов
+# ---------------------------------------------------------------------------
+
+class ChatRegistry:
+    # In-memory view of the chat bindings kept by the storage engine. The
+    # engine is asked for a cheap version stamp (file mtime, a counter row)
+    # at most once per RELOAD_CHECK_SECONDS and bindings are re-read only
+    # when it changes, so is_bound() is a dict lookup.
+
+    RELOAD_CHECK_SECONDS = 1.0
+
+    def __init__(self, engine):
+        self.engine = engine
+        self._chats: dict[str, dict] = {}
+        self._version = None
+        self._checked_at = float("-inf")
+        self._lock = threading.Lock()
+
+    def _refresh(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not force and now - self._checked_at < self.RELOAD_CHECK_SECONDS:
+            return
+        self._checked_at = now
+        version = self.engine.chats_version()
+        if force or version != self._version:
+            self._chats = self.engine.load_chats()
+            self._version = version
+
+    def all(self) -> dict:
+        with self._lock:
+            self._refresh()
+            return {cid: dict(meta) for cid, meta in self._chats.items()}
+
+    def contains(self, chat_id: int) -> bool:
+        with self._lock:
+            self._refresh()
+            return str(chat_id) in self._chats
+
+    def loaded(self, chat_id: int) -> bool:
+        # Whether the last loaded view has the chat: no version check, so no
+        # I/O and no lock (_chats is only ever replaced whole).
+        return str(chat_id) in self._chats
+
+    def replace(self, chats: dict) -> None:
+        with self._lock:
+            self.engine.save_chats(dict(chats))
+            self._refresh(force=True)
+
+    def get(self, chat_id: int) -> dict | None:
+        with self._lock:
+            self._refresh()
+            meta = self._chats.get(str(chat_id))
+            return dict(meta) if meta is not None else None
+
+    def update(self, chat_id: int, meta: dict) -> None:
+        # Replaces the given top-level keys of a bound chat's entry.
+        with self._lock:
+            self.engine.upsert_chat(chat_id, meta)
+            self._refresh(force=True)
+
+    def merge_settings(self, chat_id: int, changes: dict | None) -> dict:
+        # Read-modify-write of the chat's "settings" under the lock, so two
+        # changes at once cannot drop each other; None clears them.
+        with self._lock:
+            self._refresh(force=True)
+            current = (self._chats.get(str(chat_id)) or {}).get("settings", {})
+            settings = {**current, **changes} if changes is not None else {}
+            self.engine.upsert_chat(chat_id, {"settings": settings})
+            self._refresh(force=True)
+            return settings
+
+    def bind(self, chat_id: int, title: str | None) -> None:
+        with self._lock:
+            meta = {"title": title or str(chat_id), "bound_at": datetime.now(timezone.utc).isoformat()}
+            self.engine.upsert_chat(chat_id, meta)
+            self._refresh(force=True)
 
 
 def load_chats() -> dict:
-    if not CHATS_FILE.exists():
-        return {}
-    return json.loads(CHATS_FILE.read_text(encoding="utf-8"))
+    return _registry.all()
 
 
 def save_chats(chats: dict) -> None:
-    CHATS_FILE.write_text(json.dumps(chats, ensure_ascii=False, indent=2), encoding="utf-8")
+    _registry.replace(chats)
 
 
 def bind_chat(chat_id: int, title: str | None) -> None:
-    chats = load_chats()
-    chats[str(chat_id)] = {"title": title or str(chat_id), "bound_at": datetime.now(timezone.utc).isoformat()}
-    save_chats(chats)
+    _registry.bind(chat_id, title)
+
+
+def chat_meta(chat_id: int) -> dict | None:
+    return _registry.get(chat_id)
+
+
+def update_chat_meta(chat_id: int, meta: dict) -> None:
+    _registry.update(chat_id, meta)
+
+
+def merge_chat_settings(chat_id: int, changes: dict | None) -> dict:
+    return _registry.merge_settings(chat_id, changes)
 
 
 def is_bound(chat_id: int) -> bool:
-    return str(chat_id) in load_chats()
+    return _registry.contains(chat_id)
 
 
-def log_message(chat_id: int, user: str, text: str) -> None:
-    row = {
-        "ts": datetime.now(timezone.utc).isoformat(),
-        "chat_id": chat_id,
-        "user": user,
-        "text": text[:2000],
-    }
-    with LOG_FILE.open("a", encoding="utf-8") as f:
-        f.write(json.dumps(row, ensure_ascii=False) + "\n")
+def is_bound_loaded(chat_id: int) -> bool:
+    # Chats are never unbound, so a True here is final; False needs is_bound.
+    return _registry.loaded(chat_id)
 
 
-def read_last_n(chat_id: int, n: int = 10) -> list[dict]:
-    if not LOG_FILE.exists():
+# ---------------------------------------------------------------------------
+# Сегменты лога: по файлу на чат и UTC-день + индекс смещений строк
+# ---------------------------------------------------------------------------
+
+def _chat_dir(chat_id: int) -> Path:
+    return MESSAGES_DIR / str(chat_id)
+
+
+def _segment_path(chat_id: int, day: str) -> Path:
+    return _chat_dir(chat_id) / f"{day}.jsonl"
+
+
+def _index_path(segment: Path) -> Path:
+    return segment.with_suffix(".idx")
+
+
+def _archive_path(chat_id: int, day: str) -> Path:
+    return _chat_dir(chat_id) / f"{day}.jsonl.gz"
+
+
+def _segment_days(chat_id: int) -> list[str]:
+    # Days with a live segment, a compressed one, or both (a late row for an
+    # already compressed day lands in a fresh .jsonl next to the .gz).
+    chat_dir = _chat_dir(chat_id)
+    if not chat_dir.is_dir():
         return []
-    out = []
-    for line in LOG_FILE.read_text(encoding="utf-8").splitlines():
-        if not line.strip():
-            continue
-        row = json.loads(line)
-        if row.get("chat_id") == chat_id:
-            out.append(row)
-    return out[-n:]
+    days = {p.name.split(".", 1)[0] for p in chat_dir.glob("*.jsonl")}
+    days.update(p.name.split(".", 1)[0] for p in chat_dir.glob("*.jsonl.gz"))
+    return sorted(days)
 
 
-def read_last_24h(chat_id: int) -> list[dict]:
-    if not LOG_FILE.exists():
+def _iter_archive(f) -> Iterator[Row]:
+    with gzip.GzipFile(fileobj=f, mode="rb") as gz:
+        for line in gz:
+            if line.strip():
+                yield Row.from_json(line)
+
+
+def _append_rows(chat_id: int, day: str, rows: list[dict]) -> None:
+    segment = _segment_path(chat_id, day)
+    segment.parent.mkdir(parents=True, exist_ok=True)
+    lines = [(json.dumps(dict(row), ensure_ascii=False) + "\n").encode("utf-8") for row in rows]
+    offsets = bytearray()
+    payload = bytearray()
+    with _segment_lock:
+        with segment.open("ab") as f:
+            pos = f.tell()
+            for line in lines:
+                offsets += _OFFSET.pack(pos + len(payload))
+                payload += line
+            f.write(payload)
+        # The index is written after the data: if we crash in between, readers
+        # still pick up the unindexed tail because they read to EOF.
+        with _index_path(segment).open("ab") as f:
+            f.write(offsets)
+
+
+def _read_index(segment: Path) -> bytes:
+    idx = _index_path(segment)
+    if not idx.exists():
+        return b""
+    raw = idx.read_bytes()
+    return raw[:len(raw) - len(raw) % _OFFSET.size]
+
+
+def _iter_segment(f, offset: int = 0) -> Iterator[Row]:
+    # Rows from `offset` to EOF, read in fixed-size chunks: memory stays at
+    # one chunk however big the segment is.
+    f.seek(offset)
+    tail = b""
+    while chunk := f.read(_READ_CHUNK):
+        buf = tail + chunk
+        end = buf.rfind(b"\n") + 1
+        tail = buf[end:]
+        # Decoded a chunk at a time: cut at a newline, never mid-character.
+        for line in buf[:end].decode("utf-8").split("\n"):
+            if line.strip():
+                yield Row.from_json(line)
+    if tail.strip():
+        yield Row.from_json(tail)
+
+
+def _tail_segment(f, n: int) -> list[Row]:
+    # Last `n` rows, scanning blocks backwards from EOF until they hold n
+    # complete lines.
+    pos = f.seek(0, os.SEEK_END)
+    blocks: list[bytes] = []
+    newlines = 0
+    while pos > 0 and newlines <= n:
+        step = min(_TAIL_BLOCK, pos)
+        pos -= step
+        f.seek(pos)
+        blocks.append(f.read(step))
+        newlines += blocks[-1].count(b"\n")
+    # "replace": the first block may start mid-character, in a line dropped below.
+    lines = [line for line in b"".join(reversed(blocks)).decode("utf-8", "replace").split("\n") if line.strip()]
+    if pos > 0:
+        # The first block starts mid-line.
+        lines = lines[1:]
+    return [Row.from_json(line) for line in lines[-n:]]
+
+
+def _row_at(f, offset: int) -> Row:
+    f.seek(offset)
+    return Row.from_json(f.readline())
+
+
+def _first_offset_since(f, index: bytes, since: str) -> int:
+    # Rows are appended in time order, so bisect the index on "ts" and read
+    # one line per probe instead of parsing the whole segment.
+    lo, hi = 0, len(index) // _OFFSET.size
+    while lo < hi:
+        mid = (lo + hi) // 2
+        if _row_at(f, _OFFSET.unpack_from(index, mid * _OFFSET.size)[0]).ts < since:
+            lo = mid + 1
+        else:
+            hi = mid
+    count = len(index) // _OFFSET.size
+    if lo == count:
+        # Everything indexed is older; an unindexed tail may still follow.
+        lo = count - 1
+    return _OFFSET.unpack_from(index, lo * _OFFSET.size)[0] if count else 0
+
+
+def _open_if_exists(path: Path):
+    try:
+        return path.open("rb")
+    except FileNotFoundError:
+        return None
+
+
+@contextmanager
+def _open_day(chat_id: int, day: str):
+    # (archive, segment, index) of a day, opened together under _segment_lock.
+    # Compression folds the segment into the archive and unlinks it under the
+    # same lock, and open files keep their data, so a reader sees the day
+    # either before or after that, never half of it. Missing files are None.
+    with ExitStack() as stack:
+        with _segment_lock:
+            archive = _open_if_exists(_archive_path(chat_id, day))
+            if archive is not None:
+                stack.enter_context(archive)
+            segment = _open_if_exists(_segment_path(chat_id, day))
+            if segment is not None:
+                stack.enter_context(segment)
+            index = _read_index(_segment_path(chat_id, day)) if segment is not None else b""
+        yield archive, segment, index
+
+
+def _read_last_n_disk(chat_id: int, n: int) -> list[Row]:
+    if n <= 0:
         return []
+    out: list[Row] = []
+    for day in reversed(_segment_days(chat_id)):
+        need = n - len(out)
+        with _open_day(chat_id, day) as (archive, segment, _):
+            rows = _tail_segment(segment, need) if segment is not None else []
+            if len(rows) < need and archive is not None:
+                rows = list(deque(_iter_archive(archive), maxlen=need - len(rows))) + rows
+        out = rows + out
+        if len(out) >= n:
+            break
+    return out
+
+
+def _iter_since_disk(chat_id: int, since: datetime) -> Iterator[Row]:
+    now = datetime.now(timezone.utc)
+    key = ts_key(since)
+    days = [d for d in _segment_days(chat_id) if d >= key[:10] and d <= now.date().isoformat()]
+    for day in days:
+        with _open_day(chat_id, day) as (archive, segment, index):
+            if archive is not None:
+                yield from (r for r in _iter_archive(archive) if r.ts >= key)
+            if segment is not None:
+                start = _first_offset_since(segment, index, key) if index else 0
+                yield from (r for r in _iter_segment(segment, start) if r.ts >= key)
+
+
+class FileEngine:
+    # Default engine: chats.json plus per-chat day segments on disk.
+
+    name = "files"
+
+    def chats_version(self) -> int | None:
+        try:
+            return CHATS_FILE.stat().st_mtime_ns
+        except FileNotFoundError:
+            return None
+
+    def load_chats(self) -> dict:
+        if not CHATS_FILE.exists():
+            return {}
+        return json.loads(CHATS_FILE.read_text(encoding="utf-8"))
+
+    def save_chats(self, chats: dict) -> None:
+        tmp = CHATS_FILE.with_name(f"{CHATS_FILE.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        tmp.write_text(json.dumps(chats, ensure_ascii=False, indent=2), encoding="utf-8")
+        os.replace(tmp, CHATS_FILE)
+
+    def upsert_chat(self, chat_id: int, meta: dict) -> None:
+        # Re-read right before writing so a bind from another process that
+        # landed since the last check is not overwritten.
+        chats = self.load_chats()
+        chats[str(chat_id)] = {**chats.get(str(chat_id), {}), **meta}
+        self.save_chats(chats)
+
+    def append_rows(self, rows: list[dict]) -> None:
+        groups: dict[tuple[int, str], list[dict]] = {}
+        for row in rows:
+            groups.setdefault((row["chat_id"], row["ts"][:10]), []).append(row)
+        for (chat_id, day), items in groups.items():
+            _append_rows(chat_id, day, items)
+
+    def read_last_n(self, chat_id: int, n: int) -> list[Row]:
+        return _read_last_n_disk(chat_id, n)
+
+    def read_since(self, chat_id: int, since: datetime) -> list[Row]:
+        return list(_iter_since_disk(chat_id, since))
+
+    def maintain(self, compress_after_days: int, retention_days: int, retention_by_chat: dict[int, int]) -> dict:
+        return _maintain_segments(compress_after_days, retention_days, retention_by_chat)
+
+
+def _make_engine():
+    if STORAGE_BACKEND == "sqlite":
+        from storage_sqlite import SqliteEngine
+
+        return SqliteEngine(SQLITE_PATH)
+    return FileEngine()
+
+
+_engine = _make_engine()
+_registry = ChatRegistry(_engine)
+
+
+# ---------------------------------------------------------------------------
+# Кэш последних сообщений в памяти
+# ---------------------------------------------------------------------------
+
+class RecentCache:
+    # Per-chat deques of the newest rows, LRU-evicted by chat once the
+    # approximate total size exceeds max_bytes. A chat is only cached after
+    # a full load from disk, so appends never leave gaps in the window.
+    # Rows appended while a load is reading the disk are collected for that
+    # load (begin_load) and merged into the window it installs.
+
+    ROW_OVERHEAD = 140
+
+    def __init__(self, depth: int, max_bytes: int):
+        self.depth = depth
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._chats: OrderedDict[int, deque] = OrderedDict()
+        self._complete: set[int] = set()
+        self._loading: dict[int, list[list[Row]]] = {}
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    @classmethod
+    def _row_size(cls, row: Row) -> int:
+        return cls.ROW_OVERHEAD + len(row.user) + len(row.text)
+
+    def _drop(self, chat_id: int) -> None:
+        rows = self._chats.pop(chat_id)
+        self._complete.discard(chat_id)
+        self._bytes -= sum(self._row_size(r) for r in rows)
+
+    def _trim(self) -> None:
+        while self._bytes > self.max_bytes and len(self._chats) > 1:
+            self._drop(next(iter(self._chats)))
+
+    def begin_load(self, chat_id: int) -> list[Row]:
+        # Call before flushing the writer; pass the result to load() or
+        # end_load().
+        pending: list[Row] = []
+        with self._lock:
+            self._loading.setdefault(chat_id, []).append(pending)
+        return pending
+
+    def end_load(self, chat_id: int, pending: list[Row]) -> None:
+        with self._lock:
+            self._end_load(chat_id, pending)
+
+    def _end_load(self, chat_id: int, pending: list[Row]) -> None:
+        loads = self._loading.get(chat_id, [])
+        if any(p is pending for p in loads):
+            loads[:] = [p for p in loads if p is not pending]
+            if not loads:
+                del self._loading[chat_id]
+
+    def load(self, chat_id: int, rows: list[Row], complete: bool, pending: list[Row] | None = None) -> list[Row]:
+        # Returns `rows` plus whatever was logged during the read and had not
+        # reached the disk yet (rows go to the writer in time order).
+        with self._lock:
+            if pending is not None:
+                self._end_load(chat_id, pending)
+                last = rows[-1].ts if rows else ""
+                rows = rows + [r for r in pending if r.ts > last]
+            if self.depth <= 0:
+                return rows
+            if chat_id in self._chats:
+                self._drop(chat_id)
+            window = deque(rows[-self.depth:], maxlen=self.depth)
+            self._chats[chat_id] = window
+            self._bytes += sum(self._row_size(r) for r in window)
+            if complete and len(rows) <= self.depth:
+                self._complete.add(chat_id)
+            self._trim()
+            return rows
+
+    def append(self, chat_id: int, row: Row) -> None:
+        with self._lock:
+            for pending in self._loading.get(chat_id, ()):
+                pending.append(row)
+            window = self._chats.get(chat_id)
+            if window is None:
+                return
+            if len(window) == window.maxlen:
+                self._bytes -= self._row_size(window[0])
+                self._complete.discard(chat_id)
+            window.append(row)
+            self._bytes += self._row_size(row)
+            self._chats.move_to_end(chat_id)
+            self._trim()
+
+    def get(self, chat_id: int, n: int) -> list[Row] | None:
+        with self._lock:
+            window = self._chats.get(chat_id)
+            if window is None or (n > len(window) and chat_id not in self._complete):
+                self.misses += 1
+                return None
+            self.hits += 1
+            self._chats.move_to_end(chat_id)
+            return list(window)[-n:]
+
+
+_recent = RecentCache(RECENT_CACHE_DEPTH, RECENT_CACHE_MAX_BYTES)
+
+
+# ---------------------------------------------------------------------------
+# Фоновая запись лога пачками
+# ---------------------------------------------------------------------------
+
+class LogWriter:
+    # Write-behind queue for log rows. A daemon thread drains it and hands
+    # rows to the storage engine in batches once batch_size rows are pending or
+    # flush_seconds have passed since the first pending row.
+
+    _STOP = object()
+
+    def __init__(self, batch_size: int, flush_seconds: float):
+        self.batch_size = max(1, batch_size)
+        self.flush_seconds = flush_seconds
+        self.rows_written = 0
+        self.flushes = 0
+        self.errors = 0
+        self.last_flush_ms = 0.0
+        self.max_flush_ms = 0.0
+        self._queue: queue.Queue = queue.Queue()
+        self._thread: threading.Thread | None = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self) -> None:
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="log-writer", daemon=True)
+                self._thread.start()
+
+    def submit(self, row: Row) -> None:
+        self._ensure_started()
+        self._queue.put(row)
+
+    def flush(self) -> None:
+        # Blocks until every row submitted before the call is on disk.
+        if self._thread is None or not self._thread.is_alive():
+            return
+        done = threading.Event()
+        self._queue.put(done)
+        done.wait()
+
+    def close(self) -> None:
+        if self._thread is None:
+            return
+        self._queue.put(self._STOP)
+        self._thread.join()
+        self._thread = None
+
+    def stats(self) -> dict:
+        return {
+            "queue_depth": self._queue.qsize(),
+            "rows_written": self.rows_written,
+            "flushes": self.flushes,
+            "errors": self.errors,
+            "last_flush_ms": round(self.last_flush_ms, 2),
+            "max_flush_ms": round(self.max_flush_ms, 2),
+        }
+
+    def _write(self, batch: list[Row]) -> None:
+        if not batch:
+            return
+        started = time.perf_counter()
+        try:
+            _engine.append_rows(batch)
+            self.rows_written += len(batch)
+        except Exception:
+            self.errors += 1
+            logger.exception("Failed to write %s log rows", len(batch))
+        elapsed = time.perf_counter() - started
+        STORAGE_SECONDS.observe(elapsed, op="flush")
+        elapsed_ms = elapsed * 1000
+        self.flushes += 1
+        self.last_flush_ms = elapsed_ms
+        self.max_flush_ms = max(self.max_flush_ms, elapsed_ms)
+
+    def _run(self) -> None:
+        batch: list[Row] = []
+        deadline = None
+        while True:
+            timeout = None if deadline is None else max(0.0, deadline - time.monotonic())
+            try:
+                item = self._queue.get(timeout=timeout)
+            except queue.Empty:
+                item = None
+            if isinstance(item, Row):
+                batch.append(item)
+                if deadline is None:
+                    deadline = time.monotonic() + self.flush_seconds
+                if len(batch) < self.batch_size:
+                    continue
+            self._write(batch)
+            batch, deadline = [], None
+            if isinstance(item, threading.Event):
+                item.set()
+            elif item is self._STOP:
+                return
+
+
+_writer = LogWriter(LOG_FLUSH_BATCH, LOG_FLUSH_SECONDS)
+
+REGISTRY.gauge("porfiriy_log_queue_depth", "log rows waiting for the background writer", lambda: _writer._queue.qsize())
+REGISTRY.gauge("porfiriy_log_rows_written", "log rows written since start", lambda: _writer.rows_written)
+REGISTRY.gauge(
+    "porfiriy_recent_cache_lookups",
+    "recent-messages cache lookups since start",
+    lambda: [({"result": "hit"}, _recent.hits), ({"result": "miss"}, _recent.misses)],
+)
+REGISTRY.gauge("porfiriy_recent_cache_bytes", "approximate size of the recent-messages cache", lambda: _recent._bytes)
+
+
+def flush_log() -> None:
+    _writer.flush()
+
+
+def close_storage() -> None:
+    save_aggregates()
+    _writer.close()
+
+
+def log_writer_stats() -> dict:
+    return _writer.stats()
+
+
+def warm_recent_cache(chat_ids) -> None:
+    for chat_id in chat_ids:
+        rows = _engine.read_last_n(chat_id, _recent.depth)
+        _recent.load(chat_id, rows, complete=len(rows) < _recent.depth)
+
+
+def log_message(chat_id: int, user: str, text: str, reply_to: dict | None = None) -> Row:
+    # `reply_to` ({"id", "user", "text"} of the answered message) only feeds
+    # the daily aggregates; the log row itself is unchanged. The row is also
+    # added to the chat's search index.
     now = datetime.now(timezone.utc)
-    out = []
-    for line in LOG_FILE.read_text(encoding="utf-8").splitlines():
-        if not line.strip():
+    row = Row(now.isoformat(), chat_id, user, text[:2000])
+    with STORAGE_SECONDS.time(op="log_message"):
+        _recent.append(chat_id, row)
+        _writer.submit(row)
+        _aggregates.add(chat_id, now, user, row.text, reply_to)
+        _search.add(chat_id, row.ts, user, row.text)
+    return row
+
+
+def read_last_n(chat_id: int, n: int = 10) -> list[Row]:
+    if n <= 0:
+        return []
+    with STORAGE_SECONDS.time(op="read_last_n") as labels:
+        cached = _recent.get(chat_id, n)
+        if cached is not None:
+            labels["source"] = "cache"
+            return cached
+        labels["source"] = "disk"
+        want = max(n, _recent.depth)
+        # Runs in a worker thread while the loop keeps logging to this chat.
+        pending = _recent.begin_load(chat_id)
+        try:
+            _writer.flush()
+            rows = _engine.read_last_n(chat_id, want)
+        except BaseException:
+            _recent.end_load(chat_id, pending)
+            raise
+        return _recent.load(chat_id, rows, complete=len(rows) < want, pending=pending)[-n:]
+
+
+def read_last_24h(chat_id: int) -> list[Row]:
+    with STORAGE_SECONDS.time(op="read_last_24h"):
+        return _read_last_24h(chat_id)
+
+
+def _read_last_24h(chat_id: int) -> list[Row]:
+    _writer.flush()
+    return _engine.read_since(chat_id, datetime.now(timezone.utc) - timedelta(hours=24))
+
+
+# ---------------------------------------------------------------------------
+# Агрегаты для дайджестов
+# ---------------------------------------------------------------------------
+
+_aggregates = DailyAggregator(DATA / "aggregates.json", keep_hours=48)
+
+
+def chat_stats(chat_id: int, hours: int = 24, tz: tzinfo = timezone.utc) -> dict:
+    return _aggregates.snapshot(chat_id, hours, tz=tz)
+
+
+def save_aggregates() -> None:
+    _aggregates.save()
+
+
+def rebuild_aggregates(chat_ids) -> int:
+    # Fills chats that have no aggregates yet (first start, lost file) from
+    # the last 24h of the log. Reply counts are not in the log and start at 0.
+    rebuilt = 0
+    for chat_id in chat_ids:
+        if _aggregates.has(chat_id):
+            continue
+        for row in _read_last_24h(chat_id):
+            _aggregates.add(chat_id, row.dt, row.user, row.text)
+        rebuilt += 1
+    return rebuilt
+
+
+# ---------------------------------------------------------------------------
+# Поиск по истории чата
+# ---------------------------------------------------------------------------
+
+_search = SearchIndex(SEARCH_INDEX_DOCS, vectors=SEARCH_VECTORS)
+REGISTRY.gauge(
+    "porfiriy_search_index",
+    "chat history search index: chats, docs, terms, queries, queries cut short by the time budget",
+    lambda: [({"stat": k}, v) for k, v in _search.stats().items()],
+)
+
+
+def search_history(chat_id: int, query: str, k: int = 3, budget_ms: float = 5, before: str | None = None) -> list[dict]:
+    with STORAGE_SECONDS.time(op="search"):
+        return _search.search(chat_id, query, k, budget_ms / 1000, before)
+
+
+def rebuild_search_index(chat_ids) -> int:
+    # The index lives in memory only; on start it is refilled from the last
+    # SEARCH_INDEX_DOCS messages of every chat.
+    docs = 0
+    for chat_id in chat_ids:
+        if _search.has(chat_id):
             continue
-        row = json.loads(line)
-        if row.get("chat_id") != chat_id:
+        _writer.flush()
+        for row in _engine.read_last_n(chat_id, _search.max_docs):
+            _search.add(chat_id, row.ts, row.user, row.text)
+            docs += 1
+    return docs
+
+
+def migrate_legacy_log(batch_size: int = 10000) -> int:
+    # One-shot import of the legacy messages.jsonl into the storage engine.
+    if not LOG_FILE.exists():
+        return 0
+    batch: list[dict] = []
+    total = 0
+    with LOG_FILE.open("r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            row = json.loads(line)
+            row["ts"] = datetime.fromisoformat(row["ts"]).astimezone(timezone.utc).isoformat()
+            batch.append(row)
+            total += 1
+            if len(batch) >= batch_size:
+                _engine.append_rows(batch)
+                batch = []
+    if batch:
+        _engine.append_rows(batch)
+    os.replace(LOG_FILE, LOG_FILE.with_name(LOG_FILE.name + ".migrated"))
+    return total
+
+
+# ---------------------------------------------------------------------------
+# Обслуживание лога: сжатие старых сегментов и срок хранения
+# ---------------------------------------------------------------------------
+
+def _compress_segment(chat_id: int, day: str) -> None:
+    segment = _segment_path(chat_id, day)
+    archive = _archive_path(chat_id, day)
+    tmp = archive.with_name(archive.name + ".tmp")
+    with _segment_lock:
+        with gzip.open(tmp, "wb") as out:
+            if archive.exists():
+                # A late row re-created the live segment; fold it into the archive.
+                with gzip.open(archive, "rb") as old:
+                    shutil.copyfileobj(old, out)
+            with segment.open("rb") as src:
+                shutil.copyfileobj(src, out)
+        os.replace(tmp, archive)
+        segment.unlink()
+        _index_path(segment).unlink(missing_ok=True)
+
+
+def _dir_bytes(path: Path) -> int:
+    return sum(p.stat().st_size for p in path.rglob("*") if p.is_file())
+
+
+def maintain_log(compress_after_days: int, retention_days: int, retention_by_chat: dict[int, int]) -> dict:
+    # Runs in a worker thread.
+    _writer.flush()
+    stats = _engine.maintain(compress_after_days, retention_days, retention_by_chat)
+    migrated = LOG_FILE.with_name(LOG_FILE.name + ".migrated")
+    if migrated.exists():
+        with migrated.open("rb") as src, gzip.open(migrated.with_name(migrated.name + ".gz"), "wb") as out:
+            shutil.copyfileobj(src, out)
+        migrated.unlink()
+    return stats
+
+
+def _maintain_segments(compress_after_days: int, retention_days: int, retention_by_chat: dict[int, int]) -> dict:
+    # Only segments at least compress_after_days
+    # old are touched, so the writer (which appends to today's segment) never
+    # races with compression; a late row for an old day simply starts a new
+    # .jsonl that the next run folds into the archive.
+    today = datetime.now(timezone.utc).date()
+    stats = {"compressed": 0, "deleted": 0, "bytes_before": _dir_bytes(MESSAGES_DIR)}
+    for chat_dir in MESSAGES_DIR.iterdir():
+        if not chat_dir.is_dir():
             continue
-        ts = datetime.fromisoformat(row["ts"])
-        if (now - ts).total_seconds() <= 86400:
-            out.append(row)
-    return out
+        try:
+            chat_id = int(chat_dir.name)
+        except ValueError:
+            continue
+        keep_days = retention_by_chat.get(chat_id, retention_days)
+        for day in _segment_days(chat_id):
+            age = (today - datetime.fromisoformat(day).date()).days
+            if keep_days > 0 and age > keep_days:
+                segment = _segment_path(chat_id, day)
+                with _segment_lock:
+                    for path in (segment, _index_path(segment), _archive_path(chat_id, day)):
+                        path.unlink(missing_ok=True)
+                stats["deleted"] += 1
+            elif age >= compress_after_days and _segment_path(chat_id, day).exists():
+                _compress_segment(chat_id, day)
+                stats["compressed"] += 1
+    stats["bytes_after"] = _dir_bytes(MESSAGES_DIR)
+    return stats
@@ -0,0 +1,195 @@
+import json
+import os
+import sqlite3
+import threading
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+from rows import Row, ts_key
+
+# SQLite engine for storage.py (STORAGE_BACKEND=sqlite). WAL mode lets the
+# log writer thread commit while other threads read; every thread gets its
+# own connection.
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS messages (
+    id INTEGER PRIMARY KEY,
+    chat_id INTEGER NOT NULL,
+    ts TEXT NOT NULL,
+    user TEXT NOT NULL,
+    text TEXT NOT NULL
+);
+CREATE INDEX IF NOT EXISTS messages_chat_ts ON messages (chat_id, ts);
+CREATE TABLE IF NOT EXISTS chats (
+    chat_id TEXT PRIMARY KEY,
+    meta TEXT NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    key TEXT PRIMARY KEY,
+    value INTEGER NOT NULL
+);
+INSERT OR IGNORE INTO meta (key, value) VALUES ('chats_version', 0);
+CREATE TRIGGER IF NOT EXISTS chats_ins AFTER INSERT ON chats
+    BEGIN UPDATE meta SET value = value + 1 WHERE key = 'chats_version'; END;
+CREATE TRIGGER IF NOT EXISTS chats_upd AFTER UPDATE ON chats
+    BEGIN UPDATE meta SET value = value + 1 WHERE key = 'chats_version'; END;
+CREATE TRIGGER IF NOT EXISTS chats_del AFTER DELETE ON chats
+    BEGIN UPDATE meta SET value = value + 1 WHERE key = 'chats_version'; END;
+"""
+
+
+class SqliteEngine:
+    name = "sqlite"
+
+    def __init__(self, path: Path):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as conn:
+            conn.executescript(SCHEMA)
+
+    def _conn(self) -> sqlite3.Connection:
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            conn = sqlite3.connect(self.path, timeout=30)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn = conn
+        return conn
+
+    # -- chats -------------------------------------------------------------
+
+    def chats_version(self) -> int:
+        return self._conn().execute("SELECT value FROM meta WHERE key = 'chats_version'").fetchone()[0]
+
+    def load_chats(self) -> dict:
+        rows = self._conn().execute("SELECT chat_id, meta FROM chats").fetchall()
+        return {chat_id: json.loads(meta) for chat_id, meta in rows}
+
+    def save_chats(self, chats: dict) -> None:
+        with self._conn() as conn:
+            conn.execute("DELETE FROM chats")
+            conn.executemany(
+                "INSERT INTO chats (chat_id, meta) VALUES (?, ?)",
+                [(str(cid), json.dumps(meta, ensure_ascii=False)) for cid, meta in chats.items()],
+            )
+
+    def upsert_chat(self, chat_id: int, meta: dict) -> None:
+        with self._conn() as conn:
+            row = conn.execute("SELECT meta FROM chats WHERE chat_id = ?", (str(chat_id),)).fetchone()
+            merged = {**(json.loads(row[0]) if row else {}), **meta}
+            conn.execute(
+                "INSERT INTO chats (chat_id, meta) VALUES (?, ?) "
+                "ON CONFLICT (chat_id) DO UPDATE SET meta = excluded.meta",
+                (str(chat_id), json.dumps(merged, ensure_ascii=False)),
+            )
+
+    # -- messages ----------------------------------------------------------
+
+    def append_rows(self, rows: list[dict]) -> None:
+        with self._conn() as conn:
+            conn.executemany(
+                "INSERT INTO messages (chat_id, ts, user, text) VALUES (?, ?, ?, ?)",
+                [(r["chat_id"], r["ts"], r["user"], r["text"]) for r in rows],
+            )
+
+    def read_last_n(self, chat_id: int, n: int) -> list[Row]:
+        if n <= 0:
+            return []
+        rows = self._conn().execute(
+            "SELECT chat_id, ts, user, text FROM messages WHERE chat_id = ? ORDER BY ts DESC, id DESC LIMIT ?",
+            (chat_id, n),
+        ).fetchall()
+        return [Row(ts, cid, user, text) for cid, ts, user, text in reversed(rows)]
+
+    def read_since(self, chat_id: int, since: datetime) -> list[Row]:
+        # Rows are built straight off the cursor, without a fetchall() copy.
+        cursor = self._conn().execute(
+            "SELECT chat_id, ts, user, text FROM messages WHERE chat_id = ? AND ts >= ? ORDER BY ts, id",
+            (chat_id, ts_key(since)),
+        )
+        return [Row(ts, cid, user, text) for cid, ts, user, text in cursor]
+
+    def _size(self) -> int:
+        total = 0
+        for suffix in ("", "-wal"):
+            try:
+                total += os.path.getsize(f"{self.path}{suffix}")
+            except OSError:
+                pass
+        return total
+
+    def maintain(self, compress_after_days: int, retention_days: int, retention_by_chat: dict[int, int]) -> dict:
+        # Nothing to compress: SQLite pages are reused after deletes, so the
+        # file stops growing once retention kicks in.
+        stats = {"compressed": 0, "deleted": 0, "bytes_before": self._size()}
+        now = datetime.now(timezone.utc)
+        conn = self._conn()
+        chat_ids = [r[0] for r in conn.execute("SELECT DISTINCT chat_id FROM messages")]
+        with conn:
+            for chat_id in chat_ids:
+                keep_days = retention_by_chat.get(chat_id, retention_days)
+                if keep_days <= 0:
+                    continue
+                cutoff = (now - timedelta(days=keep_days + 1)).date().isoformat()
+                cur = conn.execute("DELETE FROM messages WHERE chat_id = ? AND ts < ?", (chat_id, cutoff))
+                stats["deleted"] += cur.rowcount
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        stats["bytes_after"] = self._size()
+        return stats
+
+
+def import_files(engine: SqliteEngine, data_dir: Path, batch_size: int = 20000) -> dict:
+    # One-shot import of chats.json, the per-chat segments and a leftover
+    # legacy messages.jsonl. Refuses to run twice on a non-empty database.
+    import gzip
+
+    conn = engine._conn()
+    if conn.execute("SELECT 1 FROM messages LIMIT 1").fetchone():
+        raise RuntimeError(f"{engine.path} already has messages; import skipped")
+
+    chats_file = data_dir / "chats.json"
+    chats = json.loads(chats_file.read_text(encoding="utf-8")) if chats_file.exists() else {}
+    for cid, meta in chats.items():
+        engine.upsert_chat(int(cid), meta)
+
+    sources: list[Path] = []
+    legacy = data_dir / "messages.jsonl"
+    if legacy.exists():
+        sources.append(legacy)
+    messages_dir = data_dir / "messages"
+    if messages_dir.is_dir():
+        sources.extend(sorted(messages_dir.glob("*/*.jsonl.gz")))
+        sources.extend(sorted(messages_dir.glob("*/*.jsonl")))
+
+    total = 0
+    batch: list[dict] = []
+    for source in sources:
+        opener = gzip.open if source.suffix == ".gz" else open
+        with opener(source, "rt", encoding="utf-8") as f:
+            for line in f:
+                if not line.strip():
+                    continue
+                row = json.loads(line)
+                row["ts"] = datetime.fromisoformat(row["ts"]).astimezone(timezone.utc).isoformat()
+                batch.append(row)
+                if len(batch) >= batch_size:
+                    engine.append_rows(batch)
+                    total += len(batch)
+                    batch = []
+    if batch:
+        engine.append_rows(batch)
+        total += len(batch)
+    return {"chats": len(chats), "messages": total, "files": len(sources)}
+
+
+if __name__ == "__main__":
+    import argparse
+
+    from config import DATA_DIR, SQLITE_PATH
+
+    parser = argparse.ArgumentParser(description="Import the JSON/JSONL data files into SQLite")
+    parser.add_argument("--data-dir", type=Path, default=DATA_DIR)
+    parser.add_argument("--db", type=Path, default=SQLITE_PATH)
+    args = parser.parse_args()
+    print(import_files(SqliteEngine(args.db), args.data_dir))
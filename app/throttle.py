@@ -0,0 +1,87 @@
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.types import Message
+
+from fastpath import GROUP_TYPES, route
+from metrics import THROTTLE_NOTICES, THROTTLED
+
+logger = logging.getLogger("porfiriy.throttle")
+
+
+def classify(message: Message, kind: str) -> str | None:
+    # Which LLM-backed command a routed message is, if any.
+    if kind == "find":
+        return "find"
+    if message.chat.type in GROUP_TYPES and kind in ("nax", "reply"):
+        return kind
+    return None
+
+
+class ThrottleMiddleware(BaseMiddleware):
+    # Outer middleware on messages, after FastPathMiddleware: spends a token
+    # from the user's and the chat's bucket for the command before filters
+    # or LLM work run. Only the LLM work is refused: a rejected group message
+    # still goes to `on_rejected` so the chat log stays complete.
+    # `limits` maps command -> {"user"|"chat": (burst, seconds) or None}.
+    # `overloaded()` sheds every LLM command while the request queue is
+    # backed up. Rejections get one "Остынь" per chat per notice window.
+
+    def __init__(
+        self, state, limits: dict, notice_seconds: float, allowed_chat_ids=(), overloaded=None, on_rejected=None,
+    ):
+        self.state = state
+        self.limits = limits
+        self.notice_seconds = notice_seconds
+        self.allowed_chat_ids = frozenset(allowed_chat_ids)
+        self.overloaded = overloaded
+        self.on_rejected = on_rejected
+
+    async def __call__(self, handler, event: Message, data):
+        kind = data.get("route") or route(event, data["bot"].id)
+        command = classify(event, kind)
+        if command is None:
+            return await handler(event, data)
+        chat_id = event.chat.id
+        if event.chat.type in GROUP_TYPES:
+            # Chats the handlers ignore anyway are not throttled (nor answered).
+            if self.allowed_chat_ids and chat_id not in self.allowed_chat_ids:
+                return await handler(event, data)
+            if not await self.state.is_bound(chat_id):
+                return await handler(event, data)
+
+        if self.overloaded is not None and self.overloaded():
+            THROTTLED.inc(command=command, reason="overload")
+            await self._reject(event, command, "Порфирий перегружен. Попробуй через минуту.")
+            return None
+
+        limits = self.limits.get(command, {})
+        user_id = event.from_user.id if event.from_user else chat_id
+        scopes = [(scope, key) for scope, key in (("user", user_id), ("chat", chat_id)) if limits.get(scope)]
+        # Both buckets are checked before either is spent, so a call the chat
+        # bucket refuses does not cost the user a token.
+        wait, index = await self.state.take([(f"{command}:{scope}:{key}", *limits[scope]) for scope, key in scopes])
+        if wait > 0:
+            scope = scopes[index][0]
+            THROTTLED.inc(command=command, reason=scope)
+            logger.info("Throttled %s in chat %s (%s bucket), wait=%.1fs", command, chat_id, scope, wait)
+            await self._reject(event, command, f"Остынь. Следующий вызов через {max(1, int(wait))} сек.")
+            return None
+        return await handler(event, data)
+
+    async def _reject(self, event: Message, command: str, text: str) -> None:
+        # Logs what group_listener would have: /nax and replies to the bot
+        # (/find is handled by cmd_find, which does not log).
+        if self.on_rejected is not None and event.chat.type in GROUP_TYPES and command != "find":
+            await self.on_rejected(event)
+        await self._notice(event, text)
+
+    async def _notice(self, event: Message, text: str) -> None:
+        if await self.state.cooldown(f"throttle-notice:{event.chat.id}", self.notice_seconds) > 0:
+            THROTTLE_NOTICES.inc(result="coalesced")
+            return
+        THROTTLE_NOTICES.inc(result="sent")
+        try:
+            await event.reply(text)
+        except Exception:
+            logger.exception("Failed to send throttle notice to chat %s", event.chat.id)
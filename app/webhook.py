@@ -0,0 +1,91 @@
+import asyncio
+import logging
+from typing import Any
+
+from aiohttp import web
+from aiogram import Bot, Dispatcher
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+
+logger = logging.getLogger("porfiriy.webhook")
+
+
+class BoundedRequestHandler(SimpleRequestHandler):
+    # Answers Telegram right away and processes each update in a background
+    # task, at most `max_tasks` at once. When all slots are busy the HTTP
+    # response is held back, so Telegram slows down instead of the bot piling
+    # up tasks. close() drains running handlers before the session closes.
+
+    def __init__(
+        self,
+        dispatcher: Dispatcher,
+        bot: Bot,
+        secret_token: str | None = None,
+        max_tasks: int = 256,
+        drain_timeout: float = 30.0,
+        **data: Any,
+    ):
+        super().__init__(dispatcher, bot, handle_in_background=True, secret_token=secret_token, **data)
+        self.max_tasks = max(1, max_tasks)
+        self.drain_timeout = drain_timeout
+        self._slots = asyncio.Semaphore(self.max_tasks)
+        self.accepted = 0
+        self.failed = 0
+
+    async def _handle_request_background(self, bot: Bot, request: web.Request) -> web.Response:
+        update = await request.json(loads=bot.session.json_loads)
+        await self._slots.acquire()
+        self.accepted += 1
+        task = asyncio.create_task(self._process(bot, update))
+        self._background_feed_update_tasks.add(task)
+        task.add_done_callback(self._background_feed_update_tasks.discard)
+        return web.json_response({}, dumps=bot.session.json_dumps)
+
+    async def _process(self, bot: Bot, update: dict) -> None:
+        try:
+            await self._background_feed_update(bot, update)
+        except Exception:
+            self.failed += 1
+            logger.exception("Webhook update %s failed", update.get("update_id"))
+        finally:
+            self._slots.release()
+
+    async def drain(self) -> None:
+        tasks = set(self._background_feed_update_tasks)
+        if not tasks:
+            return
+        logger.info("Draining %s webhook handlers (up to %ss)", len(tasks), self.drain_timeout)
+        _, pending = await asyncio.wait(tasks, timeout=self.drain_timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.warning("Cancelled %s webhook handlers still running after drain", len(pending))
+            await asyncio.wait(pending)
+
+    async def close(self) -> None:
+        await self.drain()
+        await super().close()
+
+    def stats(self) -> dict:
+        return {
+            "in_flight": len(self._background_feed_update_tasks),
+            "max_tasks": self.max_tasks,
+            "accepted": self.accepted,
+            "failed": self.failed,
+        }
+
+
+def build_webhook_app(
+    dispatcher: Dispatcher,
+    bot: Bot,
+    path: str,
+    secret_token: str | None,
+    max_tasks: int,
+    drain_timeout: float,
+) -> tuple[web.Application, BoundedRequestHandler]:
+    app = web.Application()
+    handler = BoundedRequestHandler(
+        dispatcher, bot, secret_token=secret_token, max_tasks=max_tasks, drain_timeout=drain_timeout,
+    )
+    handler.register(app, path=path)
+    setup_application(app, dispatcher, bot=bot)
+    return app, handler
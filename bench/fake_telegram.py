@@ -0,0 +1,71 @@
+import itertools
+from datetime import datetime, timezone
+from typing import AsyncGenerator
+
+from aiogram.client.session.base import BaseSession
+from aiogram.methods import EditMessageText, GetMe, SendMessage
+from aiogram.types import Chat, Message, Update, User
+
+# Bot API stand-in: answers the methods the handlers call without any
+# network I/O and counts them.
+
+BOT_ID = 123456
+
+
+class FakeSession(BaseSession):
+    def __init__(self):
+        super().__init__()
+        self.calls: dict[str, int] = {}
+        self._ids = itertools.count(1_000_000)
+
+    async def close(self) -> None:
+        pass
+
+    async def stream_content(
+        self, url: str, headers=None, timeout: int = 30, chunk_size: int = 65536, raise_for_status: bool = True,
+    ) -> AsyncGenerator[bytes, None]:
+        # File downloads: counted like API calls, every file is empty.
+        self.calls["download"] = self.calls.get("download", 0) + 1
+        return
+        yield b""
+
+    async def make_request(self, bot, method, timeout=None):
+        name = type(method).__name__
+        self.calls[name] = self.calls.get(name, 0) + 1
+        if isinstance(method, GetMe):
+            return User(id=BOT_ID, is_bot=True, first_name="Porfiriy")
+        if isinstance(method, (SendMessage, EditMessageText)):
+            chat_id = int(method.chat_id) if method.chat_id is not None else 0
+            return Message(
+                message_id=getattr(method, "message_id", None) or next(self._ids),
+                date=datetime.now(timezone.utc),
+                chat=Chat(id=chat_id, type="supergroup"),
+                text=method.text,
+            ).as_(bot)
+        return True
+
+
+_update_ids = itertools.count(1)
+
+
+def group_update(chat_id: int, user_id: int, text: str, reply_to_bot: bool = False) -> Update:
+    now = datetime.now(timezone.utc)
+    chat = Chat(id=chat_id, type="supergroup", title=f"bench {chat_id}")
+    reply = None
+    if reply_to_bot:
+        reply = Message(
+            message_id=1,
+            date=now,
+            chat=chat,
+            from_user=User(id=BOT_ID, is_bot=True, first_name="Porfiriy"),
+            text="Предыдущий ответ Порфирия",
+        )
+    message = Message(
+        message_id=next(_update_ids),
+        date=now,
+        chat=chat,
+        from_user=User(id=user_id, is_bot=False, first_name=f"user{user_id}"),
+        text=text,
+        reply_to_message=reply,
+    )
+    return Update(update_id=message.message_id, message=message)
@@ -0,0 +1,411 @@
+import argparse
+import asyncio
+import json
+import logging
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+import tracemalloc
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+# Benchmarks for the bot: replays a group-message stream through the real
+# dispatcher against fake Telegram and a local CometAPI stub, times the
+# storage layer at a chosen log size, and measures digest wall time.
+#
+#   python bench/run.py handlers --messages 5000 --chats 20
+#   python bench/run.py webhook --messages 5000 --max-tasks 64
+#   python bench/run.py storage --rows 1000000 --chats 50
+#   python bench/run.py digest --chats 30 --rows-per-chat 2000 --llm-latency 2
+
+ROOT = Path(__file__).resolve().parent
+sys.path.insert(0, str(ROOT.parent / "app"))
+sys.path.insert(0, str(ROOT))
+
+WORDS = (
+    "крипта биток работа отпуск пятница пиво футбол погода начальник дедлайн "
+    "релиз баг кофе спортзал машина ремонт кот собака ипотека новости выборы"
+).split()
+
+
+def _setup_env(data_dir: str, comet_port: int) -> None:
+    from fake_telegram import BOT_ID
+
+    os.environ["DATA_DIR"] = data_dir
+    os.environ["COMET_BASE_URL"] = f"http://127.0.0.1:{comet_port}"
+    os.environ.setdefault("BOT_TOKEN", f"{BOT_ID}:BENCHbenchBENCHbenchBENCHbench")
+    os.environ.setdefault("COMET_API_TOKEN", "bench")
+    os.environ.setdefault("METRICS_PORT", "0")
+    os.environ.setdefault("BOT_COOLDOWN_SECONDS", "0")
+    os.environ.setdefault("THROTTLE_ENABLED", "0")
+
+
+def _text(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(3, 25)))
+
+
+def _pct(values: list[float], q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+
+
+def _ms(seconds: float) -> float:
+    return round(seconds * 1000, 3)
+
+
+def _report(title: str, result: dict, as_json: bool) -> None:
+    if as_json:
+        print(json.dumps({"bench": title, **result}, ensure_ascii=False))
+        return
+    print(f"== {title}")
+    for key, value in result.items():
+        print(f"  {key}: {value}")
+
+
+# ---------------------------------------------------------------------------
+# Хендлеры: поток сообщений через dp
+# ---------------------------------------------------------------------------
+
+def _message_stream(args, rng: random.Random):
+    if args.replay:
+        with open(args.replay, encoding="utf-8") as f:
+            for i, line in enumerate(f):
+                if i >= args.messages:
+                    return
+                if line.strip():
+                    row = json.loads(line)
+                    yield row["chat_id"], abs(hash(row.get("user", ""))) % 10_000, row["text"], False
+        return
+    chat_ids = [-100_000 - i for i in range(args.chats)]
+    for _ in range(args.messages):
+        chat_id = rng.choice(chat_ids)
+        user_id = rng.randint(1, 200)
+        roll = rng.random()
+        if roll < args.nax_rate:
+            yield chat_id, user_id, "/nax " + _text(rng), False
+        elif roll < args.nax_rate + args.find_rate:
+            yield chat_id, user_id, "/find " + " ".join(rng.sample(WORDS, 3)), False
+        elif roll < args.nax_rate + args.find_rate + args.reply_rate:
+            yield chat_id, user_id, _text(rng), True
+        elif roll < args.nax_rate + args.find_rate + args.reply_rate + args.recall_rate:
+            yield chat_id, user_id, "/recall " + " ".join(rng.sample(WORDS, 2)), False
+        else:
+            yield chat_id, user_id, _text(rng), False
+
+
+async def bench_handlers(args) -> dict:
+    import stub_comet
+    from fake_telegram import FakeSession, group_update
+
+    runner = await stub_comet.start(
+        "127.0.0.1", args.comet_port, latency=args.llm_latency, slow_rate=args.llm_slow_rate,
+    )
+    import bot as bot_module
+    import storage
+
+    session = FakeSession()
+    bot_module.bot.session = session
+    rng = random.Random(args.seed)
+    stream = list(_message_stream(args, rng))
+    for chat_id in {chat_id for chat_id, *_ in stream}:
+        storage.bind_chat(chat_id, f"bench {chat_id}")
+
+    latencies: dict[str, list[float]] = {"plain": [], "command": [], "recall": []}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def feed(chat_id: int, user_id: int, text: str, reply_to_bot: bool) -> None:
+        update = group_update(chat_id, user_id, text, reply_to_bot)
+        if text.startswith("/recall"):
+            kind = "recall"
+        elif reply_to_bot or text.startswith(("/nax", "/find")):
+            kind = "command"
+        else:
+            kind = "plain"
+        async with sem:
+            started = time.perf_counter()
+            await bot_module.dp.feed_update(bot_module.bot, update)
+            latencies[kind].append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(feed(*item) for item in stream))
+    wall = time.perf_counter() - started
+    await asyncio.to_thread(storage.flush_log)
+    await bot_module.comet.aclose()
+    await runner.cleanup()
+
+    return {
+        "messages": len(stream),
+        "wall_s": round(wall, 3),
+        "messages_per_s": round(len(stream) / wall, 1) if wall else 0,
+        "plain_p50_ms": _ms(_pct(latencies["plain"], 0.5)),
+        "plain_p99_ms": _ms(_pct(latencies["plain"], 0.99)),
+        "command_count": len(latencies["command"]),
+        "command_p50_ms": _ms(_pct(latencies["command"], 0.5)),
+        "command_p99_ms": _ms(_pct(latencies["command"], 0.99)),
+        "recall_count": len(latencies["recall"]),
+        "recall_p50_ms": _ms(_pct(latencies["recall"], 0.5)),
+        "recall_p99_ms": _ms(_pct(latencies["recall"], 0.99)),
+        "telegram_calls": session.calls,
+        "comet_calls": dict(runner.app["stats"]),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Вебхук: те же сообщения POST-ами в aiohttp-сервер
+# ---------------------------------------------------------------------------
+
+async def bench_webhook(args) -> dict:
+    import aiohttp
+    from aiohttp import web
+
+    import stub_comet
+    from fake_telegram import FakeSession, group_update
+
+    runner = await stub_comet.start(
+        "127.0.0.1", args.comet_port, latency=args.llm_latency, slow_rate=args.llm_slow_rate,
+    )
+    import bot as bot_module
+    import storage
+    from webhook import build_webhook_app
+
+    session = FakeSession()
+    bot_module.bot.session = session
+    rng = random.Random(args.seed)
+    stream = list(_message_stream(args, rng))
+    for chat_id in {chat_id for chat_id, *_ in stream}:
+        storage.bind_chat(chat_id, f"bench {chat_id}")
+
+    secret = "bench-secret"
+    app, handler = build_webhook_app(bot_module.dp, bot_module.bot, "/webhook", secret, args.max_tasks, 60)
+    web_runner = web.AppRunner(app, access_log=None)
+    await web_runner.setup()
+    await web.TCPSite(web_runner, "127.0.0.1", args.webhook_port).start()
+    url = f"http://127.0.0.1:{args.webhook_port}/webhook"
+
+    acks: list[float] = []
+    statuses: dict[int, int] = {}
+    sem = asyncio.Semaphore(args.concurrency)
+
+    async def post(http, chat_id: int, user_id: int, text: str, reply_to_bot: bool) -> None:
+        body = group_update(chat_id, user_id, text, reply_to_bot).model_dump_json(by_alias=True, exclude_none=True)
+        headers = {"Content-Type": "application/json", "X-Telegram-Bot-Api-Secret-Token": secret}
+        async with sem:
+            started = time.perf_counter()
+            async with http.post(url, data=body, headers=headers) as r:
+                await r.read()
+                statuses[r.status] = statuses.get(r.status, 0) + 1
+            acks.append(time.perf_counter() - started)
+
+    started = time.perf_counter()
+    async with aiohttp.ClientSession() as http:
+        await asyncio.gather(*(post(http, *item) for item in stream))
+        accepted_wall = time.perf_counter() - started
+        async with http.post(url, json={"update_id": 0}, headers={"X-Telegram-Bot-Api-Secret-Token": "wrong"}) as r:
+            bad_secret_status = r.status
+    await web_runner.cleanup()
+    wall = time.perf_counter() - started
+    await asyncio.to_thread(storage.flush_log)
+    await bot_module.comet.aclose()
+    await runner.cleanup()
+
+    return {
+        "messages": len(stream),
+        "accepted_s": round(accepted_wall, 3),
+        "wall_s": round(wall, 3),
+        "messages_per_s": round(len(stream) / wall, 1) if wall else 0,
+        "ack_p50_ms": _ms(_pct(acks, 0.5)),
+        "ack_p99_ms": _ms(_pct(acks, 0.99)),
+        "http_statuses": statuses,
+        "bad_secret_status": bad_secret_status,
+        "webhook": handler.stats(),
+        "telegram_calls": session.calls,
+        "comet_calls": dict(runner.app["stats"]),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Хранилище: чтение/запись на логе заданного размера
+# ---------------------------------------------------------------------------
+
+def _generate_log(rows: int, chats: int, days: int, seed: int, batch: int = 20_000) -> list[int]:
+    import storage
+
+    rng = random.Random(seed)
+    chat_ids = [-100_000 - i for i in range(chats)]
+    now = datetime.now(timezone.utc)
+    start = now - timedelta(days=days)
+    step = (now - start) / max(1, rows)
+    pending: list[dict] = []
+    for i in range(rows):
+        ts = start + step * i
+        chat_id = chat_ids[i % chats]
+        pending.append({"ts": ts.isoformat(), "chat_id": chat_id, "user": f"user{rng.randint(1, 200)}", "text": _text(rng)})
+        if len(pending) >= batch:
+            storage._engine.append_rows(pending)
+            pending = []
+    if pending:
+        storage._engine.append_rows(pending)
+    return chat_ids
+
+
+def _time_calls(fn, args_list: list, repeat: int = 1) -> list[float]:
+    out = []
+    for _ in range(repeat):
+        for item in args_list:
+            started = time.perf_counter()
+            fn(*item)
+            out.append(time.perf_counter() - started)
+    return out
+
+
+def bench_storage(args) -> dict:
+    import storage
+
+    started = time.perf_counter()
+    chat_ids = _generate_log(args.rows, args.chats, args.days, args.seed)
+    generate_s = time.perf_counter() - started
+    sample = [(cid,) for cid in chat_ids[: min(len(chat_ids), 50)]]
+
+    disk_last_n = _time_calls(lambda cid: storage._engine.read_last_n(cid, 10), sample, repeat=5)
+    storage.warm_recent_cache(cid for (cid,) in sample)
+    cached_last_n = _time_calls(lambda cid: storage.read_last_n(cid, 10), sample, repeat=5)
+    last_24h = _time_calls(storage.read_last_24h, sample)
+    tracemalloc.start()
+    rows_24h = storage.read_last_24h(sample[0][0])
+    _, peak_24h = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    rng = random.Random(args.seed)
+    texts = [_text(rng) for _ in range(args.writes)]
+    started = time.perf_counter()
+    for i, text in enumerate(texts):
+        storage.log_message(chat_ids[i % len(chat_ids)], "bench", text)
+    enqueue_s = time.perf_counter() - started
+    storage.flush_log()
+    write_s = time.perf_counter() - started
+    storage.close_storage()
+
+    return {
+        "rows": args.rows,
+        "chats": args.chats,
+        "generate_s": round(generate_s, 2),
+        "read_last_n_disk_p50_ms": _ms(_pct(disk_last_n, 0.5)),
+        "read_last_n_disk_p99_ms": _ms(_pct(disk_last_n, 0.99)),
+        "read_last_n_cached_p50_ms": _ms(_pct(cached_last_n, 0.5)),
+        "read_last_24h_p50_ms": _ms(_pct(last_24h, 0.5)),
+        "read_last_24h_p99_ms": _ms(_pct(last_24h, 0.99)),
+        "read_last_24h_peak_kb": round(peak_24h / 1024, 1),
+        "read_last_24h_peak_bytes_per_row": round(peak_24h / max(1, len(rows_24h))),
+        "read_last_24h_rows_avg": round(statistics.mean(len(storage.read_last_24h(c)) for (c,) in sample), 1),
+        "log_message_enqueue_per_s": round(args.writes / enqueue_s, 1) if enqueue_s else 0,
+        "log_message_durable_per_s": round(args.writes / write_s, 1) if write_s else 0,
+        "writer": storage.log_writer_stats(),
+    }
+
+
+# ---------------------------------------------------------------------------
+# Дайджесты: время от старта до последнего чата
+# ---------------------------------------------------------------------------
+
+async def bench_digest(args) -> dict:
+    import stub_comet
+    from fake_telegram import FakeSession
+
+    runner = await stub_comet.start(
+        "127.0.0.1", args.comet_port, latency=args.llm_latency, slow_rate=args.llm_slow_rate,
+    )
+    import bot as bot_module
+    import storage
+
+    bot_module.bot.session = FakeSession()
+    chat_ids = await asyncio.to_thread(
+        _generate_log, args.rows_per_chat * args.chats, args.chats, 1, args.seed,
+    )
+    for chat_id in chat_ids:
+        storage.bind_chat(chat_id, f"bench {chat_id}")
+    # Same as bot startup: the generated log bypassed log_message.
+    started = time.perf_counter()
+    await asyncio.to_thread(storage.rebuild_aggregates, chat_ids)
+
+    result = {"chats": args.chats, "rows_per_chat": args.rows_per_chat, "llm_latency_s": args.llm_latency}
+    result["aggregate_rebuild_s"] = round(time.perf_counter() - started, 3)
+    # Every chat's job at once, as if the digest spread were zero.
+    for name, job in (("daily_digest", "daily_digest"), ("web_digest", "web_themes_digest")):
+        started = time.perf_counter()
+        await asyncio.gather(*(bot_module.run_chat_digest(job, chat_id) for chat_id in chat_ids))
+        result[f"{name}_wall_s"] = round(time.perf_counter() - started, 3)
+    result["comet_calls"] = dict(runner.app["stats"])
+    await bot_module.comet.aclose()
+    await runner.cleanup()
+    storage.close_storage()
+    return result
+
+
+def _traffic_args(p: argparse.ArgumentParser) -> None:
+    p.add_argument("--messages", type=int, default=5000)
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--nax-rate", type=float, default=0.01)
+    p.add_argument("--find-rate", type=float, default=0.005)
+    p.add_argument("--reply-rate", type=float, default=0.005)
+    p.add_argument("--recall-rate", type=float, default=0.005)
+    p.add_argument("--llm-latency", type=float, default=0.2)
+    p.add_argument("--llm-slow-rate", type=float, default=0.0, help="share of CometAPI stub requests that are 10x slower")
+    p.add_argument("--replay", help="JSONL with chat_id/user/text rows to replay instead of synthetic traffic")
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description="Porfiriy benchmarks")
+    parser.add_argument("--data-dir", help="data directory (default: a fresh temp dir)")
+    parser.add_argument("--comet-port", type=int, default=18080)
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--json", action="store_true", help="print one JSON line per benchmark")
+    parser.add_argument("--log-level", default="WARNING", help="log level while benchmarking")
+    sub = parser.add_subparsers(dest="bench", required=True)
+
+    p = sub.add_parser("handlers", help="replay group messages through the dispatcher")
+    _traffic_args(p)
+    p.add_argument("--concurrency", type=int, default=64, help="updates processed at once")
+
+    p = sub.add_parser("webhook", help="POST group messages to the webhook server")
+    _traffic_args(p)
+    p.add_argument("--concurrency", type=int, default=64, help="HTTP requests in flight")
+    p.add_argument("--max-tasks", type=int, default=256, help="WEBHOOK_MAX_TASKS for the server")
+    p.add_argument("--webhook-port", type=int, default=18081)
+
+    p = sub.add_parser("storage", help="storage read/write latency at a given log size")
+    p.add_argument("--rows", type=int, default=100_000)
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--days", type=int, default=7)
+    p.add_argument("--writes", type=int, default=20_000)
+
+    p = sub.add_parser("digest", help="wall time of both digest jobs")
+    p.add_argument("--chats", type=int, default=20)
+    p.add_argument("--rows-per-chat", type=int, default=1000)
+    p.add_argument("--llm-latency", type=float, default=1.0)
+    p.add_argument("--llm-slow-rate", type=float, default=0.0, help="share of CometAPI stub requests that are 10x slower")
+
+    args = parser.parse_args()
+    logging.basicConfig(level=args.log_level)
+    logging.getLogger().setLevel(args.log_level)
+    data_dir = args.data_dir or tempfile.mkdtemp(prefix="porfiriy-bench-")
+    _setup_env(data_dir, args.comet_port)
+
+    if args.bench == "handlers":
+        result = asyncio.run(bench_handlers(args))
+    elif args.bench == "webhook":
+        result = asyncio.run(bench_webhook(args))
+    elif args.bench == "storage":
+        result = bench_storage(args)
+    else:
+        result = asyncio.run(bench_digest(args))
+    result["data_dir"] = data_dir
+    _report(args.bench, result, args.json)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,85 @@
+import asyncio
+import json
+import random
+
+from aiohttp import web
+
+# Local stand-in for the CometAPI endpoints used by the bot. Latency and
+# answer size are configurable; streaming requests get SSE chunks. A
+# `slow_rate` share of requests takes `slow_factor` times longer, to model
+# a degraded upstream.
+
+
+def create_app(
+    latency: float = 0.5,
+    chunks: int = 8,
+    text: str = "Порфирий отвечает. ",
+    slow_rate: float = 0.0,
+    slow_factor: float = 10.0,
+) -> web.Application:
+    stats = {"chat": 0, "responses": 0, "slow": 0}
+
+    def delay() -> float:
+        if slow_rate and random.random() < slow_rate:
+            stats["slow"] += 1
+            return latency * slow_factor
+        return latency
+
+    async def chat(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        stats["chat"] += 1
+        wait = delay()
+        if not body.get("stream"):
+            await asyncio.sleep(wait)
+            return web.json_response({"choices": [{"message": {"content": text * chunks}}]})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for _ in range(chunks):
+            await asyncio.sleep(wait / chunks)
+            event = {"choices": [{"delta": {"content": text}}]}
+            await resp.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+        await resp.write(b"data: [DONE]\n\n")
+        return resp
+
+    async def responses(request: web.Request) -> web.StreamResponse:
+        body = await request.json()
+        stats["responses"] += 1
+        wait = delay()
+        if not body.get("stream"):
+            await asyncio.sleep(wait)
+            return web.json_response({"output_text": text * chunks})
+        resp = web.StreamResponse(headers={"Content-Type": "text/event-stream"})
+        await resp.prepare(request)
+        for _ in range(chunks):
+            await asyncio.sleep(wait / chunks)
+            event = {"type": "response.output_text.delta", "delta": text}
+            await resp.write(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode())
+        await resp.write(b'data: {"type": "response.completed"}\n\n')
+        return resp
+
+    app = web.Application()
+    app["stats"] = stats
+    app.router.add_post("/v1/chat/completions", chat)
+    app.router.add_post("/v1/responses", responses)
+    return app
+
+
+async def start(host: str, port: int, **kwargs) -> web.AppRunner:
+    runner = web.AppRunner(create_app(**kwargs), access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    return runner
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Local CometAPI stub")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=18080)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--slow-rate", type=float, default=0.0)
+    args = parser.parse_args()
+    web.run_app(
+        create_app(latency=args.latency, slow_rate=args.slow_rate), host=args.host, port=args.port, access_log=None,
+    )
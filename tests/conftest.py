@@ -0,0 +1,11 @@
+import os
+import sys
+import tempfile
+from pathlib import Path
+
+# config.py reads the environment at import and storage.py creates its files
+# there: point both at a scratch directory before any test imports them.
+os.environ["DATA_DIR"] = tempfile.mkdtemp(prefix="porfiriy-tests-")
+os.environ["STORAGE_BACKEND"] = "files"
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
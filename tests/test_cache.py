@@ -0,0 +1,62 @@
+import asyncio
+
+import pytest
+
+import cache
+from cache import ResponseCache, normalize_query
+
+
+def test_concurrent_misses_share_one_fetch():
+    responses = ResponseCache(ttl=60, max_items=10)
+    calls = 0
+
+    async def fetch() -> str:
+        nonlocal calls
+        calls += 1
+        await asyncio.sleep(0.01)
+        return "answer"
+
+    async def run():
+        return await asyncio.gather(*(responses.get_or_fetch("q", fetch) for _ in range(5)))
+
+    results = asyncio.run(run())
+    assert calls == 1
+    assert sorted(results) == [("answer", False)] * 4 + [("answer", True)]
+    assert responses.stats()["coalesced"] == 4
+    assert asyncio.run(responses.get_or_fetch("q", fetch)) == ("answer", False)
+
+
+def test_failed_fetch_reaches_waiters_and_is_not_cached():
+    responses = ResponseCache(ttl=60, max_items=10)
+
+    async def fetch() -> str:
+        await asyncio.sleep(0.01)
+        raise ValueError("boom")
+
+    async def run():
+        return await asyncio.gather(*(responses.get_or_fetch("q", fetch) for _ in range(3)), return_exceptions=True)
+
+    assert [type(r) for r in asyncio.run(run())] == [ValueError] * 3
+    assert responses.get("q") is None
+    assert responses.stats()["inflight"] == 0
+
+
+def test_entries_expire_and_survive_a_restart(tmp_path, monkeypatch):
+    now = [1000.0]
+    monkeypatch.setattr(cache.time, "time", lambda: now[0])
+    path = tmp_path / "cache.json"
+    responses = ResponseCache(ttl=60, max_items=2, path=path)
+
+    async def fetch() -> str:
+        return "answer"
+
+    asyncio.run(responses.get_or_fetch("q", fetch))
+    assert ResponseCache(ttl=60, max_items=2, path=path).get("q") == "answer"
+    now[0] += 61
+    assert ResponseCache(ttl=60, max_items=2, path=path).get("q") is None
+    assert responses.get("q") is None
+
+
+@pytest.mark.parametrize("raw", ["  Что такое RAG?! ", "что   такое rag", "«Что такое RAG»"])
+def test_normalize_query(raw):
+    assert normalize_query(raw) == "что такое rag"
@@ -0,0 +1,96 @@
+import asyncio
+import time
+
+import httpx
+import pytest
+
+from comet import CometClient
+from limits import QueueTimeout
+from routing import CircuitBreaker
+
+
+def _client(statuses: dict[str, list[int]], **kwargs) -> tuple[CometClient, list[str]]:
+    # Upstream "a" with fallback "b"; each host answers with the next status
+    # from its list (the last one repeats) and a one-word chat completion.
+    seen: list[str] = []
+
+    def handler(request: httpx.Request) -> httpx.Response:
+        host = request.url.host
+        seen.append(host)
+        queue = statuses[host]
+        status = queue.pop(0) if len(queue) > 1 else queue[0]
+        return httpx.Response(status, json={"choices": [{"message": {"content": host}}]})
+
+    client = CometClient("x", "m", "http://a", fallbacks=[("m", "http://b")], max_retries=0, **kwargs)
+    client._client = httpx.AsyncClient(transport=httpx.MockTransport(handler))
+    return client, seen
+
+
+def test_breaker_opens_then_lets_one_probe_through():
+    breaker = CircuitBreaker(threshold=2, cooldown=0.05)
+    breaker.failure()
+    assert breaker.allow() and breaker.state == "closed"
+    breaker.failure()
+    assert breaker.state == "open" and not breaker.allow()
+    time.sleep(0.06)
+    assert breaker.allow() and not breaker.allow()
+    breaker.failure()
+    assert breaker.state == "open" and breaker.opened == 1
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.success()
+    assert breaker.state == "closed" and breaker.allow()
+
+
+def test_release_frees_the_probe_without_judging():
+    breaker = CircuitBreaker(threshold=1, cooldown=0.05)
+    breaker.failure()
+    time.sleep(0.06)
+    assert breaker.allow()
+    breaker.release()
+    assert breaker.state == "half_open" and breaker.allow()
+
+
+@pytest.mark.parametrize("status", [500, 429])
+def test_fails_over_on_server_errors_and_exhausted_429(status):
+    client, seen = _client({"a": [status], "b": [200]}, breaker_failures=1)
+    assert asyncio.run(client.chat("s", "u")) == "b"
+    assert seen == ["a", "b"]
+    # The failed upstream is skipped until its cooldown is over.
+    assert client.upstreams[0].breaker.state == "open"
+    assert client.upstreams[1].breaker.failures == 0
+
+
+def test_client_error_is_raised_at_once_and_keeps_the_breaker_closed():
+    client, seen = _client({"a": [400], "b": [200]}, breaker_failures=1)
+    with pytest.raises(httpx.HTTPStatusError):
+        asyncio.run(client.chat("s", "u"))
+    assert seen == ["a"]
+    assert client.upstreams[0].breaker.state == "closed"
+
+
+def test_rejected_search_tool_on_the_last_variant_is_an_http_error():
+    client, seen = _client({"a": [400], "b": [200]})
+
+    async def run():
+        return [chunk async for chunk in client.web_search_stream("q")]
+
+    with pytest.raises(httpx.HTTPStatusError) as e:
+        asyncio.run(run())
+    assert e.value.response.status_code == 400
+    # Both tool variants were tried on the first upstream, with no failover.
+    assert seen == ["a", "a"]
+
+
+def test_queue_timeout_releases_the_probe():
+    client, _ = _client({"a": [200], "b": [200]}, breaker_failures=1, breaker_cooldown=0.0)
+    upstream = client.upstreams[0]
+    upstream.breaker.failure()
+    assert upstream.breaker.allow() and upstream.breaker.probing
+
+    async def call(upstream):
+        raise QueueTimeout("queued too long")
+
+    with pytest.raises(QueueTimeout):
+        asyncio.run(client._attempt(upstream, call, "chat"))
+    assert not upstream.breaker.probing and upstream.breaker.failures == 1
@@ -0,0 +1,67 @@
+import asyncio
+import sys
+from datetime import datetime, timedelta, timezone
+from pathlib import Path
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "app"))
+
+from context import PANE_HOURS, RollingSummaries, build_context  # noqa: E402
+from rows import Row  # noqa: E402
+
+
+def _rows(start: datetime, first: int, count: int) -> list[Row]:
+    return [
+        Row((start + timedelta(minutes=i)).isoformat(), -1, f"u{i % 5}", f"сообщение {i}")
+        for i in range(first, first + count)
+    ]
+
+
+def test_sliding_window_keeps_panes_inside_the_window(tmp_path):
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    summaries = RollingSummaries(tmp_path / "summaries.json")
+    summarized: list[str] = []
+
+    async def summarize(previous: str, lines: list[str]) -> str:
+        summarized.extend(lines)
+        return f"{previous}+{len(lines)}"
+
+    async def refresh(rows: list[Row]) -> str:
+        return await build_context(-1, rows, 50, summaries, summarize, 10_000)
+
+    # A day of one message per minute, then the window slides by an hour.
+    asyncio.run(refresh(_rows(start, 0, 1440)))
+    before = {p["pane"]: p for p in summaries.get(-1)}
+    assert len(before) == 1440 // 60 // PANE_HOURS
+    summarized.clear()
+    context = asyncio.run(refresh(_rows(start, 60, 1440)))
+    after = summaries.get(-1)
+
+    # The first pane started before the window: only its rows still inside
+    # are summarized again, plus the hour that slid out of the verbatim tail.
+    head = PANE_HOURS * 60
+    assert summarized[0].endswith("сообщение 60")
+    assert len(summarized) == (head - 60) + 60
+    assert after[0]["from_ts"] == (start + timedelta(minutes=60)).isoformat()
+    assert all(p["from_ts"] >= after[0]["from_ts"] for p in after)
+    for pane in after[1:-2]:
+        assert pane == before[pane["pane"]]
+    assert after[-1]["pane"] == "2026-01-02T00"
+    assert after[0]["text"] in context and after[-1]["text"] in context
+
+
+def test_summary_restarts_after_a_gap(tmp_path):
+    start = datetime(2026, 1, 1, tzinfo=timezone.utc)
+    summaries = RollingSummaries(tmp_path / "summaries.json")
+    calls: list[int] = []
+
+    async def summarize(previous: str, lines: list[str]) -> str:
+        calls.append(len(lines))
+        return f"{previous}+{len(lines)}"
+
+    asyncio.run(build_context(-1, _rows(start, 0, 300), 50, summaries, summarize, 10_000))
+    # Two days later none of the summarized rows is in the window.
+    asyncio.run(build_context(-1, _rows(start, 3000, 300), 50, summaries, summarize, 10_000))
+
+    panes = summaries.get(-1)
+    assert panes[0]["from_ts"] == (start + timedelta(minutes=3000)).isoformat()
+    assert [p["text"] for p in panes] == [f"+{n}" for n in calls[-len(panes):]]
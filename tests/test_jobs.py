@@ -0,0 +1,13 @@
+from jobs import DigestLedger
+
+
+def test_failed_digest_is_not_caught_up_again(tmp_path):
+    ledger = DigestLedger(tmp_path / "digests.json")
+    ledger.start("daily_digest", 1, "2026-01-01")
+    ledger.finish("daily_digest", 1, "2026-01-01", "failed")
+    ledger.start("daily_digest", 2, "2026-01-01")
+
+    reloaded = DigestLedger(tmp_path / "digests.json")
+    assert reloaded.interrupted("2026-01-01") == [("daily_digest", 2)]
+    assert reloaded.done("daily_digest", 1, "2026-01-01")
+    assert reloaded.entry("daily_digest", 1)["status"] == "failed"
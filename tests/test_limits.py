@@ -0,0 +1,92 @@
+import asyncio
+import time
+
+import pytest
+
+from limits import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, QueueTimeout, RequestScheduler, TokenBuckets
+
+
+def test_take_spends_from_all_buckets_or_none():
+    buckets = TokenBuckets()
+    user, chat = ("nax:user:1", 5, 60), ("nax:chat:9", 1, 60)
+    assert buckets.take([user, chat]) == (0.0, -1)
+    wait, index = buckets.take([user, chat])
+    assert wait > 0 and index == 1
+    # The rejected call did not cost the user a token: 4 are left.
+    assert [buckets.take([user])[0] > 0 for _ in range(5)] == [False] * 4 + [True]
+
+
+def test_prune_keeps_buckets_that_are_still_drained():
+    buckets = TokenBuckets(max_keys=2)
+    # 5 tokens earned back over an hour; one is spent.
+    buckets.take([("slow", 5, 3600)])
+    buckets.take([("a", 1, 1)])
+    # Over max_keys: judged by this bucket's burst of 1, "slow" would look full.
+    buckets.take([("b", 1, 1)])
+    assert [buckets.take([("slow", 5, 3600)])[0] > 0 for _ in range(5)] == [False] * 4 + [True]
+
+
+def test_scheduler_admits_interactive_first_and_fifo_within_a_priority():
+    async def run():
+        scheduler = RequestScheduler(max_concurrent=1)
+        order: list[str] = []
+        await scheduler.acquire()
+
+        async def request(name: str, priority: int):
+            async with scheduler.slot(priority):
+                order.append(name)
+
+        tasks = [
+            asyncio.create_task(request(name, priority))
+            for name, priority in (
+                ("bg1", PRIORITY_BACKGROUND),
+                ("i1", PRIORITY_INTERACTIVE),
+                ("bg2", PRIORITY_BACKGROUND),
+                ("i2", PRIORITY_INTERACTIVE),
+            )
+        ]
+        await asyncio.sleep(0)
+        assert scheduler.queued() == {"interactive": 2, "background": 2}
+        scheduler.release()
+        await asyncio.gather(*tasks)
+        return order, scheduler.stats()
+
+    order, stats = asyncio.run(run())
+    assert order == ["i1", "i2", "bg1", "bg2"]
+    assert stats["active"] == 0 and stats["granted"] == 5
+
+
+def test_scheduler_times_out_waiters_without_leaking_slots():
+    async def run():
+        scheduler = RequestScheduler(max_concurrent=1, queue_timeouts={PRIORITY_INTERACTIVE: 0.01})
+        await scheduler.acquire(PRIORITY_BACKGROUND)
+        with pytest.raises(QueueTimeout):
+            await scheduler.acquire()
+        waiter = asyncio.create_task(scheduler.acquire(PRIORITY_BACKGROUND))
+        await asyncio.sleep(0)
+        waiter.cancel()
+        await asyncio.gather(waiter, return_exceptions=True)
+        scheduler.release()
+        # The slot is free again: timed-out and cancelled waiters did not keep it.
+        await asyncio.wait_for(scheduler.acquire(), 1)
+        return scheduler.stats()
+
+    stats = asyncio.run(run())
+    assert stats["timeouts"] == 1 and stats["active"] == 1
+
+
+def test_scheduler_rate_and_pause_delay_admission():
+    async def run():
+        scheduler = RequestScheduler(max_concurrent=10, per_second=50, burst=1)
+        started = time.monotonic()
+        for _ in range(3):
+            await scheduler.acquire()
+        rated = time.monotonic() - started
+        scheduler.pause(0.1)
+        started = time.monotonic()
+        await scheduler.acquire()
+        return rated, time.monotonic() - started
+
+    rated, paused = asyncio.run(run())
+    assert rated >= 0.035  # two more tokens at 50/s
+    assert paused >= 0.09
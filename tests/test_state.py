@@ -0,0 +1,30 @@
+import asyncio
+
+import pytest
+
+import state
+
+
+def _make(backend: str):
+    if backend == "redis":
+        fakeredis = pytest.importorskip("fakeredis.aioredis")
+        return state.RedisState(fakeredis.FakeRedis(), prefix="test:")
+    return state.MemoryState()
+
+
+@pytest.mark.parametrize("backend", ["memory", "redis"])
+def test_concurrent_settings_changes_are_merged(backend):
+    chat_id = -5001 if backend == "memory" else -5002
+    changes = ({"humor": "soft"}, {"context": 7}, {"daily": False}, {"web": False})
+
+    async def run():
+        st = _make(backend)
+        await st.bind_chat(chat_id, "t")
+        await asyncio.gather(*(st.update_chat_settings(chat_id, change) for change in changes))
+        settings = await st.chat_settings(chat_id)
+        cleared = await st.update_chat_settings(chat_id, None)
+        return settings, cleared, await st.chat_settings(chat_id)
+
+    settings, cleared, after = asyncio.run(run())
+    assert settings == {"humor": "soft", "context": 7, "daily": False, "web": False}
+    assert cleared == {} and after == {}
@@ -0,0 +1,125 @@
+from datetime import datetime, timedelta, timezone
+
+import storage
+from rows import Row
+
+
+def test_rows_logged_during_a_cache_load_are_kept(monkeypatch):
+    chat_id = -4001
+    for i in range(5):
+        storage.log_message(chat_id, "u", f"old {i}")
+    read = storage._engine.read_last_n
+
+    def racing_read(cid: int, n: int):
+        # The event loop keeps logging while the worker thread reads.
+        storage.log_message(chat_id, "u", "during")
+        rows = read(cid, n)
+        storage.log_message(chat_id, "u", "after")
+        return rows
+
+    monkeypatch.setattr(storage._engine, "read_last_n", racing_read)
+    expected = [f"old {i}" for i in range(5)] + ["during", "after"]
+    assert [r.text for r in storage.read_last_n(chat_id, 10)] == expected
+    monkeypatch.setattr(storage._engine, "read_last_n", read)
+    storage.log_message(chat_id, "u", "next")
+    assert [r.text for r in storage.read_last_n(chat_id, 10)] == expected + ["next"]
+
+
+def _day_rows(chat_id: int, day: datetime, count: int, step_s: int = 60) -> list[dict]:
+    return [
+        {
+            "ts": (day + timedelta(seconds=i * step_s)).isoformat(),
+            "chat_id": chat_id,
+            "user": f"u{i % 3}",
+            "text": f"{day:%d} {i} ё",
+        }
+        for i in range(count)
+    ]
+
+
+def _midnight(days_ago: int) -> datetime:
+    today = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0)
+    return today - timedelta(days=days_ago)
+
+
+def test_segments_index_every_row_and_serve_time_reads():
+    chat_id = -4101
+    rows = _day_rows(chat_id, _midnight(2), 500) + _day_rows(chat_id, _midnight(1), 500)
+    storage._engine.append_rows(rows[:300])
+    storage._engine.append_rows(rows[300:])
+
+    day = rows[0]["ts"][:10]
+    segment = storage._segment_path(chat_id, day)
+    index = storage._read_index(segment)
+    assert len(index) // storage._OFFSET.size == 500
+    with segment.open("rb") as f:
+        for i in (0, 299, 300, 499):
+            offset = storage._OFFSET.unpack_from(index, i * storage._OFFSET.size)[0]
+            assert storage._row_at(f, offset).ts == rows[i]["ts"]
+
+    since = datetime.fromisoformat(rows[250]["ts"])
+    assert [r.ts for r in storage._engine.read_since(chat_id, since)] == [r["ts"] for r in rows[250:]]
+    assert [r.text for r in storage._engine.read_last_n(chat_id, 600)] == [r["text"] for r in rows[-600:]]
+
+
+def test_compaction_keeps_reads_and_folds_late_rows():
+    chat_id = -4102
+    old = _day_rows(chat_id, _midnight(3), 200)
+    storage._engine.append_rows(old)
+    storage._maintain_segments(compress_after_days=1, retention_days=0, retention_by_chat={})
+
+    day = old[0]["ts"][:10]
+    assert not storage._segment_path(chat_id, day).exists()
+    assert not storage._index_path(storage._segment_path(chat_id, day)).exists()
+    assert storage._archive_path(chat_id, day).exists()
+    assert [r.ts for r in storage._engine.read_since(chat_id, _midnight(4))] == [r["ts"] for r in old]
+
+    # A late row for the compressed day starts a new segment next to the
+    # archive; both are read, and the next run folds it in.
+    late = {**old[-1], "ts": (datetime.fromisoformat(old[-1]["ts"]) + timedelta(seconds=1)).isoformat(), "text": "late"}
+    storage._engine.append_rows([late])
+    assert storage._engine.read_last_n(chat_id, 2)[-1].text == "late"
+    storage._maintain_segments(compress_after_days=1, retention_days=0, retention_by_chat={})
+    assert not storage._segment_path(chat_id, day).exists()
+    assert [r.text for r in storage._engine.read_since(chat_id, _midnight(4))][-2:] == [old[-1]["text"], "late"]
+
+
+def test_retention_deletes_old_days_with_per_chat_overrides():
+    kept, trimmed = -4103, -4104
+    for chat_id in (kept, trimmed):
+        storage._engine.append_rows(_day_rows(chat_id, _midnight(10), 10) + _day_rows(chat_id, _midnight(2), 10))
+    storage._maintain_segments(compress_after_days=30, retention_days=0, retention_by_chat={trimmed: 5})
+
+    assert len(storage._engine.read_since(kept, _midnight(11))) == 20
+    days = [r.ts[:10] for r in storage._engine.read_since(trimmed, _midnight(11))]
+    assert days == [_midnight(2).date().isoformat()] * 10
+
+
+def _row(chat_id: int, i: int, text: str = "x") -> Row:
+    return Row(f"2026-01-01T00:00:{i:02d}+00:00", chat_id, "u", f"{text}{i}")
+
+
+def test_recent_cache_serves_loaded_windows_only():
+    cache = storage.RecentCache(depth=5, max_bytes=1 << 20)
+    cache.append(1, _row(1, 0))
+    assert cache.get(1, 1) is None  # never loaded: appends are not cached
+
+    cache.load(1, [_row(1, i) for i in range(8)], complete=False)
+    cache.append(1, _row(1, 8))
+    assert [r.text for r in cache.get(1, 3)] == ["x6", "x7", "x8"]
+    assert cache.get(1, 6) is None  # deeper than the window and not the whole history
+
+    cache.load(2, [_row(2, i) for i in range(2)], complete=True)
+    assert [r.text for r in cache.get(2, 5)] == ["x0", "x1"]  # the whole history
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_recent_cache_evicts_least_recently_used_chats():
+    row_size = storage.RecentCache._row_size(_row(0, 0))
+    cache = storage.RecentCache(depth=4, max_bytes=row_size * 9)
+    for chat_id in (1, 2):
+        cache.load(chat_id, [_row(chat_id, i) for i in range(4)], complete=True)
+    cache.get(1, 1)
+    cache.load(3, [_row(3, i) for i in range(4)], complete=True)
+    assert cache.get(2, 1) is None
+    assert cache.get(1, 1) is not None and cache.get(3, 1) is not None
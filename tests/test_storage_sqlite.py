@@ -0,0 +1,73 @@
+import gzip
+import json
+from datetime import datetime, timedelta, timezone
+
+import pytest
+
+from storage_sqlite import SqliteEngine, import_files
+
+START = datetime(2026, 1, 1, tzinfo=timezone.utc)
+
+
+def _rows(chat_id: int, first: int, count: int) -> list[dict]:
+    return [
+        {"ts": (START + timedelta(minutes=i)).isoformat(), "chat_id": chat_id, "user": "u", "text": f"m{i}"}
+        for i in range(first, first + count)
+    ]
+
+
+def test_messages_read_back_in_time_order(tmp_path):
+    engine = SqliteEngine(tmp_path / "db.sqlite3")
+    engine.append_rows(_rows(1, 50, 50) + _rows(2, 0, 10))
+    engine.append_rows(_rows(1, 0, 50))
+
+    assert [r.text for r in engine.read_last_n(1, 3)] == ["m97", "m98", "m99"]
+    since = engine.read_since(1, START + timedelta(minutes=40))
+    assert [r.text for r in since] == [f"m{i}" for i in range(40, 100)]
+    assert {r.chat_id for r in since} == {1}
+
+
+def test_chat_upserts_merge_and_bump_the_version(tmp_path):
+    engine = SqliteEngine(tmp_path / "db.sqlite3")
+    version = engine.chats_version()
+    engine.upsert_chat(-1, {"title": "a"})
+    engine.upsert_chat(-1, {"settings": {"humor": "soft"}})
+    assert engine.chats_version() == version + 2
+    assert engine.load_chats() == {"-1": {"title": "a", "settings": {"humor": "soft"}}}
+    # Another connection (a second process) sees the same stamp.
+    assert SqliteEngine(tmp_path / "db.sqlite3").chats_version() == version + 2
+
+
+def test_retention_deletes_only_old_rows(tmp_path):
+    engine = SqliteEngine(tmp_path / "db.sqlite3")
+    now = datetime.now(timezone.utc)
+    old = {"ts": (now - timedelta(days=10)).isoformat(), "chat_id": 1, "user": "u", "text": "old"}
+    new = {"ts": now.isoformat(), "chat_id": 1, "user": "u", "text": "new"}
+    engine.append_rows([old, new, {**old, "chat_id": 2}])
+
+    stats = engine.maintain(compress_after_days=1, retention_days=5, retention_by_chat={2: 0})
+    assert stats["deleted"] == 1
+    assert [r.text for r in engine.read_last_n(1, 5)] == ["new"]
+    assert [r.text for r in engine.read_last_n(2, 5)] == ["old"]
+
+
+def test_import_files_reads_every_layout_once(tmp_path):
+    data = tmp_path / "data"
+    chat_dir = data / "messages" / "-7"
+    chat_dir.mkdir(parents=True)
+    (data / "chats.json").write_text(json.dumps({"-7": {"title": "t"}}), encoding="utf-8")
+    rows = _rows(-7, 0, 30)
+    # Legacy log with a local-time stamp, an archived day and a live one.
+    msk = timezone(timedelta(hours=3))
+    legacy = {**rows[0], "ts": datetime.fromisoformat(rows[0]["ts"]).astimezone(msk).isoformat()}
+    (data / "messages.jsonl").write_text(json.dumps(legacy) + "\n", encoding="utf-8")
+    with gzip.open(chat_dir / "2025-12-31.jsonl.gz", "wt", encoding="utf-8") as f:
+        f.writelines(json.dumps(r) + "\n" for r in rows[1:10])
+    (chat_dir / "2026-01-01.jsonl").write_text("".join(json.dumps(r) + "\n" for r in rows[10:]), encoding="utf-8")
+
+    engine = SqliteEngine(tmp_path / "db.sqlite3")
+    assert import_files(engine, data, batch_size=7) == {"chats": 1, "messages": 30, "files": 3}
+    assert engine.load_chats() == {"-7": {"title": "t"}}
+    assert [r.ts for r in engine.read_since(-7, START)] == [r["ts"] for r in rows]
+    with pytest.raises(RuntimeError):
+        import_files(engine, data)
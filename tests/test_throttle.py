@@ -0,0 +1,73 @@
+import asyncio
+from types import SimpleNamespace
+
+from aiogram.enums import ChatType
+
+from state import MemoryState
+from throttle import ThrottleMiddleware
+
+GROUP = -6001
+
+
+def _message(user_id: int, chat_id: int = GROUP, chat_type: ChatType = ChatType.SUPERGROUP, replies=None):
+    async def reply(text: str):
+        replies.append(text)
+
+    return SimpleNamespace(
+        text="/nax кто-то",
+        chat=SimpleNamespace(id=chat_id, type=chat_type),
+        from_user=SimpleNamespace(id=user_id),
+        reply=reply,
+    )
+
+
+def _run(limits: dict, calls: list[tuple[int, str]], chat_id: int = GROUP, bound: bool = True, overloaded=None):
+    # Sends /nax from each (user, route) in `calls`; returns what reached the
+    # handler, what was logged on rejection, the notices sent and the state.
+    handled, logged, replies = [], [], []
+    state = MemoryState()
+
+    async def handler(event, data):
+        handled.append(event.from_user.id)
+
+    async def on_rejected(event):
+        logged.append(event.from_user.id)
+
+    async def run():
+        if bound:
+            await state.bind_chat(chat_id, "g")
+        middleware = ThrottleMiddleware(state, limits, 60, overloaded=overloaded, on_rejected=on_rejected)
+        for user_id, route in calls:
+            await middleware(handler, _message(user_id, chat_id, replies=replies), {"route": route})
+
+    asyncio.run(run())
+    return handled, logged, replies, state
+
+
+def test_rejected_calls_are_logged_and_noticed_once():
+    limits = {"nax": {"user": (1, 60), "chat": (2, 60)}}
+    handled, logged, replies, _ = _run(limits, [(1, "nax"), (1, "nax"), (2, "nax"), (3, "nax")])
+    assert handled == [1, 2]
+    assert logged == [1, 3]
+    assert len(replies) == 1 and replies[0].startswith("Остынь")
+
+
+def test_chat_rejection_does_not_spend_the_user_token():
+    limits = {"nax": {"user": (1, 60), "chat": (1, 60)}}
+    handled, _, _, state = _run(limits, [(1, "nax"), (2, "nax")])
+    assert handled == [1]
+    assert asyncio.run(state.take([("nax:user:2", 1, 60)])) == (0.0, -1)
+
+
+def test_other_messages_and_unbound_chats_pass_through():
+    limits = {"nax": {"user": (1, 60)}}
+    handled, logged, _, _ = _run(limits, [(1, "plain"), (1, "command"), (1, "plain")])
+    assert handled == [1, 1, 1] and logged == []
+    handled, logged, _, _ = _run(limits, [(1, "nax"), (1, "nax")], chat_id=-6002, bound=False)
+    assert handled == [1, 1] and logged == []
+
+
+def test_overload_sheds_llm_commands():
+    handled, logged, replies, _ = _run({}, [(1, "nax"), (1, "plain")], overloaded=lambda: True)
+    assert handled == [1] and logged == [1]
+    assert replies == ["Порфирий перегружен. Попробуй через минуту."]